@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+"""
+Compares the conversion engines on the same templates.
+
+Usage: python benchmarks/conversion_engines.py [--engines wkhtmltopdf,weasyprint,chromium]
+       [--runs N] [--rows N]
+
+Each engine runs in its own process, so that its memory use is measured
+alone. For each template, reports the median and 95th percentile time of
+render_pdf_from_template(), the size of the PDF, and the peak RSS of the
+Python process and of the converter processes it started. Engines that
+aren't available on this host are skipped.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+TEMPLATES = {
+    # A short document, where starting the converter dominates.
+    'letter.html': """<html><body>
+<p>{{ city }}, {{ date }}</p>
+<p>Dear {{ name }},</p>
+{% for i in paragraphs %}<p>Lorem ipsum dolor sit amet, consectetur adipiscing
+elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>
+{% endfor %}<p>Yours sincerely,</p></body></html>
+""",
+    # A long table, where layout dominates.
+    'invoice.html': """<html><head><style>
+td { border-bottom: 1px solid #ccc; padding: 2px 4px; }
+</style></head><body><h1>Invoice {{ number }}</h1><table>
+{% for line in lines %}<tr><td>{{ line.sku }}</td><td>{{ line.description }}</td>
+<td>{{ line.quantity }}</td><td>{{ line.price|floatformat:2 }}</td></tr>
+{% endfor %}</table></body></html>
+""",
+    # Flexbox and grid, which wkhtmltopdf's old WebKit lays out differently.
+    'cards.html': """<html><head><style>
+.grid { display: grid; grid-template-columns: repeat(3, 1fr); gap: 8px; }
+.card { display: flex; flex-direction: column; border: 1px solid #999;
+        border-radius: 4px; padding: 8px; }
+</style></head><body><div class="grid">
+{% for line in lines|slice:":60" %}<div class="card"><b>{{ line.sku }}</b>
+<span>{{ line.description }}</span></div>{% endfor %}
+</div></body></html>
+""",
+}
+
+CMD_OPTIONS = {'page_size': 'A4', 'margin_top': '15', 'margin_bottom': '15'}
+
+
+def setup():
+    directory = tempfile.mkdtemp()
+    for name, source in TEMPLATES.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(source)
+    settings.configure(
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                    'DIRS': [directory]}],
+        STATIC_URL='/static/', STATIC_ROOT='/srv/static',
+        MEDIA_URL='/media/', MEDIA_ROOT='/srv/media',
+    )
+    django.setup()
+
+
+def worker(engine, runs, rows):
+    """Converts every template with ``engine`` and prints the results as
+    JSON."""
+    setup()
+    from wkhtmltopdf.engines import get_engine
+    from wkhtmltopdf.utils import render_pdf_from_template
+
+    if not get_engine(engine).available():
+        print(json.dumps(None))
+        return
+    context = {'city': 'Lyon', 'date': '1 March', 'name': 'Ada',
+               'paragraphs': range(6), 'number': 42, 'lines': [
+                   {'sku': 'SKU-%06d' % i, 'description': 'Item <%d> & co' % i,
+                    'quantity': i % 7 + 1, 'price': i * 1.25}
+                   for i in range(rows)]}
+    results = {}
+    for name in sorted(TEMPLATES):
+        timings = []
+        for i in range(runs):
+            start = default_timer()
+            pdf = render_pdf_from_template(name, None, None, context,
+                                           cmd_options=CMD_OPTIONS, engine=engine)
+            timings.append(default_timer() - start)
+        timings.sort()
+        results[name] = {
+            'p50': timings[len(timings) // 2],
+            'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'size': len(pdf),
+        }
+    # ru_maxrss is in kilobytes on Linux.
+    results['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['child_rss'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engines', default='wkhtmltopdf,weasyprint,chromium')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.worker:
+        worker(options.worker, options.runs, options.rows)
+        return
+
+    print('%12s %14s %10s %10s %10s %12s %12s' % (
+        'engine', 'template', 'p50 ms', 'p95 ms', 'PDF KB', 'RSS MB', 'child MB'))
+    for engine in options.engines.split(','):
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), '--worker', engine,
+            '--runs', str(options.runs), '--rows', str(options.rows)])
+        results = json.loads(output.decode().splitlines()[-1])
+        if results is None:
+            print('%12s %14s' % (engine, 'unavailable'))
+            continue
+        for name in sorted(TEMPLATES):
+            print('%12s %14s %10.1f %10.1f %10.1f %12.1f %12.1f' % (
+                engine, name, results[name]['p50'] * 1000,
+                results[name]['p95'] * 1000, results[name]['size'] / 1024.0,
+                results['rss'] / 1024.0, results['child_rss'] / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
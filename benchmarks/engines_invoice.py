@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+"""
+Compares Django templates and Jinja2 rendering a large invoice table.
+
+Usage: python benchmarks/engines_invoice.py [--rows 1000,10000,100000] [--runs N]
+
+For each engine, reports the time and peak Python memory of render() into
+a string and of render_to_temporary_file(), which streams the output.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+TEMPLATES = {
+    'django': """<html><body><h1>Invoice {{ number }}</h1>
+<table>
+{% for line in lines %}<tr><td>{{ line.sku }}</td><td>{{ line.description }}</td>
+<td>{{ line.quantity }}</td><td>{{ line.price|floatformat:2 }}</td></tr>
+{% endfor %}</table>
+<img src="/static/logo.png"></body></html>
+""",
+    'jinja2': """<html><body><h1>Invoice {{ number }}</h1>
+<table>
+{% for line in lines %}<tr><td>{{ line.sku }}</td><td>{{ line.description }}</td>
+<td>{{ line.quantity }}</td><td>{{ '%.2f'|format(line.price) }}</td></tr>
+{% endfor %}</table>
+<img src="/static/logo.png"></body></html>
+""",
+}
+
+
+def setup():
+    directory = tempfile.mkdtemp()
+    for engine, source in TEMPLATES.items():
+        os.mkdir(os.path.join(directory, engine))
+        with open(os.path.join(directory, engine, 'invoice.html'), 'w') as f:
+            f.write(source)
+    settings.configure(
+        TEMPLATES=[
+            {'BACKEND': 'django.template.backends.django.DjangoTemplates',
+             'DIRS': [os.path.join(directory, 'django')], 'NAME': 'django'},
+            {'BACKEND': 'django.template.backends.jinja2.Jinja2',
+             'DIRS': [os.path.join(directory, 'jinja2')], 'NAME': 'jinja2'},
+        ],
+        STATIC_URL='/static/', STATIC_ROOT='/srv/static',
+        MEDIA_URL='/media/', MEDIA_ROOT='/srv/media',
+    )
+    django.setup()
+
+
+def measure(func, runs):
+    timings = []
+    for i in range(runs):
+        start = default_timer()
+        func()
+        timings.append(default_timer() - start)
+    timings.sort()
+    # Tracing slows allocations down, so memory is measured separately.
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return timings[len(timings) // 2], peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', default='1000,10000,100000')
+    parser.add_argument('--runs', type=int, default=3)
+    options = parser.parse_args()
+
+    setup()
+    from wkhtmltopdf.utils import render_to_temporary_file, resolve_template
+
+    print('%8s %8s %14s %14s %14s %14s' % (
+        'rows', 'engine', 'render ms', 'render MB', 'streamed ms', 'streamed MB'))
+    for rows in [int(r) for r in options.rows.split(',')]:
+        context = {'number': 42, 'lines': [
+            {'sku': 'SKU-%06d' % i, 'description': 'Item <%d> & co' % i,
+             'quantity': i % 7 + 1, 'price': i * 1.25} for i in range(rows)]}
+        for engine in ('django', 'jinja2'):
+            template = resolve_template('invoice.html', using=engine)
+            render_ms, render_peak = measure(
+                lambda: template.render(context), options.runs)
+            stream_ms, stream_peak = measure(
+                lambda: render_to_temporary_file(template, context).close(),
+                options.runs)
+            print('%8d %8s %14.1f %14.1f %14.1f %14.1f' % (
+                rows, engine, render_ms * 1000, render_peak / 1e6,
+                stream_ms * 1000, stream_peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
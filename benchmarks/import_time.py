@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+"""
+Measures the cold import cost of wkhtmltopdf modules in fresh interpreters.
+
+Usage: python benchmarks/import_time.py [--runs N] [module ...]
+
+Each module is imported after django.setup() with minimal settings, and the
+time and peak RSS are reported relative to django.setup() alone. The default
+modules are wkhtmltopdf, wkhtmltopdf.views (what a URLconf imports) and
+wkhtmltopdf.utils (what a render imports).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, resource, sys
+from timeit import default_timer
+import django
+from django.conf import settings
+settings.configure()
+django.setup()
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+modules = len(sys.modules)
+start = default_timer()
+if sys.argv[1]:
+    __import__(sys.argv[1])
+print(json.dumps({
+    'seconds': default_timer() - start,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    'modules': len(sys.modules) - modules,
+}))
+"""
+
+
+def measure(module, runs):
+    samples = []
+    for i in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', CHILD, module], cwd=ROOT)
+        samples.append(json.loads(output.decode()))
+    samples.sort(key=lambda s: s['seconds'])
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('modules', nargs='*', default=[
+        'wkhtmltopdf', 'wkhtmltopdf.views', 'wkhtmltopdf.utils'])
+    parser.add_argument('--runs', type=int, default=20)
+    options = parser.parse_args()
+
+    print('%-24s %12s %12s %10s' % ('module', 'import ms', 'RSS KB', 'modules'))
+    for module in options.modules:
+        sample = measure(module, options.runs)
+        print('%-24s %12.2f %12d %10d' % (module, sample['seconds'] * 1000,
+                                          sample['rss_kb'], sample['modules']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+"""
+Measures the effect of WKHTMLTOPDF_MINIFY on a large indented invoice table.
+
+Usage: python benchmarks/minify.py [--rows 1000,10000,100000] [--runs N]
+
+For each size, reports the size of the temporary file and the time to
+render and write it, with and without minification, and the time
+wkhtmltopdf takes to convert it if the binary (or WKHTMLTOPDF_CMD) is
+available. Minification trades Python time for less I/O and less HTML for
+wkhtmltopdf to parse and lay out.
+"""
+import argparse
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+# Indented like a typical hand-written template, with a debug comment per row.
+TEMPLATE = """<html>
+  <head>
+    <style>
+      td { padding: 2px 4px; }
+    </style>
+  </head>
+  <body>
+    <h1>Invoice {{ number }}</h1>
+    <table>
+      {% for line in lines %}
+        <!-- line {{ forloop.counter }} -->
+        <tr>
+          <td>{{ line.sku }}</td>
+          <td>{{ line.description }}</td>
+          <td>{{ line.quantity }}</td>
+          <td>{{ line.price|floatformat:2 }}</td>
+        </tr>
+      {% endfor %}
+    </table>
+  </body>
+</html>
+"""
+
+
+def measure(func, runs):
+    timings = []
+    for i in range(runs):
+        start = default_timer()
+        result = func()
+        timings.append(default_timer() - start)
+    timings.sort()
+    return timings[len(timings) // 2], result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', default='1000,10000,100000')
+    parser.add_argument('--runs', type=int, default=3)
+    options = parser.parse_args()
+
+    settings.configure(
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}],
+        STATIC_URL='/static/', STATIC_ROOT='/srv/static',
+        MEDIA_URL='/media/', MEDIA_ROOT='/srv/media',
+    )
+    django.setup()
+    from django.template import engines
+    from wkhtmltopdf.utils import render_to_temporary_file, wkhtmltopdf
+
+    cmd = os.environ.get('WKHTMLTOPDF_CMD', 'wkhtmltopdf')
+    convert = shutil.which(shlex.split(cmd)[0]) is not None
+    template = engines['django'].from_string(TEMPLATE)
+    directory = tempfile.mkdtemp()
+
+    print('%8s %8s %12s %12s %16s' % (
+        'rows', 'minify', 'file MB', 'write ms', 'wkhtmltopdf ms'))
+    try:
+        for rows in [int(r) for r in options.rows.split(',')]:
+            context = {'number': 42, 'lines': [
+                {'sku': 'SKU-%06d' % i, 'description': 'Item <%d> & co' % i,
+                 'quantity': i % 7 + 1, 'price': i * 1.25} for i in range(rows)]}
+            for minify in (False, True):
+                path = os.path.join(directory, 'invoice-%s.html' % minify)
+
+                def write():
+                    rendered = render_to_temporary_file(template, context,
+                                                        dir=directory,
+                                                        delete=False)
+                    rendered.close()
+                    os.replace(rendered.name, path)
+                    return os.path.getsize(path)
+
+                with override_settings(WKHTMLTOPDF_MINIFY=minify):
+                    write_seconds, size = measure(write, options.runs)
+                convert_ms = 'n/a'
+                if convert:
+                    seconds = measure(lambda: wkhtmltopdf([path]), options.runs)[0]
+                    convert_ms = '%.1f' % (seconds * 1000)
+                print('%8d %8s %12.2f %12.1f %16s' % (
+                    rows, minify, size / 1e6, write_seconds * 1000, convert_ms))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
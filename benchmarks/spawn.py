@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+"""
+Compares the latency of starting a child process through the old
+check_output() path and through wkhtmltopdf.subprocess.spawn(), for
+increasing parent RSS.
+
+Usage: python benchmarks/spawn.py [command] [--runs N] [--rss 0,256,1024]
+
+The default command is ``wkhtmltopdf --version`` if WKHTMLTOPDF_CMD or the
+binary is available, ``true`` otherwise.
+"""
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wkhtmltopdf.subprocess import spawn  # noqa: E402
+
+
+def legacy(args, env):
+    # What wkhtmltopdf() did before: merge the environment on every call,
+    # search PATH in the child and let close_fds default to True.
+    env = dict(os.environ, **env)
+    return subprocess.check_output(args, env=env, stderr=subprocess.PIPE)
+
+
+def fast(args, env):
+    # get_env() merges the environment once and caches it.
+    return spawn(args, env=env)
+
+
+def measure(func, args, env, runs):
+    timings = []
+    for i in range(runs):
+        start = default_timer()
+        func(args, env)
+        timings.append(default_timer() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def main():
+    default = os.environ.get('WKHTMLTOPDF_CMD', 'wkhtmltopdf')
+    if shutil.which(shlex.split(default)[0]):
+        default += ' --version'
+    else:
+        default = 'true'
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('command', nargs='?', default=default)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--rss', default='0,256,1024',
+                        help='Comma separated extra RSS in MB.')
+    options = parser.parse_args()
+
+    args = shlex.split(options.command)
+    env = {'WKHTMLTOPDF_BENCHMARK': '1'}
+    # Both children get the same environment; only the legacy path pays
+    # for merging it on every call.
+    merged_env = dict(os.environ, **env)
+    print('command: %s, runs: %d' % (options.command, options.runs))
+    print('%10s %14s %14s %14s %14s' % ('RSS MB', 'legacy p50 ms', 'legacy p95 ms',
+                                        'spawn p50 ms', 'spawn p95 ms'))
+    for size in [int(s) for s in options.rss.split(',')]:
+        # Touch every page so the memory is resident.
+        ballast = bytearray(size * 1024 * 1024)
+        for i in range(0, len(ballast), 4096):
+            ballast[i] = 1
+        legacy_p50, legacy_p95 = measure(legacy, args, env, options.runs)
+        fast_p50, fast_p95 = measure(fast, args, merged_env, options.runs)
+        print('%10d %14.2f %14.2f %14.2f %14.2f' % (
+            size, legacy_p50 * 1000, legacy_p95 * 1000,
+            fast_p50 * 1000, fast_p95 * 1000))
+        del ballast
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,24 @@
-import os
-if 'DJANGO_SETTINGS_MODULE' in os.environ:
-    from .utils import *
-
 __author__ = 'Incuna Ltd'
 __version__ = '3.4.0'
+
+# Helpers of wkhtmltopdf.utils that are also available from the package.
+# They are imported on first use, so that importing the package doesn't load
+# the template machinery.
+_UTILS = (
+    'ContentWriter', 'NO_ARGUMENT_OPTIONS', 'RenderedFile',
+    'content_disposition_filename', 'content_filters', 'convert_to_pdf',
+    'get_command', 'get_env', 'http_quote', 'iter_render',
+    'make_absolute_paths', 'pathname2fileurl', 'plan_pdf_from_template',
+    'resolve_template',
+    'render_chunked_pdf_from_template', 'render_image_from_template',
+    'render_pdf_and_image_from_template', 'render_pdf_from_template',
+    'render_to_temporary_file', 'split_chunks', 'template_name',
+    'wkhtmltoimage', 'wkhtmltopdf',
+)
+
+
+def __getattr__(name):
+    if name in _UTILS:
+        from importlib import import_module
+        return getattr(import_module('.utils', __name__), name)
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
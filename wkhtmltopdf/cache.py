@@ -0,0 +1,207 @@
+from contextlib import contextmanager
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.http import FileResponse
+
+from .result import PDFResult
+from .signals import setting_changed
+
+
+class PDFCache(object):
+    """
+    Disk store for generated PDFs.
+
+    Files are stored under ``location`` in directories sharded by the
+    SHA-256 of their key, e.g. ``ab/cd/abcd...pdf``, and are written
+    atomically. A SQLite index in ``location`` keeps their sizes, last
+    access times and total size, and the least recently used files are
+    removed when the total size goes over ``max_size`` bytes.
+
+    Cached PDFs are returned as file-backed ``PDFResult`` objects, which
+    are served from an mmap without reading them into memory.
+    """
+
+    index_filename = 'index.sqlite3'
+    # Seconds between updates of the access time of a file.
+    touch_interval = 60
+    # Entries read at once when evicting.
+    eviction_batch = 16
+
+    def __init__(self, location, max_size=None, shard_depth=2):
+        self.location = location
+        self.max_size = max_size
+        self.shard_depth = shard_depth
+        self._local = threading.local()
+        if not os.path.isdir(location):
+            os.makedirs(location)
+
+    @property
+    def _db(self):
+        # SQLite connections can't be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.location, self.index_filename),
+                                 timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'digest TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                       'accessed REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS entries_accessed '
+                       'ON entries (accessed)')
+            # The total size of the entries, kept up to date by set() and
+            # _remove() in their transactions.
+            db.execute('CREATE TABLE IF NOT EXISTS totals ('
+                       'name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            db.execute("INSERT OR IGNORE INTO totals SELECT 'size', "
+                       "COALESCE(SUM(size), 0) FROM entries")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def digest(self, key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """Returns the path the PDF for ``key`` is stored at."""
+        return self._path(self.digest(key))
+
+    def _path(self, digest):
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.location, *(shards + [digest + '.pdf']))
+
+    def get(self, key):
+        """Returns the cached PDF for ``key`` as a PDFResult, or None."""
+        result = PDFResult(args=None, returncode=0, duration=0,
+                           path=self.path(key))
+        try:
+            # Mapped now, so that it stays readable if evicted meanwhile.
+            result.raw
+        except FileNotFoundError:
+            return None
+        self._touch(self.digest(key))
+        return result
+
+    def _touch(self, digest):
+        now = time.time()
+        self._db.execute('UPDATE entries SET accessed = ? '
+                         'WHERE digest = ? AND accessed < ?',
+                         (now, digest, now - self.touch_interval))
+
+    def set(self, key, content):
+        """
+        Stores ``content``, bytes or a PDFResult, as the PDF for ``key``
+        and returns its path.
+        """
+        if isinstance(content, PDFResult):
+            content = content.buffer
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        # Readers never see a partial file: it is written under a temporary
+        # name in the same directory and renamed.
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        digest = self.digest(key)
+        with self._transaction() as db:
+            row = db.execute('SELECT size FROM entries WHERE digest = ?',
+                             (digest,)).fetchone()
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                       (digest, len(content), time.time()))
+            db.execute("UPDATE totals SET value = value + ? WHERE name = 'size'",
+                       (len(content) - (row[0] if row else 0),))
+        if self.max_size is not None:
+            self.evict(self.max_size)
+        return path
+
+    def delete(self, key):
+        self._remove(self.digest(key))
+
+    def _remove(self, digest):
+        with self._transaction() as db:
+            row = db.execute('SELECT size FROM entries WHERE digest = ?',
+                             (digest,)).fetchone()
+            if row is not None:
+                db.execute('DELETE FROM entries WHERE digest = ?', (digest,))
+                db.execute("UPDATE totals SET value = value - ? "
+                           "WHERE name = 'size'", (row[0],))
+        try:
+            os.unlink(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    @property
+    def size(self):
+        """The total size of the cached PDFs in bytes."""
+        return self._db.execute(
+            "SELECT value FROM totals WHERE name = 'size'").fetchone()[0]
+
+    def evict(self, max_size):
+        """Removes the least recently used PDFs until ``max_size`` is met."""
+        while self.size > max_size:
+            # Other processes may evict too: the total is read again after
+            # each batch.
+            rows = self._db.execute(
+                'SELECT digest, size FROM entries ORDER BY accessed LIMIT ?',
+                (self.eviction_batch,)).fetchall()
+            if not rows:
+                break
+            excess = self.size - max_size
+            for digest, size in rows:
+                if excess <= 0:
+                    break
+                self._remove(digest)
+                excess -= size
+
+    def file_response(self, key, filename=None, as_attachment=True):
+        """
+        Returns a FileResponse streaming the cached PDF for ``key``, or None
+        if it is not cached.
+        """
+        try:
+            f = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        self._touch(self.digest(key))
+        return FileResponse(f, as_attachment=as_attachment, filename=filename,
+                            content_type='application/pdf')
+
+
+_cache = []
+
+
+def get_pdf_cache():
+    """Returns the PDFCache configured by WKHTMLTOPDF_CACHE, or None."""
+    if not _cache:
+        config = getattr(settings, 'WKHTMLTOPDF_CACHE', None)
+        _cache.append(PDFCache(**config) if config else None)
+    return _cache[0]
+
+
+def _reset_cache(**kwargs):
+    if kwargs['setting'] == 'WKHTMLTOPDF_CACHE':
+        del _cache[:]
+
+setting_changed.connect(_reset_cache)
@@ -0,0 +1,132 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULTS = {
+    # Cache alias used to coalesce across processes. None for in-process only.
+    'cache': None,
+    # Seconds to wait for another process before rendering anyway.
+    'timeout': 60,
+    # Seconds a shared result stays available to late arrivals.
+    'ttl': 5,
+    # Seconds between polls of the cache while waiting.
+    'poll_interval': 0.1,
+}
+
+
+def get_config():
+    config = getattr(settings, 'WKHTMLTOPDF_COALESCE', False)
+    if not config:
+        return None
+    options = DEFAULTS.copy()
+    if isinstance(config, dict):
+        options.update(config)
+    return options
+
+
+def render_key(filenames, cmd_options):
+    """
+    Returns a key identifying a conversion by the content of its rendered
+    files and its options.
+
+    Hashing the rendered HTML rather than the context means requests only
+    share output when it would have been identical.
+    """
+    key = hashlib.sha1()
+    for filename in filenames:
+        key.update(b'\0')
+        if filename is None:
+            continue
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                key.update(block)
+    key.update(repr(sorted(cmd_options.items())).encode('utf-8'))
+    return key.hexdigest()
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs ``func`` once for concurrent callers with the same key.
+
+    Callers arriving while a call is in progress wait for it and share its
+    return value or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.value
+
+
+def _shared_call(key, func, config):
+    """Coalesces ``func`` across processes with a lock in the cache."""
+    cache = caches[config['cache']]
+    lock_key = 'wkhtmltopdf:coalesce:lock:%s' % key
+    result_key = 'wkhtmltopdf:coalesce:result:%s' % key
+
+    value = cache.get(result_key)
+    if value is not None:
+        return value
+
+    if cache.add(lock_key, 1, config['timeout']):
+        try:
+            value = func()
+            cache.set(result_key, value, config['ttl'])
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.time() + config['timeout']
+    while time.time() < deadline:
+        time.sleep(config['poll_interval'])
+        value = cache.get(result_key)
+        if value is not None:
+            return value
+        if cache.get(lock_key) is None:
+            # The other process failed or its result expired.
+            break
+    return func()
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(key, func, config=None):
+    """Runs ``func`` once for all concurrent callers sharing ``key``."""
+    config = config or get_config() or DEFAULTS
+    if config['cache'] is None:
+        return single_flight.do(key, func)
+    return single_flight.do(key, lambda: _shared_call(key, func, config))
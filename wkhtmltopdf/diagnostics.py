@@ -0,0 +1,142 @@
+from collections import Counter, namedtuple
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+from .signals import render_diagnostics
+
+logger = logging.getLogger('wkhtmltopdf')
+
+# Event kinds.
+LOAD_FAILED = 'load_failed'
+LOAD_ERROR = 'load_error'
+SLOW_LOAD = 'slow_load'
+JAVASCRIPT = 'javascript'
+PROGRESS = 'progress'
+EXIT = 'exit'
+OTHER = 'other'
+
+StderrEvent = namedtuple('StderrEvent', ['kind', 'message', 'url'])
+
+# QNetworkReply::TimeoutError and QNetworkReply::OperationCanceledError.
+SLOW_NETWORK_STATUS_CODES = ('4', '5')
+
+_FAILED_LOAD = re.compile(r'^Warning: Failed to load (?P<url>\S+?),? \(\w+\)$')
+_LOAD_ERROR = re.compile(r'^Error: Failed to load (?P<url>\S+?), with network '
+                         r'status code (?P<code>\d+)')
+_SLOW_LOAD = re.compile(r'taking too long to load')
+_JAVASCRIPT = re.compile(r'^Warning: (?P<url>[^:\s]+:[^\s]*?):\d+ ')
+_PROGRESS = re.compile(r'^(?P<phase>[A-Z][\w ]+) \(\d+/\d+\)$|^Done$')
+_PROGRESS_BAR = re.compile(r'^\[[=> ]*\] *\d+%$')
+_EXIT = re.compile(r'^Exit with code \d+')
+
+
+def parse_stderr(stderr):
+    """
+    Parse the standard error output of wkhtmltopdf into a list of
+    ``StderrEvent``.
+
+    Progress bars are dropped, progress phases such as
+    ``Loading pages (1/6)`` are kept.
+    """
+    events = []
+    if not stderr:
+        return events
+    for line in re.split(r'[\r\n]+', smart_str(stderr)):
+        line = line.strip()
+        if not line or _PROGRESS_BAR.match(line):
+            continue
+
+        match = _FAILED_LOAD.match(line)
+        if match:
+            events.append(StderrEvent(LOAD_FAILED, line, match.group('url')))
+            continue
+
+        match = _LOAD_ERROR.match(line)
+        if match:
+            kind = LOAD_ERROR
+            if match.group('code') in SLOW_NETWORK_STATUS_CODES:
+                kind = SLOW_LOAD
+            events.append(StderrEvent(kind, line, match.group('url')))
+            continue
+
+        if _SLOW_LOAD.search(line):
+            events.append(StderrEvent(SLOW_LOAD, line, None))
+            continue
+
+        match = _JAVASCRIPT.match(line)
+        if match:
+            events.append(StderrEvent(JAVASCRIPT, line, match.group('url')))
+            continue
+
+        if _PROGRESS.match(line):
+            events.append(StderrEvent(PROGRESS, line, None))
+            continue
+
+        if _EXIT.match(line):
+            events.append(StderrEvent(EXIT, line, None))
+            continue
+
+        events.append(StderrEvent(OTHER, line, None))
+    return events
+
+
+class ResourceStats(object):
+    """Thread-safe per-template counters of failed and slow asset loads."""
+
+    tracked_kinds = (LOAD_FAILED, LOAD_ERROR, SLOW_LOAD)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def record(self, label, events):
+        kinds = [e.kind for e in events if e.kind in self.tracked_kinds]
+        if not kinds:
+            return
+        with self._lock:
+            self._counters.setdefault(label, Counter()).update(kinds)
+
+    def get(self, label):
+        with self._lock:
+            return Counter(self._counters.get(label, ()))
+
+    def as_dict(self):
+        with self._lock:
+            return dict((label, Counter(counts))
+                        for label, counts in self._counters.items())
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+resource_stats = ResourceStats()
+
+_LOG_LEVELS = {
+    LOAD_FAILED: logging.WARNING,
+    LOAD_ERROR: logging.WARNING,
+    SLOW_LOAD: logging.WARNING,
+    JAVASCRIPT: logging.INFO,
+    PROGRESS: logging.DEBUG,
+    EXIT: logging.ERROR,
+    OTHER: logging.WARNING,
+}
+
+
+def report_events(events, args, returncode, label=None):
+    """Log ``events``, count them per template and send the signal."""
+    for event in events:
+        logger.log(_LOG_LEVELS[event.kind], event.message,
+                   extra={'wkhtmltopdf_event': event.kind,
+                          'wkhtmltopdf_url': event.url,
+                          'wkhtmltopdf_label': label})
+
+    if getattr(settings, 'WKHTMLTOPDF_TRACK_RESOURCES', False):
+        resource_stats.record(label, events)
+
+    render_diagnostics.send(sender=None, args=args, events=events,
+                            returncode=returncode, label=label)
@@ -0,0 +1,258 @@
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import metrics, scheduler
+from .diagnostics import logger
+from .pdf import concatenate_pdfs
+from .result import PDFResult
+from .usage import CHROMIUM as CHROMIUM_RUNS, ResourceUsage
+from .utils import _execute, convert_to_pdf, get_command
+
+WKHTMLTOPDF = 'wkhtmltopdf'
+WEASYPRINT = 'weasyprint'
+CHROMIUM = 'chromium'
+
+# Options understood by every engine, named as for wkhtmltopdf. Lengths
+# without a unit are in millimetres.
+PAGE_OPTIONS = ('page_size', 'page_width', 'page_height', 'orientation',
+                'margin_top', 'margin_right', 'margin_bottom', 'margin_left')
+
+_UNITLESS = re.compile(r'^\s*[\d.]+\s*$')
+
+# Where insert_style() puts the <style> element, by preference.
+_STYLE_POSITIONS = [re.compile(pattern, re.IGNORECASE) for pattern in
+                    (br'<head\b[^>]*>', br'<html\b[^>]*>', br'<!doctype\b[^>]*>')]
+# Bytes of the file searched for them.
+STYLE_SEARCH_BYTES = 64 * 1024
+
+
+def _length(value):
+    value = str(value)
+    return value + 'mm' if _UNITLESS.match(value) else value
+
+
+def page_css(cmd_options):
+    """Returns an ``@page`` rule for the page options in ``cmd_options``."""
+    declarations = []
+    if cmd_options.get('page_width') and cmd_options.get('page_height'):
+        size = '%s %s' % (_length(cmd_options['page_width']),
+                          _length(cmd_options['page_height']))
+    else:
+        size = cmd_options.get('page_size') or ''
+    orientation = (cmd_options.get('orientation') or '').lower()
+    if orientation in ('landscape', 'portrait'):
+        size = ('%s %s' % (size, orientation)).strip()
+    if size:
+        declarations.append('size: %s' % size)
+    for side in ('top', 'right', 'bottom', 'left'):
+        value = cmd_options.get('margin_' + side)
+        if value is not None:
+            declarations.append('margin-%s: %s' % (side, _length(value)))
+    if not declarations:
+        return ''
+    return '@page { %s; }' % '; '.join(declarations)
+
+
+def insert_style(filename, css):
+    """
+    Inserts a ``<style>`` element with ``css`` at the start of the
+    ``<head>`` of the HTML file ``filename``, or after its ``<html>`` tag
+    or doctype if it has none. The rest of the file is copied as it is.
+    """
+    with open(filename, 'rb') as source:
+        start = source.read(STYLE_SEARCH_BYTES)
+        position = 0
+        for pattern in _STYLE_POSITIONS:
+            match = pattern.search(start)
+            if match is not None:
+                position = match.end()
+                break
+        fd, path = tempfile.mkstemp(suffix='.html',
+                                    dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                output.write(start[:position])
+                output.write(('<style>%s</style>' % css).encode('utf-8'))
+                output.write(start[position:])
+                shutil.copyfileobj(source, output)
+            os.replace(path, filename)
+        except BaseException:
+            os.unlink(path)
+            raise
+
+
+class BaseEngine(object):
+    """
+    Converts rendered HTML files to PDF.
+
+    Engines take the options of PAGE_OPTIONS. The wkhtmltopdf engine passes
+    all options to the command line; others ignore the options they don't
+    understand.
+    """
+    name = None
+
+    def available(self):
+        """Returns True if the engine can run on this host."""
+        return True
+
+    def convert(self, filename, header_filename=None, footer_filename=None,
+                cmd_options=None, cover_filename=None, label=None, result=False):
+        """
+        Converts the HTML file ``filename``, with an optional cover, and
+        returns the PDF as bytes, or a PDFResult if ``result`` is True.
+        """
+        raise NotImplementedError
+
+    def _page_options(self, cmd_options, header_filename, footer_filename):
+        if header_filename or footer_filename:
+            raise ValueError('The %s engine does not support header and footer '
+                             'templates; use CSS @page margin boxes.' % self.name)
+        ignored = sorted(set(cmd_options) - set(PAGE_OPTIONS))
+        if ignored:
+            logger.debug('The %s engine ignores the options %s.',
+                         self.name, ', '.join(ignored))
+        return dict((key, value) for key, value in cmd_options.items()
+                    if key in PAGE_OPTIONS)
+
+
+class WkhtmltopdfEngine(BaseEngine):
+    """The wkhtmltopdf binary of WKHTMLTOPDF_CMD."""
+    name = WKHTMLTOPDF
+
+    def available(self):
+        return shutil.which(get_command()[0]) is not None
+
+    def convert(self, filename, header_filename=None, footer_filename=None,
+                cmd_options=None, cover_filename=None, label=None, result=False):
+        return convert_to_pdf(filename=filename, header_filename=header_filename,
+                              footer_filename=footer_filename,
+                              cmd_options=cmd_options,
+                              cover_filename=cover_filename,
+                              label=label, result=result)
+
+
+class WeasyPrintEngine(BaseEngine):
+    """
+    Converts in this process with WeasyPrint, which avoids starting a
+    process and is often faster for short, simple documents.
+    """
+    name = WEASYPRINT
+
+    def _import(self):
+        try:
+            import weasyprint
+        except ImportError:
+            raise ImproperlyConfigured(
+                'The weasyprint engine requires the WeasyPrint package.')
+        return weasyprint
+
+    def available(self):
+        try:
+            self._import()
+        except ImproperlyConfigured:
+            return False
+        return True
+
+    def convert(self, filename, header_filename=None, footer_filename=None,
+                cmd_options=None, cover_filename=None, label=None, result=False):
+        weasyprint = self._import()
+        options = self._page_options(cmd_options or {}, header_filename,
+                                     footer_filename)
+        css = page_css(options)
+        stylesheets = [weasyprint.CSS(string=css)] if css else []
+        filenames = [cover_filename, filename] if cover_filename else [filename]
+
+        with scheduler.slot(), metrics.in_flight(label):
+            start = default_timer()
+            documents = [weasyprint.HTML(filename=name).render(stylesheets=stylesheets)
+                         for name in filenames]
+            pages = [page for document in documents for page in document.pages]
+            content = documents[0].copy(pages).write_pdf()
+            duration = default_timer() - start
+        metrics.observe(metrics.WALL_SECONDS, duration, label)
+        metrics.observe(metrics.PDF_BYTES, len(content), label)
+        if result:
+            return PDFResult(args=[self.name] + filenames, returncode=0,
+                             duration=duration, content=content)
+        return content
+
+
+class ChromiumEngine(BaseEngine):
+    """
+    Prints with a local headless Chromium, the command in
+    WKHTMLTOPDF_CHROMIUM_CMD, for templates that need a current browser
+    engine.
+    """
+    name = CHROMIUM
+
+    def available(self):
+        return shutil.which(self.command()[0]) is not None
+
+    def command(self):
+        return get_command('WKHTMLTOPDF_CHROMIUM_CMD', 'chromium')
+
+    def convert(self, filename, header_filename=None, footer_filename=None,
+                cmd_options=None, cover_filename=None, label=None, result=False):
+        options = self._page_options(cmd_options or {}, header_filename,
+                                     footer_filename)
+        css = page_css(options)
+        filenames = [cover_filename, filename] if cover_filename else [filename]
+        if css:
+            # The command line has no page options; Chromium reads @page.
+            for name in filenames:
+                insert_style(name, css)
+
+        runs = [self._print(name, label) for name in filenames]
+        outputs = [output for args, output, run in runs]
+        content = outputs[0] if len(outputs) == 1 else concatenate_pdfs(outputs)
+        metrics.observe(metrics.PDF_BYTES, len(content), label)
+        if result:
+            args, output, (returncode, _, stderr, events, _, _) = runs[-1]
+            return PDFResult(args=args, returncode=returncode,
+                             duration=sum(run[4] for _, _, run in runs),
+                             content=content, stderr=stderr, events=events,
+                             usage=ResourceUsage.total(run[5] for _, _, run in runs))
+        return content
+
+    def _print(self, filename, label):
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            args = self.command() + [
+                '--headless', '--disable-gpu', '--no-pdf-header-footer',
+                '--print-to-pdf-no-header', '--print-to-pdf=' + path,
+                pathlib.Path(filename).resolve().as_uri()]
+            run = _execute(args, label, kind=CHROMIUM_RUNS)
+            with open(path, 'rb') as f:
+                return args, f.read(), run
+        finally:
+            os.unlink(path)
+
+
+ENGINES = {
+    WKHTMLTOPDF: WkhtmltopdfEngine,
+    WEASYPRINT: WeasyPrintEngine,
+    CHROMIUM: ChromiumEngine,
+}
+
+def get_engine(name=None, template=None):
+    """
+    Returns the engine ``name``, a key of ENGINES or the dotted path of a
+    BaseEngine subclass. Without a name, returns the engine the template
+    named ``template`` has in WKHTMLTOPDF_TEMPLATE_ENGINES, or else the
+    WKHTMLTOPDF_ENGINE, by default wkhtmltopdf.
+    """
+    if name is None and template is not None:
+        name = getattr(settings, 'WKHTMLTOPDF_TEMPLATE_ENGINES', {}).get(template)
+    if name is None:
+        name = getattr(settings, 'WKHTMLTOPDF_ENGINE', WKHTMLTOPDF)
+    engine_class = ENGINES.get(name) or import_string(name)
+    return engine_class()
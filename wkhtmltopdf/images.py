@@ -0,0 +1,162 @@
+import hashlib
+import os
+import re
+import tempfile
+from urllib.parse import unquote, urlparse
+from urllib.request import pathname2url, url2pathname
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULTS = {
+    # Directory of the optimized images. Defaults to a directory in the
+    # system's temporary directory.
+    'cache_dir': None,
+    # Resolution the images are printed at. wkhtmltopdf lays pages out at
+    # 96 CSS pixels per inch.
+    'dpi': 150,
+    # Largest size in pixels of images without width or height attributes.
+    'max_width': 2000,
+    'max_height': 2000,
+    # JPEG quality of the optimized images.
+    'quality': 85,
+}
+
+IMG_RE = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+SRC_RE = re.compile(r'''(\bsrc\s*=\s*)(["'])(file://[^"']+)\2''', re.IGNORECASE)
+SIZE_RE = re.compile(r'''\b(width|height)\s*=\s*["']?(\d+)(?:px)?["'\s/>]''',
+                     re.IGNORECASE)
+
+# Formats that are resized. Animated GIFs and vector images are left alone.
+FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+# The EXIF Orientation tag, and its values for images stored rotated by
+# 90 or 270 degrees, which are displayed with width and height swapped.
+ORIENTATION = 0x0112
+TRANSPOSED = (5, 6, 7, 8)
+
+
+def get_config():
+    config = getattr(settings, 'WKHTMLTOPDF_IMAGE_OPTIMIZATION', None)
+    if not config:
+        return None
+    options = DEFAULTS.copy()
+    if isinstance(config, dict):
+        options.update(config)
+    if options['cache_dir'] is None:
+        options['cache_dir'] = os.path.join(tempfile.gettempdir(),
+                                            'wkhtmltopdf-images')
+    return options
+
+
+def _import_pillow():
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise ImproperlyConfigured(
+            'WKHTMLTOPDF_IMAGE_OPTIMIZATION requires the Pillow package.')
+    return Image, ImageOps
+
+
+def target_size(width, height, displayed, config):
+    """
+    Returns the size to resize a ``width`` x ``height`` image to, given
+    its ``displayed`` (width, height) in CSS pixels, either may be None.
+    """
+    scale = config['dpi'] / 96.0
+    bounds = [config['max_width'], config['max_height']]
+    for i, size in enumerate(displayed):
+        if size:
+            bounds[i] = int(round(size * scale))
+    ratio = min(float(bounds[0]) / width, float(bounds[1]) / height)
+    if ratio >= 1:
+        return None
+    return max(1, int(round(width * ratio))), max(1, int(round(height * ratio)))
+
+
+def optimized_image(path, displayed, config):
+    """
+    Returns the path of a copy of the image ``path`` resized for its
+    ``displayed`` size, or None if the image can be used as it is.
+
+    Copies are cached in the ``cache_dir`` under the path, modification
+    time and size of the source and the target size.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    Image, ImageOps = _import_pillow()
+    try:
+        image = Image.open(path)
+    except (IOError, SyntaxError):
+        return None
+    with image:
+        extension = FORMATS.get(image.format)
+        if extension is None:
+            return None
+        width, height = image.size
+        transposed = image.getexif().get(ORIENTATION) in TRANSPOSED
+        if transposed:
+            width, height = height, width
+        size = target_size(width, height, displayed, config)
+        if size is None:
+            return None
+        key = hashlib.sha1(repr((path, stat.st_mtime_ns, stat.st_size, size,
+                                 config['quality'])).encode('utf-8')).hexdigest()
+        output = os.path.join(config['cache_dir'], key[:2], key + extension)
+        if os.path.exists(output):
+            return output
+
+        if image.format == 'JPEG':
+            # Let the decoder scale down by a power of two, which is much
+            # faster than decoding the full image. The draft size is in
+            # stored pixels, before exif_transpose().
+            image.draft('RGB', size[::-1] if transposed else size)
+        resized = ImageOps.exif_transpose(image)
+        resized.thumbnail(size, Image.LANCZOS)
+        options = {'optimize': True}
+        if image.format in ('JPEG', 'WEBP'):
+            options['quality'] = config['quality']
+
+        directory = os.path.dirname(output)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix=extension, dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                resized.save(f, format=image.format, **options)
+            os.replace(temp_path, output)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return output
+
+
+def optimize_images(content):
+    """
+    Points the local images of ``content`` at copies resized to the size
+    they are displayed at, per WKHTMLTOPDF_IMAGE_OPTIMIZATION.
+
+    Runs after make_absolute_paths(), so only ``file://`` URLs are handled.
+    """
+    config = get_config()
+    if config is None or 'file://' not in content:
+        return content
+
+    def replace_tag(match):
+        tag = match.group(0)
+        src = SRC_RE.search(tag)
+        if src is None:
+            return tag
+        sizes = dict((name.lower(), int(value))
+                     for name, value in SIZE_RE.findall(tag))
+        path = url2pathname(unquote(urlparse(src.group(3)).path))
+        output = optimized_image(path, (sizes.get('width'), sizes.get('height')),
+                                 config)
+        if output is None:
+            return tag
+        url = 'file://' + pathname2url(output)
+        return tag[:src.start(3)] + url + tag[src.end(3):]
+
+    return IMG_RE.sub(replace_tag, content)
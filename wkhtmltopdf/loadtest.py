@@ -0,0 +1,295 @@
+"""
+Load test for PDFTemplateView.
+
+Starts a threaded WSGI server with sample PDF views, requests them from
+concurrent clients and reports throughput, latency percentiles, peak RSS
+and the temporary files left behind.
+
+Usage: python -m wkhtmltopdf.loadtest [--clients N] [--requests N]
+       [--rows N] [--delay SECONDS | --cmd wkhtmltopdf]
+
+Without ``--cmd``, wkhtmltopdf is replaced by a stub that sleeps for
+``--delay`` seconds and writes a fixed PDF, which measures the overhead of
+the view itself: template rendering, temporary files and process spawning.
+Run from a project with DJANGO_SETTINGS_MODULE set to test its settings,
+e.g. WKHTMLTOPDF_SCHEDULER or WKHTMLTOPDF_CACHE.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shlex
+import shutil
+from socketserver import ThreadingMixIn
+import sys
+import tempfile
+import threading
+from timeit import default_timer
+from urllib.request import urlopen
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from django.conf import settings
+from django.urls import path
+
+from .views import PDFTemplateView
+
+TEMPLATES = {
+    'loadtest/invoice.html': (
+        '<html><head><title>Invoice {{ number }}</title></head><body>'
+        '<h1>Invoice {{ number }}</h1><table>'
+        '{% for row in rows %}<tr><td>{{ row }}</td><td>Item {{ row }}</td>'
+        '<td>{{ row|floatformat:2 }}</td></tr>\n{% endfor %}'
+        '</table></body></html>'
+    ),
+    'loadtest/footer.html': (
+        '<html><body>Page <span class="page"></span></body></html>'
+    ),
+}
+
+SETTINGS = {
+    'DEBUG': False,
+    'ALLOWED_HOSTS': ['*'],
+    'SECRET_KEY': 'wkhtmltopdf-loadtest',
+    'INSTALLED_APPS': ['wkhtmltopdf'],
+    'MIDDLEWARE': [],
+    'ROOT_URLCONF': 'wkhtmltopdf.loadtest',
+}
+
+STUB = '''import sys, time
+time.sleep(%r)
+data = %r
+if sys.argv[-1] == '-':
+    sys.stdout.buffer.write(data)
+else:
+    with open(sys.argv[-1], 'wb') as f:
+        f.write(data)
+'''
+
+PDF = (b'%PDF-1.4\n1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n'
+       b'2 0 obj\n<< /Type /Pages /Kids [3 0 R] /Count 1 >>\nendobj\n'
+       b'3 0 obj\n<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>\n'
+       b'endobj\ntrailer\n<< /Root 1 0 R >>\n%%EOF\n')
+
+
+class InvoiceView(PDFTemplateView):
+    template_name = 'loadtest/invoice.html'
+    filename = 'invoice.pdf'
+
+    def get_context_data(self, **kwargs):
+        context = super(InvoiceView, self).get_context_data(**kwargs)
+        context['number'] = kwargs.get('number', 1)
+        context['rows'] = range(int(self.request.GET.get('rows', 100)))
+        return context
+
+
+class InvoiceFooterView(InvoiceView):
+    footer_template = 'loadtest/footer.html'
+
+
+urlpatterns = [
+    path('invoice/<int:number>/', InvoiceView.as_view()),
+    path('invoice/<int:number>/footer/', InvoiceFooterView.as_view()),
+]
+
+
+class Server(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def percentile(values, fraction):
+    """Returns the ``fraction`` percentile of the sorted ``values``."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def current_rss():
+    """Returns the resident set size of this process in bytes, if known."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def peak_rss(who):
+    """Returns the peak RSS in bytes of ``who``, e.g. 'RUSAGE_CHILDREN'."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(getattr(resource, who)).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def write_stub(directory, delay):
+    """Writes the wkhtmltopdf stub to ``directory`` and returns its command."""
+    script = os.path.join(directory, 'wkhtmltopdf_stub.py')
+    with open(script, 'w') as f:
+        f.write(STUB % (delay, PDF))
+    return '%s %s' % (shlex.quote(sys.executable), shlex.quote(script))
+
+
+def run(clients=8, requests=200, rows=100, footer=False, cmd=None, delay=0.05):
+    """
+    Runs the load test and returns a dict of results.
+
+    ``cmd`` is the wkhtmltopdf command to use, by default a stub that
+    sleeps for ``delay`` seconds.
+    """
+    from django.test.utils import override_settings
+
+    stub_dir = tempfile.mkdtemp(prefix='wkhtmltopdf-loadtest-')
+    temp_dir = os.path.join(stub_dir, 'tmp')
+    os.mkdir(temp_dir)
+    if cmd is None:
+        cmd = write_stub(stub_dir, delay)
+
+    overrides = dict(
+        ALLOWED_HOSTS=['*'],
+        ROOT_URLCONF='wkhtmltopdf.loadtest',
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {
+                'loaders': [('django.template.loaders.locmem.Loader',
+                             TEMPLATES)],
+            },
+        }],
+        WKHTMLTOPDF_CMD=cmd,
+        WKHTMLTOPDF_DEBUG=False,
+    )
+
+    previous_tempdir = tempfile.tempdir
+    # Rendered templates are written here, so that files that are not
+    # deleted can be counted.
+    tempfile.tempdir = temp_dir
+    server = None
+    try:
+        with override_settings(**overrides):
+            from django.core.wsgi import get_wsgi_application
+            server = make_server('127.0.0.1', 0, get_wsgi_application(),
+                                 server_class=Server, handler_class=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+            url = 'http://127.0.0.1:%d/invoice/%%d/%s?rows=%d' % (
+                server.server_port, 'footer/' if footer else '', rows)
+            results = _drive(url, clients, requests)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        tempfile.tempdir = previous_tempdir
+        leftover = os.listdir(temp_dir)
+        shutil.rmtree(stub_dir, ignore_errors=True)
+
+    results['leftover_files'] = len(leftover)
+    results['peak_rss'] = peak_rss('RUSAGE_SELF')
+    results['peak_child_rss'] = peak_rss('RUSAGE_CHILDREN')
+    return results
+
+
+def _drive(url, clients, requests):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def fetch(number):
+        start = default_timer()
+        try:
+            response = urlopen(url % number)
+            content = response.read()
+            if not content.startswith(b'%PDF'):
+                raise ValueError('Response is not a PDF.')
+        except Exception as e:
+            with lock:
+                errors.append(e)
+            return
+        with lock:
+            latencies.append(default_timer() - start)
+
+    rss_before = current_rss()
+    start = default_timer()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(fetch, range(1, requests + 1)))
+    elapsed = default_timer() - start
+    rss_after = current_rss()
+
+    latencies.sort()
+    return {
+        'clients': clients,
+        'requests': requests,
+        'errors': len(errors),
+        'first_error': repr(errors[0]) if errors else None,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'rss_growth': (rss_after - rss_before
+                       if rss_before is not None and rss_after is not None
+                       else None),
+    }
+
+
+def _format_bytes(value):
+    return 'n/a' if value is None else '%.1f MB' % (value / 1024 / 1024)
+
+
+def _format_ms(value):
+    return 'n/a' if value is None else '%.1f ms' % (value * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', '-c', type=int, default=8,
+                        help='Number of concurrent clients.')
+    parser.add_argument('--requests', '-n', type=int, default=200,
+                        help='Total number of requests.')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='Table rows in each document.')
+    parser.add_argument('--footer', action='store_true',
+                        help='Render a footer, which adds a temporary file.')
+    parser.add_argument('--cmd', default=None,
+                        help='wkhtmltopdf command. Defaults to the stub.')
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='Seconds the stub takes per document.')
+    options = parser.parse_args(argv)
+
+    import django
+    if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        settings.configure(**SETTINGS)
+    django.setup()
+
+    results = run(clients=options.clients, requests=options.requests,
+                  rows=options.rows, footer=options.footer, cmd=options.cmd,
+                  delay=options.delay)
+    print('command:        %s' % (options.cmd or 'stub, %gs' % options.delay))
+    print('clients:        %d' % results['clients'])
+    print('requests:       %d (%d errors)' % (results['requests'],
+                                              results['errors']))
+    if results['first_error']:
+        print('first error:    %s' % results['first_error'])
+    print('throughput:     %.1f PDFs/s' % results['throughput'])
+    print('latency p50:    %s' % _format_ms(results['p50']))
+    print('latency p95:    %s' % _format_ms(results['p95']))
+    print('latency p99:    %s' % _format_ms(results['p99']))
+    print('peak RSS:       %s' % _format_bytes(results['peak_rss']))
+    print('peak child RSS: %s' % _format_bytes(results['peak_child_rss']))
+    print('RSS growth:     %s' % _format_bytes(results['rss_growth']))
+    print('leftover files: %d' % results['leftover_files'])
+    return 1 if results['errors'] or results['leftover_files'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
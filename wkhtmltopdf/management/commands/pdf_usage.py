@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wkhtmltopdf.usage import CHROMIUM, IMAGE, PDF, get_store
+
+SORT_KEYS = {
+    'cpu': 'cpu_time',
+    'rss': 'max_rss_p95',
+    'time': 'duration',
+    'count': 'count',
+}
+
+
+class Command(BaseCommand):
+    help = ('Lists the templates whose wkhtmltopdf runs use the most CPU time '
+            'or memory, from the database of WKHTMLTOPDF_USAGE.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sort', choices=sorted(SORT_KEYS), default='cpu',
+            help='Sort by mean CPU time, 95th percentile peak RSS, mean wall '
+                 'time or number of runs (default: cpu).')
+        parser.add_argument(
+            '--limit', type=int, default=20,
+            help='Number of templates listed (default: 20).')
+        parser.add_argument(
+            '--days', type=float,
+            help='Only count the runs of the last DAYS days.')
+        parser.add_argument(
+            '--kind', choices=(PDF, IMAGE, CHROMIUM), default=PDF,
+            help='List the wkhtmltopdf, wkhtmltoimage or Chromium runs '
+                 '(default: pdf).')
+
+    def handle(self, *args, **options):
+        store = get_store()
+        if store is None:
+            raise CommandError("Set a 'database' in WKHTMLTOPDF_USAGE to keep "
+                               "the resource usage of renders.")
+        since = None
+        if options['days'] is not None:
+            since = time.time() - options['days'] * 86400
+        rows = store.most_expensive(SORT_KEYS[options['sort']],
+                                    options['limit'], since, options['kind'])
+
+        self.stdout.write('%-40s %7s %9s %9s %8s %8s %7s %9s' % (
+            'template', 'runs', 'cpu s', 'cpu p95', 'rss MB', 'rss p95',
+            'cpu %', 'wall s'))
+        for label, summary in rows:
+            self.stdout.write('%-40s %7d %9.3f %9.3f %8.1f %8.1f %7.0f %9.3f' % (
+                label[-40:] or '-', summary['count'], summary['cpu_time'],
+                summary['cpu_time_p95'], summary['max_rss'] / (1024 * 1024),
+                summary['max_rss_p95'] / (1024 * 1024),
+                summary['cpu_utilization'] * 100, summary['duration']))
@@ -0,0 +1,236 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import multiprocessing
+import os
+from timeit import default_timer
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Manager, Model, QuerySet
+from django.utils.module_loading import import_string
+from django.utils.text import slugify
+
+from wkhtmltopdf import scheduler
+from wkhtmltopdf.utils import render_pdf_from_template
+
+CHECKPOINT_FILENAME = '.render_pdfs.checkpoint'
+
+
+def storage_checkpoint(output):
+    """
+    Returns the default checkpoint path of PDFs saved under the ``output``
+    prefix of the default storage: next to them when the storage has local
+    paths, or else in the current directory.
+    """
+    try:
+        path = default_storage.path(os.path.join(output, CHECKPOINT_FILENAME))
+    except NotImplementedError:
+        return os.path.abspath('%s-%s' % (CHECKPOINT_FILENAME, slugify(output)))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
+
+def iterate_source(source):
+    """
+    Returns an iterator over ``source``, a model, manager, queryset or
+    callable returning an iterable.
+
+    Querysets are iterated without caching so that large tables are not
+    loaded into memory at once.
+    """
+    if isinstance(source, type) and issubclass(source, Model):
+        source = source._default_manager
+    if isinstance(source, Manager):
+        source = source.all()
+    elif callable(source):
+        source = source()
+    if isinstance(source, QuerySet):
+        return source.iterator()
+    return iter(source)
+
+
+class Checkpoint(object):
+    """
+    Names of the PDFs already written, one per line, so that an
+    interrupted run can be resumed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = set(line.rstrip('\n') for line in f)
+        self._file = open(path, 'a') if path else None
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def add(self, name):
+        self.done.add(name)
+        if self._file is not None:
+            self._file.write(name + '\n')
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class Command(BaseCommand):
+    help = ('Renders a template to one PDF per object of a queryset, '
+            'or per context returned by a callable.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('template', help='Name of the template.')
+        parser.add_argument(
+            'source',
+            help='Dotted path to a model, manager, queryset, or a callable '
+                 'returning objects or context dictionaries.')
+        parser.add_argument(
+            'output',
+            help='Output directory, or path prefix in the default storage '
+                 'with --storage.')
+        parser.add_argument('--header', help='Name of the header template.')
+        parser.add_argument('--footer', help='Name of the footer template.')
+        parser.add_argument(
+            '--jobs', '-j', type=int, default=multiprocessing.cpu_count(),
+            help='Number of PDFs rendered in parallel (default: one per CPU).')
+        parser.add_argument(
+            '--filename',
+            help='Format string of the file names, e.g. "{object.pk}.pdf" '
+                 '(the default for model instances) or "{index}.pdf". '
+                 'Keys of context dictionaries are available too.')
+        parser.add_argument(
+            '--context-name', default='object',
+            help='Name of each object in the template context.')
+        parser.add_argument(
+            '--storage', action='store_true',
+            help='Save the PDFs with the default file storage.')
+        parser.add_argument(
+            '--checkpoint',
+            help='File listing the PDFs already written, used to resume an '
+                 'interrupted run. Defaults to %s in the output directory, '
+                 'or in the current directory with --storage if the storage '
+                 'has no local paths.' % CHECKPOINT_FILENAME)
+
+    def handle(self, *args, **options):
+        try:
+            source = import_string(options['source'])
+        except ImportError as e:
+            raise CommandError(str(e))
+
+        self.options = options
+        output = options['output']
+        checkpoint = options['checkpoint']
+        if options['storage']:
+            if checkpoint is None:
+                checkpoint = storage_checkpoint(output)
+        else:
+            if not os.path.isdir(output):
+                os.makedirs(output)
+            if checkpoint is None:
+                checkpoint = os.path.join(output, CHECKPOINT_FILENAME)
+        self.checkpoint = Checkpoint(checkpoint)
+
+        self.rendered = self.skipped = self.failed = self.bytes = 0
+        self.start = self.last_report = default_timer()
+        jobs = max(1, options['jobs'])
+        try:
+            with scheduler.render_priority(scheduler.BULK), \
+                    ThreadPoolExecutor(max_workers=jobs) as pool:
+                pending = set()
+                for index, item in enumerate(iterate_source(source)):
+                    try:
+                        name = self.get_filename(item, index)
+                    except Exception as e:
+                        self.failed += 1
+                        self.stderr.write(self.style.ERROR(
+                            'Failed: no file name for object %d: %s' % (index, e)))
+                        continue
+                    if name in self.checkpoint:
+                        self.skipped += 1
+                        continue
+                    pending.add(pool.submit(scheduler.propagate(self.render),
+                                            item, name))
+                    # Bound the number of queued objects.
+                    if len(pending) >= jobs * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        self.collect(done)
+                self.collect(pending)
+        finally:
+            self.checkpoint.close()
+
+        self.report(summary=True)
+        if self.failed:
+            raise CommandError('%d PDFs failed.' % self.failed)
+
+    def get_filename(self, item, index):
+        template = self.options['filename']
+        if template is None:
+            template = '{object.pk}.pdf' if hasattr(item, 'pk') else '{index}.pdf'
+        extra = item if isinstance(item, dict) else {}
+        return template.format(object=item, index=index, **extra)
+
+    def get_context(self, item):
+        if isinstance(item, dict):
+            return item
+        return {self.options['context_name']: item}
+
+    def render(self, item, name):
+        try:
+            pdf = render_pdf_from_template(
+                self.options['template'], self.options['header'],
+                self.options['footer'], context=self.get_context(item))
+        finally:
+            # Worker threads open their own connections.
+            connections.close_all()
+
+        if self.options['storage']:
+            path = os.path.join(self.options['output'], name)
+            # Storages save under a new name rather than overwrite.
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            saved = default_storage.save(path, ContentFile(pdf))
+            if saved != path:
+                self.stderr.write(self.style.WARNING(
+                    'Saved %s as %s.' % (path, saved)))
+        else:
+            path = os.path.join(self.options['output'], name)
+            # Never leave a truncated PDF behind.
+            with open(path + '.tmp', 'wb') as f:
+                f.write(pdf)
+            os.rename(path + '.tmp', path)
+        return name, len(pdf)
+
+    def collect(self, futures):
+        for future in futures:
+            try:
+                name, size = future.result()
+            except Exception as e:
+                self.failed += 1
+                self.stderr.write(self.style.ERROR('Failed: %s' % e))
+            else:
+                self.rendered += 1
+                self.bytes += size
+                self.checkpoint.add(name)
+        if default_timer() - self.last_report >= 1:
+            self.report()
+
+    def report(self, summary=False):
+        self.last_report = default_timer()
+        if self.options['verbosity'] < 1:
+            return
+        elapsed = max(self.last_report - self.start, 1e-6)
+        megabytes = self.bytes / (1024 * 1024)
+        message = '%d PDFs (%.1f MB) in %.1fs: %.2f PDFs/s, %.2f MB/s' % (
+            self.rendered, megabytes, elapsed, self.rendered / elapsed,
+            megabytes / elapsed)
+        if summary:
+            message = 'Rendered %s, %d skipped, %d failed.' % (
+                message, self.skipped, self.failed)
+            self.stdout.write(self.style.SUCCESS(message))
+        else:
+            self.stdout.write(message)
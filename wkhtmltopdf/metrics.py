@@ -0,0 +1,201 @@
+from contextlib import contextmanager
+import re
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .signals import setting_changed
+
+# Metric names, types and label names.
+TEMPLATE_RENDER_SECONDS = 'wkhtmltopdf_template_render_seconds'
+TEMPFILE_WRITE_SECONDS = 'wkhtmltopdf_tempfile_write_seconds'
+WALL_SECONDS = 'wkhtmltopdf_wall_seconds'
+CPU_SECONDS = 'wkhtmltopdf_cpu_seconds'
+MAX_RSS_BYTES = 'wkhtmltopdf_max_rss_bytes'
+PDF_BYTES = 'wkhtmltopdf_pdf_bytes'
+RESPONSE_SECONDS = 'wkhtmltopdf_response_seconds'
+FAILURES = 'wkhtmltopdf_failures_total'
+IN_FLIGHT = 'wkhtmltopdf_in_flight'
+
+_MB = 1024 * 1024
+# Histogram buckets of the metrics not measured in seconds, for which the
+# default buckets of prometheus_client are too small.
+BUCKETS = {
+    PDF_BYTES: (10 * 1024, 100 * 1024, 0.5 * _MB, _MB, 5 * _MB, 10 * _MB,
+                50 * _MB, 100 * _MB),
+    MAX_RSS_BYTES: (32 * _MB, 64 * _MB, 128 * _MB, 256 * _MB, 512 * _MB,
+                    1024 * _MB, 2048 * _MB, 4096 * _MB),
+}
+
+HISTOGRAM = 'histogram'
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+METRICS = {
+    TEMPLATE_RENDER_SECONDS: (HISTOGRAM, ('name',)),
+    TEMPFILE_WRITE_SECONDS: (HISTOGRAM, ('name',)),
+    WALL_SECONDS: (HISTOGRAM, ('name',)),
+    CPU_SECONDS: (HISTOGRAM, ('name',)),
+    MAX_RSS_BYTES: (HISTOGRAM, ('name',)),
+    PDF_BYTES: (HISTOGRAM, ('name',)),
+    RESPONSE_SECONDS: (HISTOGRAM, ('name',)),
+    FAILURES: (COUNTER, ('name', 'exit_code')),
+    IN_FLIGHT: (GAUGE, ('name',)),
+}
+
+
+class BaseBackend(object):
+    """
+    Metrics backend that discards everything.
+
+    Backends receive the metric name, a value and a dict of labels whose
+    keys are given in ``METRICS``.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    def observe(self, name, value, labels):
+        """Records ``value`` in the histogram ``name``."""
+
+    def increment(self, name, labels, value=1):
+        """Increments the counter ``name``."""
+
+    def gauge(self, name, delta, labels):
+        """Adds ``delta`` to the gauge ``name``."""
+
+
+class PrometheusBackend(BaseBackend):
+    """
+    Exports metrics with prometheus_client.
+
+    Options: ``registry`` (default: the global registry) and ``buckets``,
+    a dict of histogram buckets by metric name.
+    """
+
+    def __init__(self, **options):
+        super(PrometheusBackend, self).__init__(**options)
+        import prometheus_client
+
+        registry = options.get('registry', prometheus_client.REGISTRY)
+        buckets = dict(BUCKETS, **options.get('buckets', {}))
+        types = {
+            HISTOGRAM: prometheus_client.Histogram,
+            COUNTER: prometheus_client.Counter,
+            GAUGE: prometheus_client.Gauge,
+        }
+        self.metrics = {}
+        for name, (kind, labelnames) in METRICS.items():
+            kwargs = {'registry': registry}
+            if name in buckets:
+                kwargs['buckets'] = buckets[name]
+            metric_name = name
+            if kind == COUNTER:
+                # prometheus_client appends _total itself.
+                metric_name = name[:-len('_total')]
+            self.metrics[name] = types[kind](metric_name, name.replace('_', ' '),
+                                             labelnames, **kwargs)
+
+    def observe(self, name, value, labels):
+        self.metrics[name].labels(**labels).observe(value)
+
+    def increment(self, name, labels, value=1):
+        self.metrics[name].labels(**labels).inc(value)
+
+    def gauge(self, name, delta, labels):
+        self.metrics[name].labels(**labels).inc(delta)
+
+
+class StatsdBackend(BaseBackend):
+    """
+    Sends metrics with the statsd package. Labels are appended to the
+    metric name, e.g. ``wkhtmltopdf_wall_seconds.invoice_html``.
+
+    Options are passed to ``statsd.StatsClient``.
+    """
+
+    def __init__(self, **options):
+        super(StatsdBackend, self).__init__(**options)
+        import statsd
+        self.client = statsd.StatsClient(**options)
+
+    def _name(self, name, labels):
+        parts = [name]
+        for key in METRICS[name][1]:
+            parts.append(re.sub(r'[^\w-]', '_', str(labels.get(key))))
+        return '.'.join(parts)
+
+    def observe(self, name, value, labels):
+        if name.endswith('_seconds'):
+            self.client.timing(self._name(name, labels), value * 1000)
+        else:
+            self.client.timing(self._name(name, labels), value)
+
+    def increment(self, name, labels, value=1):
+        self.client.incr(self._name(name, labels), value)
+
+    def gauge(self, name, delta, labels):
+        self.client.gauge(self._name(name, labels), delta, delta=True)
+
+
+_backend = []
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns the backend configured by WKHTMLTOPDF_METRICS_BACKEND."""
+    if not _backend:
+        # Backends register their metrics once, e.g. with prometheus_client
+        # which rejects duplicates, so concurrent first renders must not
+        # both create one.
+        with _backend_lock:
+            if not _backend:
+                path = getattr(settings, 'WKHTMLTOPDF_METRICS_BACKEND', None)
+                if path is None:
+                    backend = BaseBackend()
+                else:
+                    options = getattr(settings, 'WKHTMLTOPDF_METRICS_OPTIONS', {})
+                    backend = import_string(path)(**options)
+                _backend.append(backend)
+    return _backend[0]
+
+
+def _reset_backend(**kwargs):
+    if kwargs['setting'] in ('WKHTMLTOPDF_METRICS_BACKEND',
+                             'WKHTMLTOPDF_METRICS_OPTIONS'):
+        del _backend[:]
+
+setting_changed.connect(_reset_backend)
+
+
+def observe(name, value, label):
+    get_backend().observe(name, value, {'name': label or ''})
+
+
+@contextmanager
+def timer(name, label):
+    """Records the duration of the block in the histogram ``name``."""
+    start = default_timer()
+    try:
+        yield
+    finally:
+        observe(name, default_timer() - start, label)
+
+
+@contextmanager
+def in_flight(label):
+    """Tracks the block in the in-flight gauge."""
+    backend = get_backend()
+    labels = {'name': label or ''}
+    backend.gauge(IN_FLIGHT, 1, labels)
+    try:
+        yield
+    finally:
+        backend.gauge(IN_FLIGHT, -1, labels)
+
+
+def failure(label, exit_code):
+    get_backend().increment(FAILURES, {'name': label or '',
+                                       'exit_code': str(exit_code)})
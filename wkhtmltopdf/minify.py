@@ -0,0 +1,144 @@
+import re
+
+# Elements whose content is copied as it is.
+RAW_ELEMENTS = ('pre', 'textarea', 'script', 'style')
+
+_START = re.compile(r'<!--|<(%s)(?=[\s>/])' % '|'.join(RAW_ELEMENTS),
+                    re.IGNORECASE)
+_END_TAGS = dict(
+    (name, re.compile(r'</%s\s*>' % name, re.IGNORECASE))
+    for name in RAW_ELEMENTS)
+# HTML whitespace only: \s would also match non-breaking spaces.
+_NEWLINES = re.compile(r'[ \t\r\f]*\n[ \t\n\r\f]*')
+_SPACES = re.compile(r'[ \t\r\f]{2,}')
+WHITESPACE = ' \t\n\r\f'
+# A tag, whose quoted attribute values may contain '>'.
+_TAG = re.compile(r'''<[a-zA-Z/!?](?:[^>"']|"[^"]*"|'[^']*')*>''')
+_QUOTED = re.compile(r'"[^"]*"|\'[^\']*\'')
+# What may be an attribute value that collapse_whitespace() would change.
+_SPACED_VALUE = re.compile(
+    r'''=\s*(?:"[^"]*(?:\n|[ \t\r\f]{2})|'[^']*(?:\n|[ \t\r\f]{2}))''')
+
+# Longest tag held back at the end of a piece, in text and in raw elements
+# where only the end tag matters.
+MAX_HELD_TAG = 4096
+MAX_HELD_END_TAG = 32
+
+TEXT = 'text'
+COMMENT = 'comment'
+
+
+def collapse_whitespace(text):
+    """Replaces runs of whitespace by a newline if they contain one, or
+    else by a space."""
+    return _SPACES.sub(' ', _NEWLINES.sub('\n', text))
+
+
+def minify_text(text):
+    """Collapses the whitespace of ``text`` outside the quoted attribute
+    values of its tags."""
+    output = []
+    pos = 0
+    # Only the tags around such values are parsed, since they are rare.
+    for spaced in _SPACED_VALUE.finditer(text):
+        start = text.rfind('<', pos, spaced.start())
+        tag = _TAG.match(text, start) if start >= 0 else None
+        if tag is None or tag.end() <= spaced.start():
+            continue
+        for value in _QUOTED.finditer(text, start, tag.end()):
+            output.append(collapse_whitespace(text[pos:value.start()]))
+            output.append(value.group(0))
+            pos = value.end()
+        output.append(collapse_whitespace(text[pos:tag.end()]))
+        pos = tag.end()
+    output.append(collapse_whitespace(text[pos:]))
+    return ''.join(output)
+
+
+class Minifier(object):
+    """
+    Content filter that removes HTML comments and collapses whitespace,
+    leaving the content of ``<pre>``, ``<textarea>``, ``<script>`` and
+    ``<style>`` elements and quoted attribute values intact.
+
+    The document is fed in pieces: comments and elements may span them,
+    and an incomplete tag or trailing whitespace at the end of a piece is
+    held back until the next one. flush() returns what is left at the end.
+    Use one instance per document.
+    """
+
+    def __init__(self):
+        self.state = TEXT
+        self.held = ''
+
+    def __call__(self, piece):
+        text = self.held + piece
+        self.held = ''
+        output = []
+        pos = 0
+        length = len(text)
+        while pos < length:
+            if self.state == COMMENT:
+                end = text.find('-->', pos)
+                if end < 0:
+                    # Keep what could be the start of '-->'.
+                    self.held = text[max(pos, length - 2):]
+                    break
+                pos = end + 3
+                self.state = TEXT
+            elif self.state != TEXT:
+                match = _END_TAGS[self.state].search(text, pos)
+                if match is None:
+                    cut = self._incomplete_tag(text, pos, MAX_HELD_END_TAG)
+                    output.append(text[pos:cut])
+                    self.held = text[cut:]
+                    break
+                output.append(text[pos:match.end()])
+                pos = match.end()
+                self.state = TEXT
+            else:
+                match = _START.search(text, pos)
+                if match is None:
+                    cut = self._incomplete_tag(text, pos, MAX_HELD_TAG)
+                    rest = text[pos:cut]
+                    stripped = rest.rstrip(WHITESPACE)
+                    output.append(minify_text(stripped))
+                    self.held = rest[len(stripped):] + text[cut:]
+                    break
+                output.append(minify_text(text[pos:match.start()]))
+                if match.group(1) is None:
+                    pos = match.end()
+                    self.state = COMMENT
+                    continue
+                end = text.find('>', match.end())
+                if end < 0:
+                    self.held = text[match.start():]
+                    break
+                output.append(text[match.start():end + 1])
+                pos = end + 1
+                self.state = match.group(1).lower()
+        return ''.join(output)
+
+    @staticmethod
+    def _incomplete_tag(text, pos, limit):
+        """Returns the start of a tag of at most ``limit`` characters left
+        open at the end of ``text``, or its length."""
+        start = text.rfind('<', max(pos, len(text) - limit))
+        if start < 0:
+            return len(text)
+        if text.find('>', start) < 0:
+            return start
+        # A '>' in a quoted value doesn't end the tag.
+        if text[start + 1:start + 2].isalpha() and _TAG.match(text, start) is None:
+            return start
+        return len(text)
+
+    def flush(self):
+        """Returns the text held back at the end of the document."""
+        held, self.held = self.held, ''
+        if self.state == COMMENT:
+            # An unterminated comment hides the rest of the document.
+            return ''
+        if self.state == TEXT:
+            return minify_text(held)
+        return held
@@ -0,0 +1,139 @@
+from io import BytesIO
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+def _import_pypdf():
+    try:
+        import pypdf
+    except ImportError:
+        try:
+            import PyPDF2 as pypdf
+        except ImportError:
+            raise ImproperlyConfigured(
+                'Combining PDF documents requires the pypdf package.')
+    return pypdf
+
+
+def _reader(pypdf, pdf):
+    if not hasattr(pdf, 'read'):
+        pdf = BytesIO(pdf)
+    return pypdf.PdfReader(pdf)
+
+
+def _add_object(writer, obj):
+    """Adds ``obj`` to ``writer`` and returns a reference to it."""
+    # pypdf has no public method for this yet: the private one is used
+    # until it does, with the releases it was tested with pinned in
+    # test_requirements.txt.
+    add_object = getattr(writer, 'add_object', None) or writer._add_object
+    return add_object(obj)
+
+
+def concatenate_pdfs(pdfs):
+    """Returns the PDF documents in ``pdfs`` joined into one, as bytes."""
+    pypdf = _import_pypdf()
+    writer = pypdf.PdfWriter()
+    for pdf in pdfs:
+        writer.append(_reader(pypdf, pdf))
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def _form_xobject(pypdf, writer, page):
+    """Returns a reference to a Form XObject of ``page`` added to ``writer``."""
+    generic = pypdf.generic
+    contents = page.get_contents()
+    form = generic.DecodedStreamObject()
+    form.set_data(contents.get_data() if contents is not None else b'')
+    form.update({
+        generic.NameObject('/Type'): generic.NameObject('/XObject'),
+        generic.NameObject('/Subtype'): generic.NameObject('/Form'),
+        generic.NameObject('/BBox'): generic.ArrayObject(
+            generic.FloatObject(value) for value in page.mediabox),
+    })
+    resources = page.get('/Resources')
+    if resources is not None:
+        form[generic.NameObject('/Resources')] = \
+            resources.get_object().clone(writer)
+    return _add_object(writer, form)
+
+
+def stamp_pdf(base, stamp):
+    """
+    Returns the PDF ``base`` with the pages of the PDF ``stamp`` drawn over
+    its pages, as bytes: the first stamp page over the first page and so
+    on, the last stamp page over the remaining pages.
+
+    The stamp pages are added once as form XObjects that every page
+    refers to, and the content of the base pages is not parsed, so
+    stamping is cheap even for long documents.
+    """
+    pypdf = _import_pypdf()
+    stamp_pages = _reader(pypdf, stamp).pages
+    if not len(stamp_pages):
+        raise ValueError('The stamp PDF has no pages.')
+    return _stamp(pypdf, _reader(pypdf, base), stamp_pages)
+
+
+def stamp_pdf_pages(base, stamp):
+    """
+    Returns a list of copies of the PDF ``base``, as bytes, one per page of
+    the PDF ``stamp``, with that page drawn over all of their pages.
+
+    ``base`` and ``stamp`` are read once, so that stamping a batch of
+    recipients, with one stamp page each, costs one conversion.
+    """
+    pypdf = _import_pypdf()
+    base = _reader(pypdf, base)
+    return [_stamp(pypdf, base, [page])
+            for page in _reader(pypdf, stamp).pages]
+
+
+def _stamp(pypdf, base, stamp_pages):
+    """Returns the PdfReader ``base`` with ``stamp_pages`` drawn over its
+    pages, see stamp_pdf()."""
+    generic = pypdf.generic
+    writer = pypdf.PdfWriter()
+    writer.append(base)
+
+    forms, draws = [], []
+    for index, page in enumerate(stamp_pages):
+        forms.append(_form_xobject(pypdf, writer, page))
+        # Restores the graphics state of the page before drawing the stamp.
+        draw = generic.DecodedStreamObject()
+        draw.set_data(b'\nQ q /WkStamp%d Do Q\n' % index)
+        draws.append(_add_object(writer, draw))
+    save = generic.DecodedStreamObject()
+    save.set_data(b'q\n')
+    save = _add_object(writer, save)
+
+    for index, page in enumerate(writer.pages):
+        index = min(index, len(forms) - 1)
+        resources = page.get('/Resources')
+        if resources is None:
+            resources = generic.DictionaryObject()
+        else:
+            # Resources may be shared by pages or inherited.
+            resources = generic.DictionaryObject(resources.get_object())
+        xobjects = resources.get('/XObject')
+        xobjects = generic.DictionaryObject(
+            xobjects.get_object() if xobjects is not None else {})
+        xobjects[generic.NameObject('/WkStamp%d' % index)] = forms[index]
+        resources[generic.NameObject('/XObject')] = xobjects
+        page[generic.NameObject('/Resources')] = resources
+
+        contents = page.get('/Contents')
+        if contents is None:
+            contents = []
+        elif isinstance(contents.get_object(), generic.ArrayObject):
+            contents = list(contents.get_object())
+        else:
+            contents = [contents]
+        page[generic.NameObject('/Contents')] = generic.ArrayObject(
+            [save] + contents + [draws[index]])
+
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
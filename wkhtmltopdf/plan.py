@@ -0,0 +1,261 @@
+from collections import Counter, OrderedDict
+import re
+import threading
+
+from django.conf import settings
+
+from .signals import setting_changed
+
+# src="...", href="..." and CSS url(...) references.
+ASSET_RE = re.compile(
+    br'''(?:\b(?:src|href)\s*=\s*["']([^"']+)["']|url\(\s*["']?([^"')]+))''',
+    re.IGNORECASE)
+
+LOCAL = 'local'
+REMOTE = 'remote'
+INLINE = 'inline'
+
+
+def asset_kind(url):
+    """Returns whether ``url`` is a LOCAL, REMOTE or INLINE asset."""
+    url = url.strip().lower()
+    if url.startswith(b'data:'):
+        return INLINE
+    if url.startswith((b'http:', b'https:', b'//')):
+        return REMOTE
+    return LOCAL
+
+
+class HTMLStats(object):
+    """
+    Binary file-like object counting the bytes and the asset references
+    written to it.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.assets = Counter()
+
+    def write(self, data):
+        self.size += len(data)
+        for match in ASSET_RE.finditer(data):
+            url = match.group(1) or match.group(2)
+            if not url.startswith(b'#'):
+                self.assets[asset_kind(url)] += 1
+
+    def update(self, other):
+        self.size += other.size
+        self.assets.update(other.assets)
+
+
+class StatsWriter(object):
+    """Binary file-like object writing to ``file`` and to ``stats``, an
+    HTMLStats."""
+
+    def __init__(self, file, stats):
+        self.file = file
+        self.stats = stats
+
+    def write(self, data):
+        self.file.write(data)
+        self.stats.write(data)
+
+
+class RenderPlan(object):
+    """
+    What a render would do, worked out without running wkhtmltopdf.
+
+    ``args`` is the command line, with template names in place of the
+    temporary files. ``html_size`` is the size in bytes of the rendered
+    HTML of all templates and ``assets`` counts the images, stylesheets
+    and scripts they reference by kind. ``predicted_seconds`` is the
+    run time predicted by the cost model, or None without one.
+
+    ``engine`` names the conversion engine. Only wkhtmltopdf runs are
+    planned: for other engines, ``args`` and ``predicted_seconds`` are
+    None and ``plannable`` is False.
+    """
+
+    def __init__(self, args, html_size, assets, predicted_seconds=None,
+                 engine='wkhtmltopdf'):
+        self.args = args
+        self.html_size = html_size
+        self.assets = assets
+        self.predicted_seconds = predicted_seconds
+        self.engine = engine
+
+    @property
+    def plannable(self):
+        return self.args is not None
+
+    @property
+    def asset_count(self):
+        return sum(self.assets.values())
+
+    def __repr__(self):
+        return '<RenderPlan: %d bytes, %d assets, %s s>' % (
+            self.html_size, self.asset_count, self.predicted_seconds)
+
+
+class CostModel(object):
+    """
+    Predicts the run time of wkhtmltopdf from the size of the HTML and the
+    number of assets, by least squares over the observed runs:
+
+        seconds = a + b * megabytes + c * assets
+
+    ``coefficients`` fixes (a, b, c), e.g. as fitted offline from metrics.
+    """
+
+    min_observations = 3
+
+    def __init__(self, coefficients=None):
+        self.coefficients = coefficients
+        self._lock = threading.Lock()
+        # Sums of x x^T and x y over the observations, for x = (1, MB, assets).
+        self._xx = [[0.0] * 3 for i in range(3)]
+        self._xy = [0.0] * 3
+        self.observations = 0
+
+    @staticmethod
+    def _features(html_size, assets):
+        return (1.0, html_size / 1e6, float(assets))
+
+    def observe(self, html_size, assets, seconds):
+        x = self._features(html_size, assets)
+        with self._lock:
+            for i in range(3):
+                self._xy[i] += x[i] * seconds
+                for j in range(3):
+                    self._xx[i][j] += x[i] * x[j]
+            self.observations += 1
+
+    def fit(self):
+        """Returns the fitted (a, b, c), or None with too few observations."""
+        if self.coefficients is not None:
+            return tuple(self.coefficients)
+        with self._lock:
+            if self.observations < self.min_observations:
+                return None
+            rows = [self._xx[i][:] + [self._xy[i]] for i in range(3)]
+        # A little ridge regularisation keeps the system solvable when a
+        # feature doesn't vary, e.g. documents without assets.
+        for i in range(3):
+            rows[i][i] += 1e-9
+        return _solve(rows)
+
+    def predict(self, html_size, assets):
+        """Returns the predicted seconds, or None if nothing is known."""
+        coefficients = self.fit()
+        if coefficients is None:
+            return None
+        x = self._features(html_size, assets)
+        return max(0.0, sum(c * v for c, v in zip(coefficients, x)))
+
+
+def _solve(rows):
+    # Gaussian elimination with partial pivoting on an augmented matrix.
+    n = len(rows)
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        if rows[col][col] == 0:
+            return None
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    solution = [0.0] * n
+    for r in reversed(range(n)):
+        solution[r] = (rows[r][n] - sum(
+            rows[r][c] * solution[c] for c in range(r + 1, n))) / rows[r][r]
+    return tuple(solution)
+
+
+_model = []
+
+
+def get_cost_model():
+    """
+    Returns the CostModel configured by WKHTMLTOPDF_COST_MODEL, or None.
+    A fitted model starts with the samples kept in the database of
+    WKHTMLTOPDF_USAGE.
+    """
+    if not _model:
+        config = getattr(settings, 'WKHTMLTOPDF_COST_MODEL', None)
+        model = None
+        if isinstance(config, dict):
+            model = CostModel(**config)
+        elif config:
+            model = CostModel()
+        if model is not None and model.coefficients is None:
+            # Start from the runs of earlier processes.
+            from .usage import get_config, get_store
+            store = get_store()
+            if store is not None:
+                samples = store.samples(get_config()['samples'])
+                for html_size, assets, seconds in samples:
+                    model.observe(html_size, assets, seconds)
+        _model.append(model)
+    return _model[0]
+
+
+def _reset_model(**kwargs):
+    if kwargs['setting'] in ('WKHTMLTOPDF_COST_MODEL', 'WKHTMLTOPDF_USAGE'):
+        del _model[:]
+    if kwargs['setting'] == 'WKHTMLTOPDF_COST_MODEL':
+        with _file_stats_lock:
+            _file_stats.clear()
+
+setting_changed.connect(_reset_model)
+
+
+def fitting():
+    """Returns True if the cost model learns from the runs."""
+    model = get_cost_model()
+    return model is not None and model.coefficients is None
+
+
+# HTMLStats of the rendered files not converted yet, by path. Files that
+# are never converted, e.g. served from the cache, are forgotten first.
+_file_stats = OrderedDict()
+_file_stats_lock = threading.Lock()
+MAX_FILE_STATS = 1024
+
+
+def remember(path, stats):
+    """Keeps the HTMLStats of the file ``path``, counted as it was
+    written, for record()."""
+    with _file_stats_lock:
+        _file_stats[path] = stats
+        while len(_file_stats) > MAX_FILE_STATS:
+            _file_stats.popitem(last=False)
+
+
+def record(paths, seconds):
+    """
+    Adds a wkhtmltopdf run over the HTML files ``paths`` to the cost model,
+    unless it has fixed coefficients, and to the database of
+    WKHTMLTOPDF_USAGE if it has one.
+
+    Only the files whose HTMLStats were kept by remember() while they were
+    rendered are counted; runs over none of them are not recorded.
+    """
+    if not fitting():
+        return
+    stats = HTMLStats()
+    found = False
+    with _file_stats_lock:
+        for path in paths:
+            file_stats = _file_stats.pop(path, None)
+            if file_stats is not None:
+                stats.update(file_stats)
+                found = True
+    if not found:
+        return
+    assets = sum(stats.assets.values())
+    get_cost_model().observe(stats.size, assets, seconds)
+    from .usage import get_store
+    store = get_store()
+    if store is not None:
+        store.record_sample(stats.size, assets, seconds)
@@ -0,0 +1,245 @@
+from collections import Counter
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer
+
+from django.conf import settings
+
+from .diagnostics import logger
+
+CPROFILE = 'cprofile'
+SAMPLER = 'sampler'
+
+DEFAULTS = {
+    # Directory the profiles are written to. Defaults to a directory in the
+    # system's temporary directory.
+    'directory': None,
+    # Fraction of renders that are always profiled.
+    'sample_rate': 0,
+    # Renders slower than this many seconds are profiled. Every render is
+    # profiled while it runs, so use the sampler, whose overhead is low.
+    'threshold': 5,
+    # SAMPLER or CPROFILE.
+    'profiler': SAMPLER,
+    # Seconds between two samples of the sampler.
+    'interval': 0.005,
+}
+
+_local = threading.local()
+_counter = itertools.count(1)
+
+
+def get_config():
+    """Returns the WKHTMLTOPDF_PROFILE options, or None if disabled."""
+    config = getattr(settings, 'WKHTMLTOPDF_PROFILE', None)
+    if not config:
+        return None
+    options = DEFAULTS.copy()
+    if isinstance(config, dict):
+        options.update(config)
+    if options['directory'] is None:
+        options['directory'] = os.path.join(tempfile.gettempdir(),
+                                            'wkhtmltopdf-profiles')
+    return options
+
+
+def current_profile():
+    """Returns the Profile of the render running in this thread, if any."""
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def activate(profile):
+    """Records the wkhtmltopdf runs of the block in ``profile``."""
+    previous = current_profile()
+    _local.profile = profile
+    try:
+        yield
+    finally:
+        _local.profile = previous
+
+
+def record(args, seconds, returncode):
+    """Records a wkhtmltopdf run in the current profile, if any."""
+    profile = current_profile()
+    if profile is not None:
+        profile.record(args, seconds, returncode)
+
+
+class Sampler(object):
+    """
+    Statistical profiler that records the stack of a thread every
+    ``interval`` seconds, from a background thread.
+
+    Stacks are written in the collapsed format read by flamegraph.pl and
+    speedscope: one line per stack, frames separated by semicolons,
+    followed by the number of samples.
+    """
+    extension = '.folded'
+
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='wkhtmltopdf-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            del frame
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+class CProfiler(object):
+    """Deterministic profiler, written in the pstats format."""
+    extension = '.prof'
+
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+class Profile(object):
+    """A profiled render and the wkhtmltopdf runs it started."""
+
+    def __init__(self, label, config, sampled):
+        self.label = label or ''
+        self.config = config
+        self.sampled = sampled
+        self.runs = []
+        self.seconds = None
+        self._lock = threading.Lock()
+        if config['profiler'] == CPROFILE:
+            self.profiler = CProfiler()
+        else:
+            self.profiler = Sampler(config['interval'])
+
+    def start(self):
+        self.started = time.time()
+        self._start = default_timer()
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+        self.seconds = default_timer() - self._start
+
+    def record(self, args, seconds, returncode):
+        with self._lock:
+            self.runs.append({'args': list(args), 'seconds': seconds,
+                              'returncode': returncode})
+
+    @property
+    def slow(self):
+        threshold = self.config['threshold']
+        return threshold is not None and self.seconds >= threshold
+
+    def save(self):
+        """
+        Writes the profile and a JSON file of the render's duration and
+        wkhtmltopdf runs to the profile directory, and returns the path of
+        the JSON file.
+        """
+        directory = self.config['directory']
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        name = '%s-%s-%d-%d' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)),
+            re.sub(r'[^\w.-]+', '_', self.label).strip('_') or 'render',
+            os.getpid(), next(_counter))
+        profile_path = os.path.join(directory, name + self.profiler.extension)
+        self.profiler.dump(profile_path)
+
+        metadata = {
+            'label': self.label,
+            'started': self.started,
+            'seconds': self.seconds,
+            'reason': 'sampled' if self.sampled else 'threshold',
+            'profiler': self.config['profiler'],
+            'profile': os.path.basename(profile_path),
+            'wkhtmltopdf_seconds': sum(run['seconds'] for run in self.runs),
+            'wkhtmltopdf': self.runs,
+        }
+        path = os.path.join(directory, name + '.json')
+        with open(path, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        return path
+
+
+@contextmanager
+def profile(label):
+    """
+    Profiles the render in the block per WKHTMLTOPDF_PROFILE, and writes
+    the profile if the render was sampled or slow.
+
+    Nested blocks are part of the outermost render.
+    """
+    config = get_config()
+    if config is None or current_profile() is not None:
+        yield
+        return
+    sampled = random.random() < config['sample_rate']
+    if not sampled and config['threshold'] is None:
+        yield
+        return
+
+    run = Profile(label, config, sampled)
+    try:
+        run.start()
+    except ValueError:
+        # Another profiler is active in this process, e.g. in a concurrent
+        # render on Python 3.12 and later.
+        logger.debug('Not profiling %s: a profiler is already active.', label)
+        run = None
+    if run is None:
+        yield
+        return
+    try:
+        with activate(run):
+            yield
+    finally:
+        run.stop()
+        if sampled or run.slow:
+            path = run.save()
+            logger.info('Profiled %s render of %.2fs, %.2fs in wkhtmltopdf: %s',
+                        label, run.seconds,
+                        sum(r['seconds'] for r in run.runs), path)
@@ -0,0 +1,124 @@
+import mmap
+import os
+import re
+
+# The /Count of a node of the page tree, before or after its /Type.
+PAGES_PATTERN = re.compile(
+    br'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b')
+OBJECT_STREAM_PATTERN = re.compile(br'/Type\s*/ObjStm\b')
+
+
+def count_pages(data):
+    """
+    Returns the number of pages of a PDF.
+
+    ``data`` may be any bytes-like object, including an mmap.
+    The page count of uncompressed documents, like those produced by
+    wkhtmltopdf, is the /Count of the root of the page tree, the largest
+    one, read without parsing the document. Documents with compressed
+    object streams, like those of Chromium, are parsed with pypdf.
+    """
+    if OBJECT_STREAM_PATTERN.search(data) is None:
+        counts = [int(match.group(1) or match.group(2))
+                  for match in PAGES_PATTERN.finditer(data)]
+        if counts:
+            return max(counts)
+    from .pdf import _import_pypdf, _reader
+    return len(_reader(_import_pypdf(), bytes(data)).pages)
+
+
+class PDFResult(object):
+    """
+    The output of a wkhtmltopdf run along with its metadata.
+
+    The PDF is available without copying as ``buffer``, a memoryview over
+    the captured output or, when wkhtmltopdf wrote to ``path``, over a
+    read-only mmap of that file.
+
+    ``usage`` is the ResourceUsage of the wkhtmltopdf processes, or None
+    if unknown, e.g. for a PDF served from the cache.
+    """
+
+    def __init__(self, args, returncode, duration, content=None, path=None,
+                 stderr=b'', events=(), usage=None):
+        self.args = args
+        self.returncode = returncode
+        self.duration = duration
+        self.path = path
+        self.stderr = stderr
+        self.events = list(events)
+        self.usage = usage
+        self._content = content
+        self._file = None
+        self._mmap = None
+        self._page_count = None
+
+    def __repr__(self):
+        return '<%s size=%d duration=%.3f>' % (self.__class__.__name__,
+                                               self.size, self.duration)
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return self.content
+
+    @property
+    def raw(self):
+        """The underlying bytes object or mmap, without copying."""
+        if self._content is not None:
+            return self._content
+        if self._mmap is None:
+            self._file = open(self.path, 'rb')
+            # The size of the open file, which may be unlinked meanwhile.
+            if not os.fstat(self._file.fileno()).st_size:
+                self._file.close()
+                self._file = None
+                self._content = b''
+                return self._content
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @property
+    def buffer(self):
+        return memoryview(self.raw)
+
+    @property
+    def mmap(self):
+        """The mmap of the output file, or None for in-memory output."""
+        if self.path is None:
+            return None
+        raw = self.raw
+        return raw if isinstance(raw, mmap.mmap) else None
+
+    @property
+    def content(self):
+        """The PDF as bytes. Copies the data when it is file-backed."""
+        raw = self.raw
+        if isinstance(raw, bytes):
+            return raw
+        return raw[:]
+
+    @property
+    def size(self):
+        if self._content is not None:
+            return len(self._content)
+        if self._mmap is not None:
+            return len(self._mmap)
+        return os.path.getsize(self.path)
+
+    @property
+    def page_count(self):
+        if self._page_count is None:
+            self._page_count = count_pages(self.raw)
+        return self._page_count
+
+    def close(self):
+        """Release the mmap and file handle of a file-backed result."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,67 @@
+import random
+import re
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+DEFAULTS = {
+    # Total number of runs of the command, including the first.
+    'attempts': 3,
+    # Seconds to wait before the second run, doubled for each further run.
+    'backoff': 0.5,
+    'max_backoff': 8,
+    # Exit codes of transient failures. Negative codes mean the process was
+    # killed by that signal, e.g. -9 by the OOM killer, and are always
+    # transient.
+    'returncodes': [],
+    # Regular expressions matched against stderr.
+    'patterns': [
+        r'cannot connect to X server',
+        r'QXcbConnection: Could not connect to display',
+        r'std::bad_alloc',
+        r'[Oo]ut of memory',
+        r'Segmentation fault',
+        r'Resource temporarily unavailable',
+    ],
+}
+
+
+def get_config():
+    """Returns the WKHTMLTOPDF_RETRY options, or the defaults with a single
+    attempt if retrying is disabled."""
+    config = getattr(settings, 'WKHTMLTOPDF_RETRY', None)
+    options = DEFAULTS.copy()
+    if not config:
+        options['attempts'] = 1
+    elif isinstance(config, dict):
+        options.update(config)
+    return options
+
+
+def is_transient(error, config):
+    """Returns True if the CalledProcessError ``error`` is worth retrying."""
+    if error.returncode < 0 or error.returncode in config['returncodes']:
+        return True
+    stderr = smart_str(getattr(error, 'stderr', None) or '')
+    return any(re.search(pattern, stderr) for pattern in config['patterns'])
+
+
+def backoff(attempt, config):
+    """Returns the seconds to wait after failed run number ``attempt``."""
+    delay = min(config['backoff'] * 2 ** (attempt - 1), config['max_backoff'])
+    # Jitter spreads out retries of renders that failed together.
+    return delay * random.uniform(0.5, 1)
+
+
+def get_fallback(options):
+    """
+    Returns the fallback command setting and options for a failed run with
+    ``options``, or None if there is no fallback.
+    """
+    cmd = getattr(settings, 'WKHTMLTOPDF_FALLBACK_CMD', None)
+    fallback_options = getattr(settings, 'WKHTMLTOPDF_FALLBACK_CMD_OPTIONS', None)
+    if cmd is None and fallback_options is None:
+        return None
+    options = dict(options)
+    options.update(fallback_options or {})
+    return cmd, options
@@ -0,0 +1,291 @@
+from collections import Counter, deque
+from contextlib import contextmanager
+import functools
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import profiling
+from .signals import setting_changed
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+DEFAULTS = {
+    # Maximum number of wkhtmltopdf processes running at once.
+    'slots': 4,
+    # Priority classes, highest first.
+    'priorities': [INTERACTIVE, BULK],
+    # Maximum number of processes per class. Defaults to 'slots'.
+    'quotas': {},
+    # Class of renders started outside of render_priority().
+    'default': BULK,
+    # Directory of lock files shared by the processes whose renders are
+    # scheduled together, or None to schedule this process alone.
+    'directory': None,
+    # Seconds between attempts to take a slot held by another process.
+    'poll_interval': 0.05,
+}
+
+_local = threading.local()
+
+
+@contextmanager
+def render_priority(priority):
+    """Runs the renders started in the block with ``priority``."""
+    previous = getattr(_local, 'priority', None)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    """Returns the priority set by render_priority() in this thread."""
+    return getattr(_local, 'priority', None)
+
+
+def propagate(func):
+    """
+    Wraps ``func`` so that it runs with the current thread's priority and
+    profile, for use with thread pools.
+    """
+    priority = current_priority()
+    profile = profiling.current_profile()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with render_priority(priority), profiling.activate(profile):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class Scheduler(object):
+    """
+    Limits the number of concurrent wkhtmltopdf processes.
+
+    Waiting renders are started in priority order, first come first served
+    within a class, as long as the total number of slots and the quota of
+    their class allow it. A queued interactive render therefore starts
+    before any bulk render queued earlier. Give the higher classes a quota
+    below ``slots`` to guarantee the lower classes some progress.
+    """
+
+    def __init__(self, slots, priorities, quotas=None, default=None):
+        self.slots = slots
+        self.priorities = list(priorities)
+        self.quotas = dict((p, slots) for p in self.priorities)
+        self.quotas.update(quotas or {})
+        self.default = default or self.priorities[-1]
+        self._condition = threading.Condition()
+        self._queues = dict((p, deque()) for p in self.priorities)
+        self._running = Counter()
+
+    @property
+    def running(self):
+        with self._condition:
+            return sum(self._running.values())
+
+    def queued(self, priority):
+        with self._condition:
+            return len(self._queues[priority])
+
+    def _runnable(self, priority):
+        return (self._queues[priority] and
+                self._running[priority] < self.quotas[priority])
+
+    def _can_start(self, priority, ticket):
+        if sum(self._running.values()) >= self.slots:
+            return False
+        if self._queues[priority][0] is not ticket:
+            return False
+        if self._running[priority] >= self.quotas[priority]:
+            return False
+        for higher in self.priorities[:self.priorities.index(priority)]:
+            if self._runnable(higher):
+                return False
+        return True
+
+    @contextmanager
+    def slot(self, priority=None):
+        """Waits for a free slot for ``priority`` and holds it."""
+        priority = priority or current_priority() or self.default
+        if priority not in self._queues:
+            raise ValueError('Unknown render priority %r.' % priority)
+
+        ticket = object()
+        with self._condition:
+            self._queues[priority].append(ticket)
+            try:
+                while not self._can_start(priority, ticket):
+                    self._condition.wait()
+            finally:
+                self._queues[priority].remove(ticket)
+            self._running[priority] += 1
+            # Let the next render of this class check its turn.
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running[priority] -= 1
+                self._condition.notify_all()
+
+
+class SharedScheduler(Scheduler):
+    """
+    Limits the number of concurrent wkhtmltopdf processes of all the
+    processes sharing the lock files in ``directory``, e.g. the web workers,
+    management commands and task workers of a host.
+
+    A render holds an fcntl lock on one of the ``quotas[priority]`` lock
+    files of its class and one of the ``slots`` lock files. While a render
+    waits for a slot, it holds a shared lock on the waiting file of its
+    class, and renders of lower classes leave free slots to it. The
+    system releases the locks of a process when it exits, even if it
+    crashed.
+
+    Waiting renders poll for a free slot every ``poll_interval`` seconds,
+    so renders of the same class don't start in order.
+    """
+
+    def __init__(self, slots, priorities, quotas=None, default=None,
+                 directory=None, poll_interval=DEFAULTS['poll_interval']):
+        super(SharedScheduler, self).__init__(slots, priorities, quotas, default)
+        try:
+            import fcntl
+        except ImportError:
+            raise ImproperlyConfigured(
+                'Sharing the scheduler between processes requires fcntl.')
+        self._fcntl = fcntl
+        self.directory = directory
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self, name):
+        return os.open(os.path.join(self.directory, name),
+                       os.O_RDWR | os.O_CREAT, 0o666)
+
+    def _try_lock(self, name, mode=None):
+        """Returns the descriptor of the lock file ``name`` locked with
+        ``mode``, or None if it is locked elsewhere."""
+        fcntl = self._fcntl
+        fd = self._open(name)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if mode is None else mode) |
+                        fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _try_lock_any(self, prefix, count):
+        for index in range(count):
+            fd = self._try_lock('%s-%d.lock' % (prefix, index))
+            if fd is not None:
+                return fd
+        return None
+
+    def _waiting(self, priority):
+        """Returns True if a render of ``priority`` waits for a slot."""
+        fd = self._try_lock('%s.waiting' % priority)
+        if fd is None:
+            return True
+        os.close(fd)
+        return False
+
+    def _wait(self, acquire):
+        while True:
+            fd = acquire()
+            if fd is not None:
+                return fd
+            time.sleep(self.poll_interval)
+
+    @contextmanager
+    def slot(self, priority=None):
+        """Waits for a free slot for ``priority`` and holds it."""
+        priority = priority or current_priority() or self.default
+        if priority not in self._queues:
+            raise ValueError('Unknown render priority %r.' % priority)
+        higher = self.priorities[:self.priorities.index(priority)]
+
+        def acquire_slot():
+            if any(self._waiting(p) for p in higher):
+                return None
+            return self._try_lock_any('slot', self.slots)
+
+        ticket = object()
+        with self._condition:
+            self._queues[priority].append(ticket)
+        try:
+            quota = self._wait(lambda: self._try_lock_any(
+                priority, self.quotas[priority]))
+            try:
+                waiting = self._open('%s.waiting' % priority)
+                try:
+                    self._fcntl.flock(waiting, self._fcntl.LOCK_SH)
+                    slot = self._wait(acquire_slot)
+                finally:
+                    os.close(waiting)
+            except BaseException:
+                os.close(quota)
+                raise
+        finally:
+            with self._condition:
+                self._queues[priority].remove(ticket)
+        with self._condition:
+            self._running[priority] += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running[priority] -= 1
+            os.close(slot)
+            os.close(quota)
+
+
+_scheduler = []
+
+
+def get_scheduler():
+    """
+    Returns the Scheduler configured by WKHTMLTOPDF_SCHEDULER, a
+    SharedScheduler if it has a ``directory``, or None if renders are not
+    scheduled.
+    """
+    if not _scheduler:
+        config = getattr(settings, 'WKHTMLTOPDF_SCHEDULER', None)
+        scheduler = None
+        if config:
+            options = DEFAULTS.copy()
+            if isinstance(config, dict):
+                options.update(config)
+            if options['directory']:
+                scheduler = SharedScheduler(**options)
+            else:
+                del options['directory'], options['poll_interval']
+                scheduler = Scheduler(**options)
+        _scheduler.append(scheduler)
+    return _scheduler[0]
+
+
+def _reset_scheduler(**kwargs):
+    if kwargs['setting'] == 'WKHTMLTOPDF_SCHEDULER':
+        del _scheduler[:]
+
+setting_changed.connect(_reset_scheduler)
+
+
+@contextmanager
+def slot(priority=None):
+    """Holds a render slot, if WKHTMLTOPDF_SCHEDULER is set."""
+    scheduler = get_scheduler()
+    if scheduler is None:
+        yield
+    else:
+        with scheduler.slot(priority):
+            yield
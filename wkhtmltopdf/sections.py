@@ -0,0 +1,209 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template import TemplateDoesNotExist
+
+from . import scheduler
+from .cache import get_pdf_cache
+from .coalesce import render_key
+from .diagnostics import logger
+from .pdf import concatenate_pdfs
+from .result import PDFResult
+from .usage import ResourceUsage
+from .utils import (RenderedFile, _get_engine, _key_options, _render_optional,
+                    resolve_template, template_name)
+
+
+class Section(object):
+    """
+    A part of a document: a template rendered with the context ``keys`` it
+    depends on, plus its own ``context``.
+
+    Only the listed keys are passed to the template, so that a section is
+    rendered again exactly when one of them changes. Their values must be
+    serializable by DjangoJSONEncoder: pass the data the section shows
+    rather than model instances. ``keys=None`` passes the whole context.
+    """
+
+    def __init__(self, template, keys=None, context=None, cmd_options=None):
+        self.template = template
+        self.keys = keys
+        self.context = context or {}
+        self.cmd_options = cmd_options or {}
+
+    def get_context(self, context):
+        if self.keys is None:
+            section_context = dict(context)
+        else:
+            section_context = dict((key, context[key]) for key in self.keys)
+        section_context.update(self.context)
+        return section_context
+
+
+def _source_version(engine_template):
+    origin = getattr(engine_template, 'origin', None)
+    path = getattr(origin, 'name', None) or getattr(engine_template, 'filename', None)
+    try:
+        mtime = os.path.getmtime(path)
+    except (TypeError, OSError):
+        mtime = None
+    return [path, mtime, getattr(engine_template, 'source', None)]
+
+
+def _dependencies(engine_template, seen):
+    """
+    Yields the Django templates that ``engine_template`` extends or
+    includes, recursively. Templates named by a variable are only known
+    when rendering, and are left out.
+    """
+    from django.template.loader_tags import ExtendsNode, IncludeNode
+    nodelist = getattr(engine_template, 'nodelist', None)
+    engine = getattr(engine_template, 'engine', None)
+    if nodelist is None or engine is None:
+        return
+    for node in nodelist.get_nodes_by_type((ExtendsNode, IncludeNode)):
+        if isinstance(node, ExtendsNode):
+            name = node.parent_name.var
+        else:
+            name = node.template.var
+        if not isinstance(name, str) or name in seen:
+            continue
+        seen.add(name)
+        try:
+            dependency = engine.get_template(name)
+        except TemplateDoesNotExist:
+            continue
+        yield dependency
+        for template in _dependencies(dependency, seen):
+            yield template
+
+
+def _template_version(template):
+    """
+    Returns what identifies the source of ``template``, the templates it
+    extends or includes and WKHTMLTOPDF_TEMPLATE_VERSION.
+    """
+    engine_template = getattr(template, 'template', template)
+    version = [template_name(template), _source_version(engine_template)]
+    for dependency in _dependencies(engine_template, set()):
+        version.append(_source_version(dependency))
+    version.append(getattr(settings, 'WKHTMLTOPDF_TEMPLATE_VERSION', None))
+    return version
+
+
+def section_key(template, context, cmd_options, extra):
+    """
+    Returns the cache key of a section from its template, context and
+    options, and ``extra`` identifying the header and footer.
+    """
+    data = json.dumps([_template_version(template), context, cmd_options, extra],
+                      cls=DjangoJSONEncoder, sort_keys=True)
+    return 'section:' + hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def render_sectioned_pdf(sections, context, header_template=None, footer_template=None,
+                         cmd_options=None, cache=None, using=None, result=False,
+                         engine=None):
+    """
+    Renders a document made of ``sections``, reusing the PDF of every
+    section whose template, context keys and options haven't changed.
+
+    Each section is converted by its own wkhtmltopdf process, or by
+    ``engine`` or the one configured for its template, and kept in
+    ``cache``, a PDFCache or by default the one configured by
+    WKHTMLTOPDF_CACHE; without a cache every section is rendered. The
+    fragments are then concatenated.
+
+    With a header or footer, sections after the first are converted with
+    ``--page-offset`` so that ``[page]`` numbers run across the document.
+    A section is converted again if the sections before it changed length.
+
+    The request isn't used, so that sections don't depend on who asked
+    for the document.
+    """
+    cmd_options = cmd_options if cmd_options else {}
+    if cache is None:
+        cache = get_pdf_cache()
+    header_template, footer_template = [
+        resolve_template(template, using)
+        for template in (header_template, footer_template)]
+    header_file, footer_file = [
+        _render_optional(template, context)
+        for template in (header_template, footer_template)]
+    header_filename = header_file.filename if header_file else None
+    footer_filename = footer_file.filename if footer_file else None
+    numbered = bool(header_filename or footer_filename)
+    # Sections are rendered again when the header or footer changes.
+    extra = render_key([header_filename, footer_filename], {})
+    base_offset = int(cmd_options.get('page_offset') or 0)
+
+    templates, contexts, options, engines, keys = [], [], [], [], []
+    for section in sections:
+        template = resolve_template(section.template, using)
+        section_context = section.get_context(context)
+        section_options = dict(cmd_options, **section.cmd_options)
+        section_engine = _get_engine(engine, template)
+        templates.append(template)
+        contexts.append(section_context)
+        options.append(section_options)
+        engines.append(section_engine)
+        keys.append(section_key(template, section_context,
+                                _key_options(section_engine, section_options), extra))
+
+    converted = []
+
+    @scheduler.propagate
+    def convert(index, page_offset=None):
+        key = keys[index]
+        section_options = options[index].copy()
+        if page_offset is not None and page_offset != base_offset:
+            key += ':%d' % page_offset
+            section_options['page_offset'] = page_offset
+        fragment = cache.get(key) if cache else None
+        if fragment is None:
+            input_file = RenderedFile(template=templates[index],
+                                      context=contexts[index])
+            fragment = engines[index].convert(filename=input_file.filename,
+                                              header_filename=header_filename,
+                                              footer_filename=footer_filename,
+                                              cmd_options=section_options,
+                                              label=template_name(templates[index]),
+                                              result=True)
+            if not isinstance(fragment, PDFResult):
+                fragment = PDFResult(args=None, returncode=0, duration=0,
+                                     content=fragment)
+            converted.append(fragment)
+            if cache:
+                cache.set(key, fragment)
+        return fragment
+
+    indexes = range(len(sections))
+    with ThreadPoolExecutor(max_workers=max(1, len(sections))) as pool:
+        fragments = list(pool.map(convert, indexes))
+        if numbered:
+            offsets, offset = [], base_offset
+            for fragment in fragments:
+                offsets.append(offset)
+                offset += fragment.page_count
+            moved = [i for i in indexes if offsets[i] != base_offset]
+            for i, fragment in zip(moved, pool.map(
+                    convert, moved, [offsets[i] for i in moved])):
+                fragments[i].close()
+                fragments[i] = fragment
+
+    logger.debug('Converted %d of %d sections.', len(converted), len(sections))
+    content = concatenate_pdfs([fragment.raw for fragment in fragments])
+    for fragment in fragments:
+        fragment.close()
+    if result:
+        return PDFResult(args=[fragment.args for fragment in converted],
+                         returncode=0,
+                         duration=sum(fragment.duration for fragment in converted),
+                         content=content,
+                         usage=ResourceUsage.total(fragment.usage
+                                                   for fragment in converted))
+    return content
@@ -0,0 +1,7 @@
+from django.core.signals import setting_changed
+from django.dispatch import Signal
+
+
+# Sent after every wkhtmltopdf run with the structured stderr events.
+# Arguments: ``args``, ``events``, ``returncode`` and ``label``.
+render_diagnostics = Signal()
@@ -0,0 +1,192 @@
+from django.core.exceptions import ImproperlyConfigured
+
+from .cache import get_pdf_cache
+from .coalesce import render_key
+from .engines import WKHTMLTOPDF
+from .pdf import stamp_pdf, stamp_pdf_pages
+from .result import PDFResult
+from .sections import section_key
+from .utils import (RenderedFile, _get_engine, _render_optional, convert_to_pdf,
+                    resolve_template, template_name, wkhtmltopdf)
+
+# Options of the document that the stamp shares, so that its pages line up.
+PAGE_OPTIONS = ('page_size', 'page_width', 'page_height', 'orientation',
+                'dpi', 'zoom')
+
+# Stamps cover the whole page and only draw what their template shows.
+STAMP_OPTIONS = {
+    'margin_top': '0',
+    'margin_bottom': '0',
+    'margin_left': '0',
+    'margin_right': '0',
+    'no_background': True,
+}
+
+# Stamps converted by one wkhtmltopdf run in render_stamped_pdfs().
+STAMP_BATCH_SIZE = 100
+
+
+def _check_engine(template):
+    # Stamps use wkhtmltopdf options and runs converting several inputs.
+    engine = _get_engine(None, template)
+    if engine.name != WKHTMLTOPDF:
+        raise ImproperlyConfigured(
+            'Stamped documents are converted by wkhtmltopdf, not by the %s '
+            'engine configured for %s.' % (engine.name, template_name(template)))
+
+
+def stamp_options(cmd_options=None, stamp_cmd_options=None):
+    """Returns the options of a stamp for a document converted with
+    ``cmd_options``."""
+    options = dict((key, value) for key, value in (cmd_options or {}).items()
+                   if key in PAGE_OPTIONS)
+    options.update(STAMP_OPTIONS)
+    options.update(stamp_cmd_options or {})
+    return options
+
+
+def render_base_pdf(template, context, header_template=None, footer_template=None,
+                    cmd_options=None, cache=None, using=None):
+    """
+    Returns a PDFResult of the document shared by all recipients, from
+    ``cache``, a PDFCache or by default the one configured by
+    WKHTMLTOPDF_CACHE, if its template, context and options are unchanged.
+
+    With a cache, the context must be serializable by DjangoJSONEncoder,
+    like the context of sections. Close the result when done with it.
+    """
+    cmd_options = cmd_options if cmd_options else {}
+    if cache is None:
+        cache = get_pdf_cache()
+    template, header_template, footer_template = [
+        resolve_template(t, using)
+        for t in (template, header_template, footer_template)]
+    _check_engine(template)
+    header_file, footer_file = [
+        _render_optional(t, context)
+        for t in (header_template, footer_template)]
+    header_filename = header_file.filename if header_file else None
+    footer_filename = footer_file.filename if footer_file else None
+    base = key = None
+    if cache:
+        key = section_key(template, context, cmd_options,
+                          render_key([header_filename, footer_filename], {}))
+        base = cache.get(key)
+    if base is None:
+        input_file = RenderedFile(template=template, context=context)
+        base = convert_to_pdf(filename=input_file.filename,
+                              header_filename=header_filename,
+                              footer_filename=footer_filename,
+                              cmd_options=cmd_options,
+                              label=template_name(template),
+                              result=True)
+        if cache:
+            cache.set(key, base)
+    return base
+
+
+def render_stamp(stamp_template, context, cmd_options=None, stamp_cmd_options=None,
+                 using=None, result=False):
+    """
+    Converts ``stamp_template``, usually a single page with absolutely
+    positioned content on a transparent background, with the page geometry
+    of ``cmd_options`` and no margins.
+    """
+    stamp_template = resolve_template(stamp_template, using)
+    _check_engine(stamp_template)
+    input_file = RenderedFile(template=stamp_template, context=context)
+    return convert_to_pdf(filename=input_file.filename,
+                          cmd_options=stamp_options(cmd_options,
+                                                    stamp_cmd_options),
+                          label=template_name(stamp_template),
+                          result=result)
+
+
+def render_stamps(stamp_template, contexts, cmd_options=None, stamp_cmd_options=None,
+                  using=None):
+    """
+    Converts ``stamp_template`` once per context of ``contexts``, see
+    render_stamp(), in a single wkhtmltopdf run where each starts a new
+    page, and returns the PDFResult.
+    """
+    stamp_template = resolve_template(stamp_template, using)
+    _check_engine(stamp_template)
+    input_files = [RenderedFile(template=stamp_template, context=context)
+                   for context in contexts]
+    return wkhtmltopdf(pages=[input_file.filename for input_file in input_files],
+                       label=template_name(stamp_template), result=True,
+                       **stamp_options(cmd_options, stamp_cmd_options))
+
+
+def render_stamped_pdf(template, stamp_template, context, stamp_context,
+                       header_template=None, footer_template=None, cmd_options=None,
+                       stamp_cmd_options=None, cache=None, using=None, result=False):
+    """
+    Renders a document shared by many recipients once, and returns it with
+    ``stamp_template`` rendered with ``stamp_context`` drawn over every page,
+    e.g. a watermark with the recipient's name.
+
+    The base document is kept in ``cache``, see render_base_pdf(), so that
+    each further recipient costs the conversion of the stamp, a single
+    small page, and a merge that doesn't parse the document's pages.
+    With ``result``, the PDFResult has the arguments and duration of the
+    stamp's conversion.
+
+    Without a cache the base is converted on every call: use
+    render_stamped_pdfs() for a batch of recipients.
+    """
+    base = render_base_pdf(template, context, header_template=header_template,
+                           footer_template=footer_template, cmd_options=cmd_options,
+                           cache=cache, using=using)
+    try:
+        stamp = render_stamp(stamp_template, stamp_context, cmd_options=cmd_options,
+                             stamp_cmd_options=stamp_cmd_options, using=using,
+                             result=True)
+        content = stamp_pdf(base.raw, stamp.content)
+    finally:
+        base.close()
+    if result:
+        return PDFResult(args=stamp.args, returncode=0,
+                         duration=stamp.duration, content=content,
+                         usage=stamp.usage)
+    return content
+
+
+def render_stamped_pdfs(template, stamp_template, context, stamp_contexts,
+                        header_template=None, footer_template=None, cmd_options=None,
+                        stamp_cmd_options=None, cache=None, using=None,
+                        batch_size=STAMP_BATCH_SIZE):
+    """
+    Returns a list of copies of a document shared by many recipients, as
+    bytes, each with ``stamp_template`` rendered with one of
+    ``stamp_contexts`` drawn over every page.
+
+    The base document is converted once for the whole batch, or taken from
+    ``cache``, see render_base_pdf(). The stamps are converted
+    ``batch_size`` at a time by a single wkhtmltopdf run, so they must fit
+    on one page each: a batch whose stamps don't is converted again a
+    stamp at a time.
+    """
+    stamp_template = resolve_template(stamp_template, using)
+    _check_engine(stamp_template)
+    stamp_contexts = list(stamp_contexts)
+    base = render_base_pdf(template, context, header_template=header_template,
+                           footer_template=footer_template, cmd_options=cmd_options,
+                           cache=cache, using=using)
+    pdfs = []
+    try:
+        for start in range(0, len(stamp_contexts), batch_size):
+            batch = stamp_contexts[start:start + batch_size]
+            stamps = render_stamps(stamp_template, batch, cmd_options=cmd_options,
+                                   stamp_cmd_options=stamp_cmd_options)
+            if stamps.page_count == len(batch):
+                pdfs.extend(stamp_pdf_pages(base.raw, stamps.content))
+                continue
+            for stamp_context in batch:
+                stamp = render_stamp(stamp_template, stamp_context,
+                                     cmd_options=cmd_options,
+                                     stamp_cmd_options=stamp_cmd_options)
+                pdfs.append(stamp_pdf(base.raw, stamp))
+    finally:
+        base.close()
+    return pdfs
@@ -1,44 +1,92 @@
-from __future__ import absolute_import
-
-from subprocess import *
-
-
-# Provide Python 2.7's check_output() function.
-try:
-    check_output
-except NameError:
-    def check_output(*popenargs, **kwargs):
-        r"""Run command with arguments and return its output as a byte string.
-
-        If the exit code was non-zero it raises a CalledProcessError.  The
-        CalledProcessError object will have the return code in the returncode
-        attribute and output in the output attribute.
-
-        The arguments are the same as for the Popen constructor.  Example:
-
-        >>> check_output(["ls", "-l", "/dev/null"])
-        'crw-rw-rw- 1 root root 1, 3 Oct 18  2007 /dev/null\n'
-
-        The stdout argument is not allowed as it is used internally.
-        To capture standard error in the result, use stderr=STDOUT.
-
-        >>> check_output(["/bin/sh", "-c",
-        ...               "ls -l non_existent_file ; exit 0"],
-        ...              stderr=STDOUT)
-        'ls: non_existent_file: No such file or directory\n'
-        """
-        if 'stdout' in kwargs:
-            raise ValueError('stdout argument not allowed, it will be overridden.')
-        process = Popen(stdout=PIPE, *popenargs, **kwargs)
-        output, unused_err = process.communicate()
-        retcode = process.poll()
-        if retcode:
-            cmd = kwargs.get("args")
-            if cmd is None:
-                cmd = popenargs[0]
-            error = CalledProcessError(retcode, cmd)
-            # Add the output attribute to CalledProcessError, which
-            # doesn't exist until Python 2.7.
-            error.output = output
-            raise error
-        return output
+import os
+import selectors
+import shutil
+# CalledProcessError and check_output are part of this module's API.
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen, check_output  # noqa: F401
+
+
+_executables = {}
+
+
+def resolve_executable(name):
+    """
+    Returns the absolute path of the executable ``name``.
+
+    Names without a directory are looked up on PATH once and cached, so the
+    child can be started without a PATH search.
+    """
+    try:
+        return _executables[name]
+    except KeyError:
+        pass
+    path = name
+    if not os.path.dirname(name):
+        found = shutil.which(name)
+        if found:
+            path = os.path.abspath(found)
+    _executables[name] = path
+    return path
+
+
+def _read_pipes(process):
+    """
+    Returns the stdout and stderr of ``process``, read until the child
+    closes them. Unlike Popen.communicate(), doesn't reap the child.
+    """
+    output = {process.stdout: [], process.stderr: []}
+    with selectors.DefaultSelector() as selector:
+        for pipe in output:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, events in selector.select():
+                data = os.read(key.fd, 64 * 1024)
+                if data:
+                    output[key.fileobj].append(data)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+    return b''.join(output[process.stdout]), b''.join(output[process.stderr])
+
+
+def _wait4(process):
+    """Reaps ``process`` with wait4() and returns its rusage."""
+    pid, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def spawn(args, env=None, rusage=False):
+    """
+    Runs ``args`` and returns ``(returncode, stdout, stderr)``, or with
+    ``rusage``, ``(returncode, stdout, stderr, rusage)`` where rusage is
+    the ``resource.struct_rusage`` of the child, or None on platforms
+    without wait4().
+
+    The child is started with settings that let CPython use posix_spawn()
+    or vfork() instead of fork(), which copies the page tables of the
+    (possibly large) parent: an absolute executable path, no preexec_fn,
+    no cwd and close_fds=False. Python 3 file descriptors are not
+    inheritable by default, so nothing leaks into the child.
+    """
+    args = list(args)
+    args[0] = resolve_executable(args[0])
+    process = Popen(args, stdout=PIPE, stderr=PIPE, env=env, close_fds=False)
+    if not rusage:
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout, stderr
+    if not hasattr(os, 'wait4'):
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout, stderr, None
+    try:
+        stdout, stderr = _read_pipes(process)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    # The child is reaped with wait4() rather than by Popen, which would
+    # discard its resource usage.
+    usage = _wait4(process)
+    return process.returncode, stdout, stderr, usage
@@ -0,0 +1,174 @@
+from itertools import islice
+
+from django import template
+from django.db.models.query import QuerySet
+from django.template.base import token_kwargs
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+DEFAULT_ROWS = 50
+
+# Every table after the first starts on a new page.
+TABLE_STYLE = 'page-break-before: always'
+
+# Class of the tables, which TABLE_CSS applies to.
+TABLE_CLASS = 'wkhtmltopdf-chunk'
+
+# Rows are not split across pages, and the header is repeated if a table
+# still overflows one. Written once before the tables, since the rows come
+# from the template.
+TABLE_CSS = ('.%(class)s thead { display: table-header-group; } '
+             '.%(class)s tr { page-break-inside: avoid; }' % {'class': TABLE_CLASS})
+
+
+def iterate(sequence, chunk_size=2000):
+    """
+    Iterates over ``sequence`` without loading it at once: querysets that
+    haven't been evaluated are fetched ``chunk_size`` rows at a time.
+    """
+    if sequence is None:
+        return iter(())
+    if isinstance(sequence, QuerySet) and sequence._result_cache is None:
+        return sequence.iterator(chunk_size=chunk_size)
+    return iter(sequence)
+
+
+def chunks(sequence, size):
+    """Yields lists of ``size`` items of ``sequence``, lazily."""
+    iterator = iterate(sequence, chunk_size=max(size, 100))
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Chunks(object):
+    """
+    The chunks of a sequence, for the ``for`` tag, which needs their
+    number: querysets are counted rather than loaded.
+    """
+
+    def __init__(self, sequence, size):
+        self.sequence = sequence
+        self.size = size
+
+    def __iter__(self):
+        return chunks(self.sequence, self.size)
+
+    def __len__(self):
+        if isinstance(self.sequence, QuerySet):
+            count = self.sequence.count()
+        else:
+            count = len(self.sequence)
+        return -(-count // self.size)
+
+
+@register.filter
+def chunked(sequence, size=DEFAULT_ROWS):
+    """
+    Splits ``sequence`` into lists of ``size`` items, loading querysets
+    lazily::
+
+        {% for rows in lines|chunked:40 %}
+          <table>{% for line in rows %}...{% endfor %}</table>
+        {% endfor %}
+
+    Iterables without a length, like generators, are loaded at once by the
+    ``for`` tag.
+    """
+    if sequence is None:
+        return []
+    if not isinstance(sequence, QuerySet) and not hasattr(sequence, '__len__'):
+        sequence = list(sequence)
+    return Chunks(sequence, int(size))
+
+
+class ChunkedTableNode(template.Node):
+
+    def __init__(self, sequence, var, head, body, options):
+        self.sequence = sequence
+        self.var = var
+        self.head = head
+        self.body = body
+        self.options = options
+
+    def render(self, context):
+        return mark_safe(''.join(self.stream(context)))
+
+    def stream(self, context):
+        """Yields the tables one row at a time. iter_render() uses this
+        when the tag is at the top level of the template."""
+        sequence = self.sequence.resolve(context, ignore_failures=True)
+        options = dict((key, value.resolve(context))
+                       for key, value in self.options.items())
+        size = int(options.pop('rows', DEFAULT_ROWS))
+        css_class = options.pop('class', None)
+        css_class = '%s %s' % (TABLE_CLASS, css_class) if css_class else TABLE_CLASS
+        head = self.head.render(context)
+        yield format_html('<style>{}</style>', TABLE_CSS)
+
+        parentloop = context.get('forloop', {})
+        with context.push():
+            loop = context['forloop'] = {'parentloop': parentloop}
+            counter = 0
+            for index, chunk in enumerate(chunks(sequence, size)):
+                yield format_html(
+                    '<table class="{}"{}>', css_class,
+                    format_html(' style="{}"', TABLE_STYLE) if index else '')
+                yield format_html('<thead>{}</thead><tbody>', head)
+                loop['chunk'] = index + 1
+                for item in chunk:
+                    loop['counter0'] = counter
+                    loop['counter'] = counter + 1
+                    loop['first'] = counter == 0
+                    context[self.var] = item
+                    yield self.body.render(context)
+                    counter += 1
+                yield mark_safe('</tbody></table>')
+
+
+@register.tag
+def chunked_table(parser, token):
+    """
+    Renders a large sequence as a series of tables of ``rows`` rows, each
+    starting on a new page with the same header, repeated on the next page
+    if a table overflows one. Rows are not split across pages::
+
+        {% chunked_table lines rows=40 class="invoice" as line %}
+          <tr><th>SKU</th><th>Price</th></tr>
+        {% rows %}
+          <tr><td>{{ line.sku }}</td><td>{{ line.price }}</td></tr>
+        {% endchunked_table %}
+
+    wkhtmltopdf lays out many small tables much faster than one large one.
+    Querysets are fetched in batches rather than loaded at once. In the
+    rows, ``forloop`` has ``counter``, ``counter0``, ``first`` and ``chunk``,
+    the number of the table.
+    """
+    bits = token.split_contents()
+    tag = bits.pop(0)
+    if len(bits) < 3 or bits[-2] != 'as':
+        raise template.TemplateSyntaxError(
+            "'%s' expects '%s sequence [rows=N] [class=...] as name'"
+            % (tag, tag))
+    var = bits.pop()
+    bits.pop()
+    sequence = parser.compile_filter(bits.pop(0))
+    options = token_kwargs(bits, parser)
+    if bits:
+        raise template.TemplateSyntaxError(
+            "'%s' received unexpected arguments: %s" % (tag, ' '.join(bits)))
+    unknown = set(options) - set(['rows', 'class'])
+    if unknown:
+        raise template.TemplateSyntaxError(
+            "'%s' received unknown options: %s"
+            % (tag, ', '.join(sorted(unknown))))
+
+    head = parser.parse(('rows',))
+    parser.delete_first_token()
+    body = parser.parse(('end' + tag,))
+    parser.delete_first_token()
+    return ChunkedTableNode(sequence, var, head, body, options)
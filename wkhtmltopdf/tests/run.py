@@ -37,6 +37,12 @@ settings.configure(
             'DIRS': [],
             'OPTIONS': {},
         },
+        {
+            'BACKEND': 'django.template.backends.jinja2.Jinja2',
+            'APP_DIRS': True,
+            'DIRS': [],
+            'OPTIONS': {},
+        },
     ],
     WKHTMLTOPDF_DEBUG=False,
 )
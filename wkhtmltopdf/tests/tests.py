@@ -1,23 +1,61 @@
 # -*- coding: utf-8 -*-
 
-from __future__ import absolute_import
-
+import hashlib
+import io
+import json
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 from django.conf import settings
-from django.template import loader, RequestContext
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.template import (Engine, engines, loader, RequestContext,
+                             TemplateSyntaxError)
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.test.client import RequestFactory
 from django.utils.encoding import smart_str
-import six
 
-from wkhtmltopdf.subprocess import CalledProcessError
+import wkhtmltopdf as wkhtmltopdf_package
+from wkhtmltopdf import metrics, retry, usage, xvfb
+from wkhtmltopdf.cache import PDFCache
+from wkhtmltopdf.engines import (BaseEngine, ChromiumEngine, WkhtmltopdfEngine,
+                                 get_engine, insert_style, page_css)
+from wkhtmltopdf.images import optimize_images
+from wkhtmltopdf.minify import Minifier
+from wkhtmltopdf.pdf import _add_object, concatenate_pdfs, stamp_pdf, stamp_pdf_pages
+from wkhtmltopdf.sections import Section, render_sectioned_pdf, section_key
+from wkhtmltopdf.stamps import (render_base_pdf, render_stamped_pdf,
+                                render_stamped_pdfs)
+from wkhtmltopdf.plan import CostModel, get_cost_model
+from wkhtmltopdf.coalesce import DEFAULTS, SingleFlight, coalesce, render_key
+from wkhtmltopdf.result import PDFResult, count_pages
+from wkhtmltopdf.scheduler import (BULK, INTERACTIVE, Scheduler, SharedScheduler,
+                                   get_scheduler, propagate, render_priority)
+from wkhtmltopdf.diagnostics import (parse_stderr, resource_stats,
+                                     LOAD_ERROR, LOAD_FAILED, JAVASCRIPT,
+                                     PROGRESS, SLOW_LOAD)
+from wkhtmltopdf.signals import render_diagnostics
+from wkhtmltopdf.subprocess import CalledProcessError, resolve_executable, spawn
 from wkhtmltopdf.utils import (_options_to_args, make_absolute_paths,
                                wkhtmltopdf, render_pdf_from_template,
-                               render_to_temporary_file, RenderedFile)
-from wkhtmltopdf.views import PDFResponse, PDFTemplateView, PDFTemplateResponse
+                               render_to_temporary_file, RenderedFile,
+                               ContentWriter, content_filters, iter_render,
+                               resolve_template,
+                               plan_pdf_from_template,
+                               split_chunks, get_command, get_env,
+                               wkhtmltoimage, render_pdf_and_image_from_template)
+from wkhtmltopdf.views import (PDFResponse, PDFTemplateView, PDFTemplateResponse,
+                               ImageResponse, ImageTemplateResponse,
+                               ImageTemplateView)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
 
 class UnicodeContentPDFTemplateView(PDFTemplateView):
@@ -33,6 +71,51 @@ class UnicodeContentPDFTemplateView(PDFTemplateView):
         return context
 
 
+def statements():
+    """Source of the render_pdfs command tests."""
+    return [{'title': 'January', 'slug': 'jan'},
+            {'title': 'February', 'slug': 'feb'},
+            {'title': 'March', 'slug': 'mar'}]
+
+
+class RecordingBackend(metrics.BaseBackend):
+    """Metrics backend that keeps every call, for testing."""
+    calls = []
+
+    def observe(self, name, value, labels):
+        self.calls.append(('observe', name, labels))
+
+    def increment(self, name, labels, value=1):
+        self.calls.append(('increment', name, labels))
+
+    def gauge(self, name, delta, labels):
+        self.calls.append(('gauge', name, labels))
+
+
+class RecordingEngine(BaseEngine):
+    """Conversion engine that keeps the HTML it converts, for testing."""
+    name = 'recording'
+    calls = []
+
+    def convert(self, filename, header_filename=None, footer_filename=None,
+                cmd_options=None, cover_filename=None, label=None, result=False):
+        options = self._page_options(cmd_options or {}, header_filename,
+                                     footer_filename)
+        with open(filename) as f:
+            self.calls.append((label, options, f.read()))
+        return b'%PDF-1.4 recording'
+
+
+class CountingEngine(WkhtmltopdfEngine):
+    """wkhtmltopdf engine that keeps the labels it converts, for testing."""
+    name = 'counting'
+    calls = []
+
+    def convert(self, filename, label=None, **kwargs):
+        self.calls.append(label)
+        return super(CountingEngine, self).convert(filename, label=label, **kwargs)
+
+
 class TestUtils(TestCase):
     def setUp(self):
         # Clear standard error
@@ -84,6 +167,316 @@ class TestUtils(TestCase):
         finally:
             temp_file.close()
 
+    def test_wkhtmltopdf_stderr_events(self):
+        """Failed runs should carry the parsed stderr on the exception."""
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        render_diagnostics.connect(receiver)
+        try:
+            with self.assertRaises(CalledProcessError) as cm:
+                wkhtmltopdf(pages=[], label='empty.html')
+        finally:
+            render_diagnostics.disconnect(receiver)
+
+        self.assertTrue(cm.exception.stderr)
+        self.assertEqual(received[0]['events'], cm.exception.events)
+        self.assertEqual(received[0]['label'], 'empty.html')
+        self.assertEqual(received[0]['returncode'], cm.exception.returncode)
+
+    def test_wkhtmltopdf_result(self):
+        """result=True should return a PDFResult with run metadata."""
+        template = loader.get_template('sample.html')
+        temp_file = render_to_temporary_file(template, context={'title': 'A'})
+        try:
+            result = wkhtmltopdf(pages=[temp_file.name], result=True)
+            self.assertIsInstance(result, PDFResult)
+            self.assertEqual(result.returncode, 0)
+            self.assertTrue(result.buffer[:4].tobytes() == b'%PDF')
+            self.assertEqual(result.size, len(result.content))
+            self.assertEqual(result.page_count, 1)
+            # Documents with object streams are parsed.
+            self.assertEqual(count_pages(result.content + b'% /Type /ObjStm\n'), 1)
+            pdf = concatenate_pdfs([result.content] * 3)
+            self.assertEqual(count_pages(pdf), 3)
+            self.assertTrue(result.duration >= 0)
+            self.assertIn(temp_file.name, result.args)
+            self.assertIsNone(result.mmap)
+
+            # Output written to disk is exposed through an mmap.
+            output = render_to_temporary_file(template, context={},
+                                              suffix='.pdf')
+            result = wkhtmltopdf(pages=[temp_file.name], output=output.name,
+                                 result=True)
+            self.assertEqual(result.mmap[:4], b'%PDF')
+            self.assertEqual(result.size, os.path.getsize(output.name))
+            result.close()
+            output.close()
+        finally:
+            temp_file.close()
+
+    def test_parse_stderr(self):
+        stderr = (b'Loading pages (1/6)\r[====>      ] 10%\r'
+                  b'[============================================================] 100%\n'
+                  b'Warning: Failed to load file:///media/logo.png (ignore)\n'
+                  b'Error: Failed to load http://example.com/a.css, with network '
+                  b'status code 3 and http status code 0 - Host example.com not found\n'
+                  b'Error: Failed to load http://example.com/b.js, with network '
+                  b'status code 4 and http status code 0 - Operation timed out\n'
+                  b'Warning: http://example.com/page.html:12 ReferenceError: '
+                  b'Can\'t find variable: foo\n'
+                  b'Done\n')
+        events = parse_stderr(stderr)
+        self.assertEqual([e.kind for e in events],
+                         [PROGRESS, LOAD_FAILED, LOAD_ERROR, SLOW_LOAD,
+                          JAVASCRIPT, PROGRESS])
+        self.assertEqual([e.url for e in events[1:5]],
+                         ['file:///media/logo.png', 'http://example.com/a.css',
+                          'http://example.com/b.js',
+                          'http://example.com/page.html'])
+        self.assertEqual(parse_stderr(b''), [])
+
+    def test_resource_stats(self):
+        events = parse_stderr(b'Warning: Failed to load file:///a.png (ignore)\n'
+                              b'Warning: Failed to load file:///b.png (ignore)\n')
+        resource_stats.reset()
+        resource_stats.record('sample.html', events)
+        self.assertEqual(resource_stats.get('sample.html')[LOAD_FAILED], 2)
+        self.assertEqual(resource_stats.get('other.html'), {})
+        resource_stats.reset()
+        self.assertEqual(resource_stats.as_dict(), {})
+
+    def test_spawn(self):
+        """The executable should be resolved to an absolute path once."""
+        sh = resolve_executable('sh')
+        self.assertTrue(os.path.isabs(sh))
+        self.assertEqual(resolve_executable(sh), sh)
+        self.assertEqual(spawn(['sh', '-c', 'echo out; echo err >&2; exit 3']),
+                         (3, b'out\n', b'err\n'))
+        returncode, stdout, stderr, rusage = spawn(['sh', '-c', 'exit 3'],
+                                                   rusage=True)
+        self.assertEqual(returncode, 3)
+        self.assertTrue(rusage.ru_maxrss > 0)
+
+        with override_settings(WKHTMLTOPDF_CMD='sh -c true'):
+            self.assertEqual(get_command(), [sh, '-c', 'true'])
+            self.assertIs(get_command(), get_command())
+
+    def test_lazy_import(self):
+        """Importing the views shouldn't load the rendering machinery."""
+        code = ('import sys\n'
+                'from django.conf import settings\n'
+                'settings.configure()\n'
+                'import django\n'
+                'django.setup()\n'
+                'import wkhtmltopdf.views\n'
+                'print(sorted(m for m in ("wkhtmltopdf.utils", "django.test")'
+                ' if m in sys.modules))\n')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(output.strip(), b'[]')
+
+        # The helpers are still available from the package.
+        self.assertIs(wkhtmltopdf_package.render_pdf_from_template,
+                      render_pdf_from_template)
+        self.assertRaises(AttributeError, getattr, wkhtmltopdf_package, 'missing')
+
+    def test_get_env(self):
+        """The subprocess environment should be built once per setting."""
+        with override_settings(WKHTMLTOPDF_ENV=None):
+            self.assertIsNone(get_env())
+        with override_settings(WKHTMLTOPDF_ENV={'DISPLAY': ':2'}):
+            env = get_env()
+            self.assertEqual(env['DISPLAY'], ':2')
+            self.assertEqual(env.get('PATH'), os.environ.get('PATH'))
+            self.assertIs(get_env(), env)
+            self.assertEqual(get_env(':99')['DISPLAY'], ':99')
+            self.assertEqual(env['DISPLAY'], ':2')
+        with override_settings(WKHTMLTOPDF_ENV={'DISPLAY': ':3'}):
+            self.assertEqual(get_env()['DISPLAY'], ':3')
+        with override_settings(WKHTMLTOPDF_ENV=None):
+            self.assertEqual(get_env(':99')['DISPLAY'], ':99')
+
+    def test_xvfb_pool(self):
+        """Runs should get a display of the pool, restarted if it died."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # Stands in for Xvfb: reports a display number and waits.
+        fake_xvfb = os.path.join(directory, 'Xvfb')
+        with open(fake_xvfb, 'w') as f:
+            f.write('#!{0}\n'
+                    'import os, sys, time\n'
+                    'fd = int(sys.argv[sys.argv.index("-displayfd") + 1])\n'
+                    'os.write(fd, b"%d\\n" % (os.getpid() % 1000 + 100))\n'
+                    'time.sleep(60)\n'.format(sys.executable))
+        os.chmod(fake_xvfb, 0o755)
+
+        config = {'displays': 2, 'max_clients': 1, 'command': fake_xvfb}
+        with override_settings(WKHTMLTOPDF_XVFB=config,
+                               WKHTMLTOPDF_CMD='sh -c \'printf "$DISPLAY"\''):
+            pool = xvfb.get_pool()
+            with pool.display() as first, pool.display() as second:
+                self.assertNotEqual(first, second)
+                self.assertEqual(
+                    sorted([first, second]),
+                    sorted(':%d' % (d.process.pid % 1000 + 100)
+                           for d in pool.displays))
+            self.assertIn(wkhtmltopdf(['-']).decode(), (first, second))
+
+            dead = pool.displays[0]
+            dead.process.kill()
+            dead.process.wait()
+            pool.displays[1].clients = 1
+            with pool.display() as name:
+                self.assertTrue(dead.alive())
+                self.assertEqual(dead.starts, 2)
+                self.assertEqual(name, dead.name)
+            pool.displays[1].clients = 0
+            processes = [d.process for d in pool.displays]
+        # Changing the setting stops the servers.
+        for process in processes:
+            self.assertIsNotNone(process.poll())
+        self.assertIsNone(xvfb.get_pool())
+
+    def test_wkhtmltoimage(self):
+        """Should run wkhtmltoimage to generate an image"""
+        template = loader.get_template('sample.html')
+        temp_file = render_to_temporary_file(template, context={'title': 'A'})
+        try:
+            image = wkhtmltoimage(page=temp_file.name, width=100)
+            self.assertTrue(image.startswith(PNG_SIGNATURE))
+            self.assertRaises(CalledProcessError, wkhtmltoimage, page='')
+        finally:
+            temp_file.close()
+
+    def test_render_pdf_and_image(self):
+        """Should convert one rendered template to a PDF and an image."""
+        pdf, image = render_pdf_and_image_from_template(
+            'sample.html', None, 'footer.html', context={'title': 'Both'},
+            image_options={'width': 100})
+        self.assertTrue(pdf.startswith(b'%PDF-'))
+        self.assertTrue(image.startswith(PNG_SIGNATURE))
+
+    @override_settings(
+        WKHTMLTOPDF_METRICS_BACKEND='wkhtmltopdf.tests.tests.RecordingBackend')
+    def test_metrics(self):
+        """Renders should be reported to the metrics backend."""
+        RecordingBackend.calls = []
+        render_pdf_from_template('sample.html', None, None,
+                                 context={'title': 'Metrics'})
+        labels = {'name': 'sample.html'}
+        self.assertEqual(RecordingBackend.calls, [
+            ('observe', metrics.TEMPLATE_RENDER_SECONDS, labels),
+            ('observe', metrics.TEMPFILE_WRITE_SECONDS, labels),
+            ('gauge', metrics.IN_FLIGHT, labels),
+            ('gauge', metrics.IN_FLIGHT, labels),
+            ('observe', metrics.WALL_SECONDS, labels),
+            ('observe', metrics.CPU_SECONDS, labels),
+            ('observe', metrics.MAX_RSS_BYTES, labels),
+            ('observe', metrics.PDF_BYTES, labels),
+        ])
+
+        RecordingBackend.calls = []
+        self.assertRaises(CalledProcessError, wkhtmltopdf, pages=[],
+                          label='empty')
+        self.assertIn(('increment', metrics.FAILURES,
+                       {'name': 'empty', 'exit_code': '1'}),
+                      RecordingBackend.calls)
+
+    def test_prometheus_backend(self):
+        """Concurrent first renders should register the metrics once."""
+        import prometheus_client
+
+        registry = prometheus_client.CollectorRegistry()
+        with override_settings(
+                WKHTMLTOPDF_METRICS_BACKEND='wkhtmltopdf.metrics.PrometheusBackend',
+                WKHTMLTOPDF_METRICS_OPTIONS={'registry': registry}):
+            threads = [threading.Thread(target=metrics.get_backend)
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            metrics.observe(metrics.PDF_BYTES, 200 * 1024, 'sample.html')
+        labels = {'name': 'sample.html', 'le': str(0.5 * 1024 * 1024)}
+        self.assertEqual(registry.get_sample_value(
+            metrics.PDF_BYTES + '_bucket', labels), 1)
+
+    def _flaky_command(self, failures, stderr='std::bad_alloc'):
+        """
+        Returns a command failing ``failures`` times before running
+        wkhtmltopdf, and a function returning how often it ran.
+        """
+        counter = render_to_temporary_file('sample.html', context={},
+                                           suffix='.count')
+        counter.truncate(0)
+        counter.flush()
+        self.addCleanup(counter.close)
+        script = ('n=$(wc -c < {0}); printf x >> {0}; '
+                  '[ "$n" -ge {1} ] && exec {2} "$@"; '
+                  'echo "{3}" >&2; exit 1').format(
+                      counter.name, failures, ' '.join(get_command()), stderr)
+        runs = lambda: os.path.getsize(counter.name)
+        return 'sh -c \'%s\' wkhtmltopdf' % script, runs
+
+    def test_retry(self):
+        """Transient failures should be retried."""
+        template = loader.get_template('sample.html')
+        temp_file = render_to_temporary_file(template, context={'title': 'A'})
+        self.addCleanup(temp_file.close)
+
+        cmd, runs = self._flaky_command(failures=2)
+        with override_settings(WKHTMLTOPDF_CMD=cmd,
+                               WKHTMLTOPDF_RETRY={'attempts': 3, 'backoff': 0}):
+            pdf_output = wkhtmltopdf(pages=[temp_file.name])
+        self.assertTrue(pdf_output.startswith(b'%PDF'))
+        self.assertEqual(runs(), 3)
+
+        # Without WKHTMLTOPDF_RETRY the command runs once.
+        cmd, runs = self._flaky_command(failures=1)
+        with override_settings(WKHTMLTOPDF_CMD=cmd):
+            self.assertRaises(CalledProcessError, wkhtmltopdf,
+                              pages=[temp_file.name])
+        self.assertEqual(runs(), 1)
+
+        # Other failures are not retried.
+        cmd, runs = self._flaky_command(failures=1, stderr='Failed to load')
+        with override_settings(WKHTMLTOPDF_CMD=cmd,
+                               WKHTMLTOPDF_RETRY={'attempts': 3, 'backoff': 0}):
+            self.assertRaises(CalledProcessError, wkhtmltopdf,
+                              pages=[temp_file.name])
+        self.assertEqual(runs(), 1)
+
+    def test_retry_fallback(self):
+        """The fallback command should run when retries are exhausted."""
+        template = loader.get_template('sample.html')
+        temp_file = render_to_temporary_file(template, context={'title': 'A'})
+        self.addCleanup(temp_file.close)
+
+        real_cmd = ' '.join(get_command())
+        cmd, runs = self._flaky_command(failures=5)
+        with override_settings(WKHTMLTOPDF_CMD=cmd,
+                               WKHTMLTOPDF_RETRY={'attempts': 2, 'backoff': 0},
+                               WKHTMLTOPDF_FALLBACK_CMD=real_cmd,
+                               WKHTMLTOPDF_FALLBACK_CMD_OPTIONS={'lowquality': True}):
+            result = wkhtmltopdf(pages=[temp_file.name], result=True)
+        self.assertEqual(runs(), 2)
+        self.assertTrue(result.content.startswith(b'%PDF'))
+        self.assertEqual(result.args[0], real_cmd.split()[0])
+        self.assertIn('--lowquality', result.args)
+
+    def test_is_transient(self):
+        config = retry.get_config()
+        self.assertTrue(retry.is_transient(CalledProcessError(-9, []), config))
+        error = CalledProcessError(1, [])
+        self.assertFalse(retry.is_transient(error, config))
+        error.stderr = b'QXcbConnection: Could not connect to display :0'
+        self.assertTrue(retry.is_transient(error, config))
+        self.assertTrue(0 < retry.backoff(10, config) <= config['max_backoff'])
+
     def test_wkhtmltopdf_with_unicode_content(self):
         """A wkhtmltopdf call should render unicode content properly"""
         title = u'♥'
@@ -106,6 +499,709 @@ class TestUtils(TestCase):
         self.assertTrue(title in saved_content)
         temp_file.close()
 
+    def test_render_to_temporary_file_streaming(self):
+        """Templates should be written in pieces with the same output."""
+        template = engines['django'].from_string(
+            '<table>{% for row in rows %}\n<tr><td>{{ row }}</td>'
+            '<td><img src="/static/{{ row }}.png"></td></tr>{% endfor %}\n'
+            '</table>{% if title %}<h1>{{ title }}</h1>{% endif %}')
+        context = {'rows': range(5000), 'title': u'\u2665'}
+        self.assertEqual(len(list(iter_render(template, context))), 4)
+
+        with override_settings(STATIC_URL='/static/', STATIC_ROOT='/srv/static'):
+            expected = make_absolute_paths(template.render(context))
+            temp_file = render_to_temporary_file(template, context)
+        self.addCleanup(temp_file.close)
+        temp_file.seek(0)
+        self.assertEqual(temp_file.read().decode('utf-8'), expected)
+        self.assertIn('"file:///srv/static/4999.png"', expected)
+
+    def test_jinja2(self):
+        """Jinja2 templates should be streamed with generate()."""
+        context = {'title': 'Invoice',
+                   'lines': [{'description': 'Item %d' % i, 'amount': i}
+                             for i in range(100)]}
+        template = resolve_template('invoice.html', using='jinja2')
+        self.assertTrue(len(list(iter_render(template, context))) > 1)
+
+        request = RequestFactory().get('/')
+        with override_settings(STATIC_URL='/static/', STATIC_ROOT='/srv/static'):
+            temp_file = render_to_temporary_file(template, context, request)
+        self.addCleanup(temp_file.close)
+        temp_file.seek(0)
+        content = temp_file.read().decode('utf-8')
+        self.assertIn('<td>Item 99</td>', content)
+        self.assertIn('name="csrfmiddlewaretoken"', content)
+        self.assertIn('"file:///srv/static/logo.png"', content)
+
+        pdf_content = render_pdf_from_template(
+            'invoice.html', None, None, context=context, using='jinja2')
+        self.assertTrue(pdf_content.startswith(b'%PDF'))
+
+    def test_iter_render_stream(self):
+        """Templates with a stream() method should be streamed with it."""
+        class StreamingTemplate(object):
+            def stream(self, context, request=None):
+                for i in range(context['count']):
+                    yield '<p>%d</p>' % i
+
+        chunks = list(iter_render(StreamingTemplate(), {'count': 3}))
+        self.assertEqual(chunks, ['<p>0</p>', '<p>1</p>', '<p>2</p>'])
+
+    def test_plan_pdf_from_template(self):
+        """Plans should describe the render without running wkhtmltopdf."""
+        template = engines['django'].from_string(
+            '<html><body><h1>{{ title }}</h1><img src="/static/a.png">'
+            '<img src="https://example.com/b.png"><a href="#top">top</a>'
+            '<div style="background: url(data:image/png;base64,AAAA)"></div>'
+            '</body></html>')
+        with override_settings(STATIC_URL='/static/', STATIC_ROOT='/srv/static',
+                               WKHTMLTOPDF_CMD='/nonexistent/wkhtmltopdf'):
+            render_plan = plan_pdf_from_template(
+                template, None, 'footer.html', {'title': 'Plan'},
+                cmd_options={'page_size': 'A4'})
+            expected = make_absolute_paths(template.render({'title': 'Plan'}))
+            footer_size = len(make_absolute_paths(
+                loader.render_to_string('footer.html', {})).encode('utf-8'))
+        self.assertEqual(render_plan.html_size,
+                         len(expected.encode('utf-8')) + footer_size)
+        self.assertEqual(dict(render_plan.assets),
+                         {'local': 3, 'remote': 1, 'inline': 1})
+        self.assertEqual(render_plan.args[:1], ['/nonexistent/wkhtmltopdf'])
+        self.assertIn('--page-size', render_plan.args)
+        footer_index = render_plan.args.index('--footer-html')
+        self.assertEqual(render_plan.args[footer_index + 1], 'footer.html')
+        self.assertEqual(render_plan.args[-2:], ['<string>', '-'])
+        self.assertIsNone(render_plan.predicted_seconds)
+
+    def test_cost_model(self):
+        model = CostModel()
+        self.assertIsNone(model.predict(1000, 1))
+        for size, assets in [(1e6, 0), (2e6, 3), (5e5, 10), (4e6, 1)]:
+            model.observe(size, assets, 0.5 + 2 * size / 1e6 + 0.1 * assets)
+        self.assertAlmostEqual(model.predict(3e6, 5), 7.0, places=4)
+        self.assertEqual(CostModel(coefficients=(1, 1, 0)).predict(2e6, 9), 3)
+
+    def test_cost_model_recording(self):
+        """Runs should be recorded with WKHTMLTOPDF_COST_MODEL."""
+        self.assertIsNone(get_cost_model())
+        with override_settings(WKHTMLTOPDF_COST_MODEL=True):
+            model = get_cost_model()
+            for title in ('A', 'B', 'C'):
+                render_pdf_from_template('sample.html', None, None,
+                                         {'title': title})
+            self.assertEqual(model.observations, 3)
+            render_plan = plan_pdf_from_template('sample.html', None, None,
+                                                 {'title': 'D'})
+            self.assertIsNotNone(render_plan.predicted_seconds)
+        with override_settings(WKHTMLTOPDF_COST_MODEL={'coefficients': [2, 0, 0]}):
+            self.assertEqual(plan_pdf_from_template(
+                'sample.html', None, None, {}).predicted_seconds, 2)
+
+    def test_cost_model_samples(self):
+        """Samples should be kept in the usage database and seed new models."""
+        database = os.path.join(tempfile.mkdtemp(), 'usage.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(database))
+        with override_settings(WKHTMLTOPDF_USAGE={'database': database},
+                               WKHTMLTOPDF_COST_MODEL=True):
+            for title in ('A', 'B', 'C'):
+                render_pdf_from_template('sample.html', None, None,
+                                         {'title': title})
+            samples = usage.get_store().samples()
+            self.assertEqual(len(samples), 3)
+            self.assertTrue(all(html_size > 0 for html_size, assets, seconds
+                                in samples))
+        with override_settings(WKHTMLTOPDF_USAGE={'database': database},
+                               WKHTMLTOPDF_COST_MODEL=True):
+            self.assertEqual(get_cost_model().observations, 3)
+
+    def test_pdf_cache(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        cache = PDFCache(location, max_size=250)
+
+        self.assertIsNone(cache.get('a'))
+        path = cache.set('a', b'%PDF-a' + b'x' * 94)
+        digest = hashlib.sha256(b'a').hexdigest()
+        self.assertEqual(path, os.path.join(location, digest[:2], digest[2:4],
+                                            digest + '.pdf'))
+        self.assertEqual(os.listdir(os.path.dirname(path)), [digest + '.pdf'])
+        cached = cache.get('a')
+        self.addCleanup(cached.close)
+        self.assertIsNotNone(cached.mmap)
+        self.assertEqual(cached.content[:6], b'%PDF-a')
+
+        # The least recently used PDF is evicted past max_size.
+        cache.set('b', PDFResult(args=[], returncode=0, duration=0,
+                                 content=b'%PDF-b' + b'x' * 94))
+        cache.touch_interval = 0
+        time.sleep(0.01)
+        cache.get('a')
+        cache.set('c', b'%PDF-c' + b'x' * 94)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.size, 200)
+
+        response = cache.file_response('c', filename='c.pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(b''.join(response.streaming_content)[:6], b'%PDF-c')
+        response.close()
+        self.assertIsNone(cache.file_response('b'))
+
+        cache.delete('c')
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.size, 100)
+
+        # Replacing a PDF counts its new size only.
+        cache.set('a', b'%PDF-a' + b'x' * 44)
+        self.assertEqual(cache.size, 50)
+        self.assertEqual(PDFCache(location).size, 50)
+
+        # A PDF evicted after get() stays readable, until the response
+        # serving it is closed.
+        cached = cache.get('a')
+        cache.evict(0)
+        self.assertEqual(cache.size, 0)
+        self.assertIsNone(cache.get('a'))
+        response = PDFResponse(content=cached)
+        self.assertEqual(b''.join(response)[:6], b'%PDF-a')
+        response.close()
+        self.assertIsNone(cached._mmap)
+
+    def test_render_pdf_from_template_cache(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        with override_settings(WKHTMLTOPDF_CACHE={'location': location}):
+            first = render_pdf_from_template('sample.html', None, None,
+                                             {'title': 'Cached'}, cache=True)
+            # The second render doesn't run wkhtmltopdf.
+            with override_settings(WKHTMLTOPDF_CMD='false'):
+                second = render_pdf_from_template(
+                    'sample.html', None, None, {'title': 'Cached'},
+                    cache=True, result=True)
+                self.assertRaises(CalledProcessError, render_pdf_from_template,
+                                  'sample.html', None, None, {'title': 'Other'},
+                                  cache=True)
+        self.addCleanup(second.close)
+        self.assertIsNotNone(second.mmap)
+        self.assertEqual(second.content, first)
+
+    def test_section_key_dependencies(self):
+        """Section keys should change with the templates a section extends
+        or includes, and with WKHTMLTOPDF_TEMPLATE_VERSION."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        sources = {
+            'child.html': '{% extends "base.html" %}{% block body %}'
+                          '{% include "part.html" %}{% include name %}'
+                          '{% endblock %}',
+            'base.html': '<body>{% block body %}{% endblock %}</body>',
+            'part.html': 'Part',
+        }
+        for name, source in sources.items():
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(source)
+        engine = Engine(dirs=[directory],
+                        loaders=['django.template.loaders.filesystem.Loader'])
+
+        def key():
+            return section_key(engine.get_template('child.html'), {}, {}, '')
+
+        first = key()
+        self.assertEqual(key(), first)
+        with open(os.path.join(directory, 'part.html'), 'w') as f:
+            f.write('Changed part')
+        second = key()
+        self.assertNotEqual(second, first)
+        with override_settings(WKHTMLTOPDF_TEMPLATE_VERSION='2'):
+            self.assertNotEqual(key(), second)
+
+    def test_render_sectioned_pdf(self):
+        """Only the sections whose inputs changed should be converted."""
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        cache = PDFCache(location)
+        sections = [
+            Section(engines['django'].from_string('<h1>{{ title }}</h1>'),
+                    keys=['title']),
+            Section(engines['django'].from_string(
+                '<ul>{% for row in rows %}<li>{{ row }}</li>{% endfor %}</ul>'),
+                keys=['rows']),
+        ]
+        context = {'title': 'Report', 'rows': [1, 2, 3]}
+
+        def render(context, **kwargs):
+            return render_sectioned_pdf(sections, context, cache=cache,
+                                        result=True, **kwargs)
+
+        pdf = render(context)
+        self.assertEqual(len(pdf.args), 2)
+        self.assertEqual(pdf.page_count, 2)
+        self.assertEqual(render(context).args, [])
+        self.assertEqual(len(render(dict(context, rows=[4])).args), 1)
+        # Keys a section doesn't depend on are ignored.
+        self.assertEqual(render(dict(context, other=object())).args, [])
+
+        # With a footer, later sections are converted again with an offset.
+        pdf = render(context, footer_template='footer.html')
+        self.assertEqual(len(pdf.args), 3)
+        self.assertEqual(pdf.args[-1][pdf.args[-1].index('--page-offset') + 1], '1')
+        self.assertEqual(pdf.page_count, 2)
+        self.assertEqual(render(context, footer_template='footer.html').args, [])
+
+        self.assertRaises(TypeError, render, dict(context, rows=[object()]))
+
+    def test_stamp_pdf(self):
+        """Stamps should be drawn over the pages, which are kept intact."""
+        import pypdf
+        from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+        def make_pdf(texts):
+            writer = pypdf.PdfWriter()
+            font = _add_object(writer, DictionaryObject({
+                NameObject('/Type'): NameObject('/Font'),
+                NameObject('/Subtype'): NameObject('/Type1'),
+                NameObject('/BaseFont'): NameObject('/Helvetica')}))
+            for text in texts:
+                page = writer.add_blank_page(595, 842)
+                stream = DecodedStreamObject()
+                stream.set_data(b'BT /F1 12 Tf 20 400 Td (%s) Tj ET' % text)
+                page[NameObject('/Contents')] = _add_object(writer, stream)
+                page[NameObject('/Resources')] = DictionaryObject({
+                    NameObject('/Font'): DictionaryObject({
+                        NameObject('/F1'): font})})
+            output = io.BytesIO()
+            writer.write(output)
+            return output.getvalue()
+
+        base = make_pdf([b'Page one', b'Page two', b'Page three'])
+        stamped = stamp_pdf(base, make_pdf([b'Alice', b'Bob']))
+        pages = pypdf.PdfReader(io.BytesIO(stamped)).pages
+        self.assertEqual(len(pages), 3)
+        for page, page_text, stamp_text in zip(
+                pages, ['Page one', 'Page two', 'Page three'],
+                ['Alice', 'Bob', 'Bob']):
+            text = page.extract_text()
+            self.assertTrue(page_text in text, text)
+            self.assertTrue(stamp_text in text, text)
+        with self.assertRaises(ValueError):
+            stamp_pdf(base, make_pdf([]))
+
+        copies = stamp_pdf_pages(base, make_pdf([b'Alice', b'Bob']))
+        self.assertEqual(len(copies), 2)
+        for copy, stamp_text in zip(copies, ['Alice', 'Bob']):
+            pages = pypdf.PdfReader(io.BytesIO(copy)).pages
+            self.assertEqual(len(pages), 3)
+            for page in pages:
+                self.assertTrue(stamp_text in page.extract_text())
+
+    def test_render_stamped_pdf(self):
+        """The base PDF should be rendered once and stamped per recipient."""
+        import pypdf
+
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        context = {'title': 'Report'}
+        cmd_options = {'page_size': 'A5', 'margin_top': '20'}
+        with override_settings(WKHTMLTOPDF_CACHE={'location': location}):
+            base = render_base_pdf('sample.html', context, cmd_options=cmd_options)
+            self.assertIsNone(base.path)
+            base.close()
+            for name in ('Alice', 'Bob'):
+                pdf = render_stamped_pdf('sample.html', 'sample.html', context,
+                                         {'title': name}, cmd_options=cmd_options,
+                                         result=True)
+                reader = pypdf.PdfReader(io.BytesIO(pdf.content))
+                self.assertEqual(len(reader.pages), 1)
+                self.assertTrue('/WkStamp0' in
+                                reader.pages[0]['/Resources']['/XObject'])
+            base = render_base_pdf('sample.html', context, cmd_options=cmd_options)
+            self.assertTrue(base.path.startswith(location))
+            base.close()
+        args = pdf.args
+        self.assertEqual(args[args.index('--page-size') + 1], 'A5')
+        self.assertEqual(args[args.index('--margin-top') + 1], '0')
+        self.assertTrue('--no-background' in args)
+
+    def test_render_stamped_pdfs(self):
+        """Without a cache, a batch should convert the base once and the
+        stamps once per batch."""
+        import pypdf
+
+        with override_settings(WKHTMLTOPDF_USAGE={}):
+            pdfs = render_stamped_pdfs(
+                'sample.html', 'footer.html', {'title': 'Report'},
+                [{'name': name} for name in ('Alice', 'Bob', 'Carol')],
+                cmd_options={'page_size': 'A5'}, batch_size=2)
+            history = usage.get_history()
+            self.assertEqual(history.summary('sample.html')['count'], 1)
+            self.assertEqual(history.summary('footer.html')['count'], 2)
+        self.assertEqual(len(pdfs), 3)
+        # Without a cache no key is needed, so any context works.
+        self.assertEqual(len(render_stamped_pdfs(
+            'sample.html', 'footer.html', {'title': object()}, [{}])), 1)
+        for pdf in pdfs:
+            reader = pypdf.PdfReader(io.BytesIO(pdf))
+            self.assertEqual(len(reader.pages), 1)
+            self.assertTrue('/WkStamp0' in
+                            reader.pages[0]['/Resources']['/XObject'])
+
+    def test_page_css(self):
+        self.assertEqual(page_css({}), '')
+        self.assertEqual(page_css({'page_size': 'A4', 'orientation': 'Landscape',
+                                   'margin_top': 10, 'margin_left': '1in'}),
+                         '@page { size: A4 landscape; margin-top: 10mm; '
+                         'margin-left: 1in; }')
+        self.assertEqual(page_css({'page_width': '100', 'page_height': '50.5'}),
+                         '@page { size: 100mm 50.5mm; }')
+
+    def test_insert_style(self):
+        """Page CSS should go at the start of the head."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'page.html')
+        for html, expected in [
+                ('<!DOCTYPE html><html><head><title>T</title></head>'
+                 '<body><header>H</header></body></html>',
+                 '<!DOCTYPE html><html><head><style>@page {}</style>'
+                 '<title>T</title></head><body><header>H</header></body></html>'),
+                ('<html lang="en"><body>B</body></html>',
+                 '<html lang="en"><style>@page {}</style><body>B</body></html>'),
+                ('<p>P</p>', '<style>@page {}</style><p>P</p>')]:
+            with open(path, 'w') as f:
+                f.write(html)
+            insert_style(path, '@page {}')
+            with open(path) as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_get_engine(self):
+        engine = 'wkhtmltopdf.tests.tests.RecordingEngine'
+        self.assertIsInstance(get_engine(), WkhtmltopdfEngine)
+        self.assertIsInstance(get_engine('chromium'), ChromiumEngine)
+        self.assertIsInstance(get_engine(engine), RecordingEngine)
+        with override_settings(WKHTMLTOPDF_ENGINE='chromium',
+                               WKHTMLTOPDF_TEMPLATE_ENGINES={'sample.html': engine}):
+            self.assertIsInstance(get_engine(template='sample.html'), RecordingEngine)
+            self.assertIsInstance(get_engine(template='other.html'), ChromiumEngine)
+            self.assertIsInstance(get_engine('wkhtmltopdf', 'sample.html'),
+                                  WkhtmltopdfEngine)
+
+    def test_render_with_engine(self):
+        """Engines should convert the rendered HTML with the page options."""
+        engine = 'wkhtmltopdf.tests.tests.RecordingEngine'
+        RecordingEngine.calls = []
+        pdf = render_pdf_from_template('sample.html', None, None,
+                                       {'title': 'Engines'}, engine=engine,
+                                       cmd_options={'page_size': 'A4', 'quiet': True})
+        self.assertEqual(pdf, b'%PDF-1.4 recording')
+        label, options, html = RecordingEngine.calls[-1]
+        self.assertEqual(label, 'sample.html')
+        self.assertEqual(options, {'page_size': 'A4'})
+        self.assertIn('Engines', html)
+        with self.assertRaises(ValueError):
+            render_pdf_from_template('sample.html', None, 'footer.html',
+                                     {'title': 'Engines'}, engine=engine)
+
+        render_plan = plan_pdf_from_template('sample.html', None, None,
+                                             {'title': 'Engines'}, engine=engine)
+        self.assertEqual(render_plan.engine, 'recording')
+        self.assertFalse(render_plan.plannable)
+        self.assertIsNone(render_plan.args)
+        self.assertIsNone(render_plan.predicted_seconds)
+        self.assertTrue(render_plan.html_size > 0)
+        with override_settings(WKHTMLTOPDF_TEMPLATE_ENGINES={'sample.html': engine}):
+            self.assertFalse(plan_pdf_from_template(
+                'sample.html', None, None, {}).plannable)
+        self.assertTrue(plan_pdf_from_template(
+            'sample.html', None, None, {}).plannable)
+
+        RecordingEngine.calls = []
+        pdf, image = render_pdf_and_image_from_template(
+            'sample.html', None, None, {'title': 'Thumbnail'}, engine=engine)
+        self.assertEqual(pdf, b'%PDF-1.4 recording')
+        self.assertEqual(len(RecordingEngine.calls), 1)
+
+    def test_engine_entry_points(self):
+        """Chunked and sectioned documents should use the given engine, and
+        stamps refuse other engines than wkhtmltopdf."""
+        engine = 'wkhtmltopdf.tests.tests.CountingEngine'
+        CountingEngine.calls = []
+        render_pdf_from_template('sample.html', None, None,
+                                 {'title': 'Chunks', 'rows': [1, 2, 3]},
+                                 chunk_key='rows', chunks=2, engine=engine)
+        self.assertEqual(CountingEngine.calls, ['sample.html', 'sample.html'])
+        CountingEngine.calls = []
+        render_sectioned_pdf([Section('sample.html', keys=['title'])],
+                             {'title': 'Sections'}, engine=engine)
+        self.assertEqual(CountingEngine.calls, ['sample.html'])
+        with override_settings(WKHTMLTOPDF_ENGINE=engine):
+            with self.assertRaises(ImproperlyConfigured):
+                render_stamped_pdf('sample.html', 'footer.html', {}, {})
+
+    def test_chromium_print(self):
+        """Chromium should print a file URL of the page and keep its runs
+        apart from wkhtmltopdf's."""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        stub = os.path.join(root, 'chromium')
+        with open(stub, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'for arg; do case "$arg" in --print-to-pdf=*) '
+                    'out="${arg#--print-to-pdf=}";; esac; url="$arg"; done\n'
+                    'printf "%%PDF-1.4 %s" "$url" > "$out"\n')
+        os.chmod(stub, 0o755)
+        page = os.path.join(root, 'a b#1.html')
+        with open(page, 'w') as f:
+            f.write('<p>P</p>')
+
+        usage.get_history().reset()
+        with override_settings(WKHTMLTOPDF_CHROMIUM_CMD=stub):
+            pdf = ChromiumEngine().convert(page, label='chromium.html')
+        url = 'file://%s/a%%20b%%231.html' % os.path.realpath(root)
+        self.assertEqual(pdf, ('%PDF-1.4 ' + url).encode())
+        self.assertEqual(usage.get_history().summary(
+            'chromium.html', kind=usage.CHROMIUM)['count'], 1)
+        self.assertIsNone(usage.get_history().summary('chromium.html'))
+
+    def test_resource_usage(self):
+        """The rusage of every run should be kept per template."""
+        database = os.path.join(tempfile.mkdtemp(), 'usage.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(database))
+        with override_settings(WKHTMLTOPDF_USAGE={'window': 2,
+                                                  'database': database}):
+            for i in range(3):
+                pdf = render_pdf_from_template('sample.html', None, None,
+                                               {'title': 'Usage'}, result=True)
+            self.assertTrue(pdf.usage.max_rss > 0)
+            self.assertTrue(pdf.usage.cpu_time >= 0)
+            summary = usage.get_history().summary('sample.html')
+            self.assertEqual(summary['count'], 2)
+            self.assertTrue(summary['max_rss_max'] >= pdf.usage.max_rss)
+            self.assertEqual(usage.get_store().as_dict()['sample.html']['count'], 3)
+            self.assertEqual(usage.get_history().most_expensive()[0][0],
+                             'sample.html')
+
+            # Image runs are kept apart.
+            temp_file = render_to_temporary_file('sample.html', context={})
+            try:
+                wkhtmltoimage(page=temp_file.name, label='sample.html')
+            finally:
+                temp_file.close()
+            summary = usage.get_history().summary('sample.html', kind=usage.IMAGE)
+            self.assertEqual(summary['count'], 1)
+            self.assertEqual(usage.get_history().summary('sample.html')['count'], 2)
+            self.assertEqual(usage.get_store().as_dict(
+                kind=usage.IMAGE)['sample.html']['count'], 1)
+            self.assertEqual(usage.get_store().as_dict()['sample.html']['count'], 3)
+
+        total = usage.ResourceUsage.total([
+            usage.ResourceUsage(1.0, 0.5, 100, 8, 0),
+            usage.ResourceUsage(2.0, 0.0, 300, 0, 16)])
+        self.assertEqual(total.as_dict(), {
+            'user_time': 3.0, 'system_time': 0.5, 'max_rss': 300,
+            'in_blocks': 8, 'out_blocks': 16})
+        self.assertIsNone(usage.ResourceUsage.total([total, None]))
+
+    def test_content_writer(self):
+        """Pieces should be bounded and end after a line or tag."""
+        class File(list):
+            write = list.append
+
+        content = ''.join('<p>{0}</p>\n'.format(i) for i in range(1000))
+        content += '<b>' * 1000 + 'x' * 50
+        output = File()
+        writer = ContentWriter(output, filters=[str.upper], buffer_size=100)
+        for i in range(0, len(content), 333):
+            writer.write(content[i:i + 333])
+        writer.write(content[-1:0])
+        writer.close()
+        self.assertEqual(b''.join(output).decode(), content.upper())
+        for piece in output[:-1]:
+            self.assertTrue(len(piece) <= 100)
+            self.assertTrue(piece.endswith((b'\n', b'>')), piece)
+
+    def test_profile(self):
+        """Sampled and slow renders should be profiled."""
+        import pstats
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        context = {'title': 'Heading'}
+
+        with override_settings(WKHTMLTOPDF_PROFILE={'directory': directory,
+                                                    'threshold': 3600}):
+            render_pdf_from_template('sample.html', None, None, context)
+        self.assertEqual(os.listdir(directory), [])
+
+        with override_settings(WKHTMLTOPDF_PROFILE={'directory': directory,
+                                                    'threshold': 0,
+                                                    'interval': 0.001}):
+            render_pdf_from_template('sample.html', None, 'footer.html', context,
+                                     chunk_key='title', chunks=1)
+        names = sorted(os.listdir(directory))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].endswith('.folded'))
+        self.assertTrue('-sample.html-' in names[0])
+        with open(os.path.join(directory, names[1])) as f:
+            metadata = json.load(f)
+        self.assertEqual(metadata['reason'], 'threshold')
+        self.assertEqual(metadata['profile'], names[0])
+        # The run in the chunk pool is recorded too.
+        self.assertEqual(len(metadata['wkhtmltopdf']), 1)
+        run = metadata['wkhtmltopdf'][0]
+        self.assertEqual(run['returncode'], 0)
+        self.assertTrue('--footer-html' in run['args'])
+        self.assertEqual(metadata['wkhtmltopdf_seconds'], run['seconds'])
+        self.assertTrue(metadata['seconds'] >= run['seconds'])
+
+        shutil.rmtree(directory)
+        with override_settings(WKHTMLTOPDF_PROFILE={'directory': directory,
+                                                    'sample_rate': 1,
+                                                    'threshold': None,
+                                                    'profiler': 'cprofile'}):
+            render_pdf_from_template('sample.html', None, None, context)
+        names = sorted(os.listdir(directory))
+        self.assertTrue(names[1].endswith('.prof'))
+        stats = pstats.Stats(os.path.join(directory, names[1]))
+        self.assertTrue(any(name == 'convert_to_pdf'
+                            for (path, line, name) in stats.stats))
+
+    def test_chunked_table(self):
+        """Large sequences should be rendered as page-sized tables."""
+        source = ('{% load wkhtmltopdf %}<h1>{{ title }}</h1>'
+                  '{% chunked_table items rows=2 class="t" as item %}'
+                  '<tr><th>{{ title }}</th></tr>'
+                  '{% rows %}<tr><td>{{ forloop.chunk }}.{{ forloop.counter }} '
+                  '{{ item }}</td></tr>{% endchunked_table %}')
+        template = engines['django'].from_string(source)
+        context = {'title': 'Items', 'items': ['a', 'b', 'c', '<d>', 'e']}
+        page = '<thead><tr><th>Items</th></tr></thead><tbody>'
+        style = ('<style>.wkhtmltopdf-chunk thead { display: table-header-group; } '
+                 '.wkhtmltopdf-chunk tr { page-break-inside: avoid; }</style>')
+        expected = (
+            '<h1>Items</h1>' + style +
+            '<table class="wkhtmltopdf-chunk t">' + page +
+            '<tr><td>1.1 a</td></tr><tr><td>1.2 b</td></tr></tbody></table>'
+            '<table class="wkhtmltopdf-chunk t" style="page-break-before: always">' +
+            page + '<tr><td>2.3 c</td></tr><tr><td>2.4 &lt;d&gt;</td></tr>'
+            '</tbody></table>'
+            '<table class="wkhtmltopdf-chunk t" style="page-break-before: always">' +
+            page + '<tr><td>3.5 e</td></tr></tbody></table>')
+        self.assertEqual(template.render(context), expected)
+        # The tables are streamed one row at a time.
+        chunks = list(iter_render(template, context))
+        self.assertEqual(''.join(chunks), expected)
+        self.assertEqual(len(chunks), 5 + 3 * 3 + 5)
+
+        # Querysets are iterated without being loaded into the cache.
+        queryset = ContentType.objects.order_by('pk')
+        template = engines['django'].from_string(
+            '{% load wkhtmltopdf %}{% chunked_table types as type %}{% rows %}'
+            '{{ type.model }},{% endchunked_table %}'
+            '{% for part in types|chunked:1 %}{{ part|length }}{% endfor %}')
+        output = template.render({'types': queryset})
+        self.assertIsNone(queryset._result_cache)
+        models = [t.model for t in queryset]
+        self.assertTrue(output.split('</style>', 1)[1].startswith(
+            '<table class="wkhtmltopdf-chunk"><thead></thead><tbody>{0},'
+            '</tbody></table>'.format(
+                ','.join(models))))
+        self.assertTrue(output.endswith('1' * len(models)))
+
+        with self.assertRaises(TemplateSyntaxError):
+            engines['django'].from_string(
+                '{% load wkhtmltopdf %}{% chunked_table items size=2 as i %}'
+                '{% rows %}{% endchunked_table %}')
+
+    def test_minifier(self):
+        """Comments and whitespace should go, preformatted content stay."""
+        content = (
+            '<html>\n  <head>\n    <!-- debug\n      markup -->\n'
+            '    <style>\n  td  { color: red }\n</style>\n  </head>\n'
+            '  <body>\n    <pre class="code">\n  a    b\n</pre>\n'
+            '    <p>Some     text\u00a0\u00a0here</p>\n'
+            '    <p  title="a  >  b\n  c"\n data-x=\'  d \'>  "e  f"</p>\n'
+            '    <textarea\n name="t">  c\n   d </textarea >\n'
+            '    <script>if (a < b) { s = "<!-- -->  "; }</script>\n'
+            + '    <tr>\n      <td>1</td>\n    </tr>\n' * 100 +
+            '  </body>\n</html>\n')
+        expected = (
+            '<html>\n<head>\n\n'
+            '<style>\n  td  { color: red }\n</style>\n</head>\n'
+            '<body>\n<pre class="code">\n  a    b\n</pre>\n'
+            '<p>Some text\u00a0\u00a0here</p>\n'
+            '<p title="a  >  b\n  c"\ndata-x=\'  d \'> "e f"</p>\n'
+            '<textarea\n name="t">  c\n   d </textarea >\n'
+            '<script>if (a < b) { s = "<!-- -->  "; }</script>\n'
+            + '<tr>\n<td>1</td>\n</tr>\n' * 100 +
+            '</body>\n</html>\n')
+
+        class File(list):
+            write = list.append
+
+        # The output doesn't depend on where the document is cut.
+        for buffer_size, step in ((64 * 1024, 1000), (40, 7), (20, 1)):
+            output = File()
+            writer = ContentWriter(output, filters=[Minifier()],
+                                   buffer_size=buffer_size)
+            for i in range(0, len(content), step):
+                writer.write(content[i:i + step])
+            writer.close()
+            self.assertEqual(b''.join(output).decode(), expected)
+
+        template = engines['django'].from_string(content)
+        with override_settings(WKHTMLTOPDF_MINIFY=True):
+            self.assertIsInstance(content_filters()[-1], Minifier)
+            rendered = render_to_temporary_file(template, {})
+        with rendered:
+            rendered.seek(0)
+            self.assertEqual(rendered.read().decode(), expected)
+
+    def test_optimize_images(self):
+        """Local images should be resized to their displayed size."""
+        from PIL import Image
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        Image.new('RGB', (2400, 1600), 'red').save(
+            os.path.join(media_root, 'photo.jpg'))
+        Image.new('RGB', (100, 100), 'blue').save(
+            os.path.join(media_root, 'small.png'))
+        # Stored as 800x1200 and displayed as 1200x800 by a rotation.
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new('RGB', (800, 1200), 'green').save(
+            os.path.join(media_root, 'rotated.jpg'), exif=exif)
+        cache_dir = os.path.join(media_root, 'cache')
+        content = ('<img src="/media/photo.jpg" width="300">\n'
+                   '<img src="/media/small.png">\n'
+                   '<img src="/media/missing.jpg" width="10">\n'
+                   '<img src="/media/rotated.jpg" width="300" height="200">')
+
+        with override_settings(MEDIA_ROOT=media_root, MEDIA_URL='/media/'):
+            content = make_absolute_paths(content)
+            self.assertEqual(content_filters(), [make_absolute_paths])
+            with override_settings(WKHTMLTOPDF_IMAGE_OPTIMIZATION={
+                    'cache_dir': cache_dir, 'dpi': 192}):
+                self.assertEqual(content_filters()[-1], optimize_images)
+                self.assertEqual(content_filters(images=False),
+                                 [make_absolute_paths])
+                optimized = optimize_images(content)
+                self.assertEqual(optimize_images(content), optimized)
+
+        lines = optimized.splitlines()
+        self.assertTrue(lines[0].startswith('<img src="file://' + cache_dir))
+        path = lines[0].split('"')[1][len('file://'):]
+        with Image.open(path) as image:
+            self.assertEqual(image.size, (600, 400))
+        self.assertEqual(lines[1:3], content.splitlines()[1:3])
+        path = lines[3].split('"')[1][len('file://'):]
+        with Image.open(path) as image:
+            self.assertEqual(image.size, (600, 400))
+        self.assertEqual(sum(len(files) for root, dirs, files
+                             in os.walk(cache_dir)), 2)
+
     def _render_file(self, template, context):
         """Helper method for testing rendered file deleted/persists tests."""
         render = RenderedFile(template=template, context=context)
@@ -157,6 +1253,198 @@ class TestUtils(TestCase):
         self.assertTrue(pdf_content.startswith(b'%PDF-'))
         self.assertTrue(pdf_content.endswith(b'%%EOF\n'))
 
+    def test_split_chunks(self):
+        self.assertEqual(split_chunks(range(7), 3), [[0, 1, 2], [3, 4], [5, 6]])
+        self.assertEqual(split_chunks(range(2), 4), [[0], [1]])
+        self.assertEqual(split_chunks([], 4), [[]])
+
+    def test_render_chunked_pdf(self):
+        """chunk_key should convert the document in parallel parts."""
+        result = render_pdf_from_template('sample.html',
+                                          header_template=None,
+                                          footer_template='footer.html',
+                                          context={'title': 'Rows',
+                                                   'rows': range(10)},
+                                          chunk_key='rows', chunks=3,
+                                          result=True)
+        self.assertTrue(result.content.startswith(b'%PDF-'))
+        self.assertEqual(len(result.args), 3)
+        self.assertNotIn('--page-offset', result.args[0])
+        for args in result.args[1:]:
+            self.assertIn('--page-offset', args)
+        self.assertEqual(result.page_count, 3)
+
+    def test_single_flight(self):
+        """Concurrent calls with the same key should run once."""
+        calls = []
+        results = []
+
+        def render():
+            calls.append(1)
+            time.sleep(0.2)
+            return b'%PDF-'
+
+        flight = SingleFlight()
+        threads = [threading.Thread(target=lambda: results.append(
+                       flight.do('key', render))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b'%PDF-'] * 5)
+
+        # Errors are shared too, and the key is released afterwards.
+        def fail():
+            raise ValueError
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        self.assertEqual(flight.do('key', render), b'%PDF-')
+
+    def test_coalesce_across_processes(self):
+        """With a cache, late callers should reuse the shared result."""
+        calls = []
+
+        def render():
+            calls.append(1)
+            return b'%PDF-'
+
+        config = dict(DEFAULTS, cache='default')
+        self.assertEqual(coalesce('cross-process', render, config), b'%PDF-')
+        self.assertEqual(coalesce('cross-process', render, config), b'%PDF-')
+        self.assertEqual(len(calls), 1)
+
+    def _wait_queued(self, scheduler, priority, count=1):
+        while scheduler.queued(priority) < count:
+            time.sleep(0.01)
+
+    def test_scheduler_priorities(self):
+        """Queued interactive renders should start before queued bulk ones."""
+        scheduler = Scheduler(slots=1, priorities=[INTERACTIVE, BULK])
+        order = []
+        release = threading.Event()
+
+        def render(priority, name, hold=None):
+            with scheduler.slot(priority):
+                order.append(name)
+                if hold:
+                    hold.wait()
+
+        first = threading.Thread(target=render, args=(BULK, 'first', release))
+        first.start()
+        while scheduler.running < 1:
+            time.sleep(0.01)
+        bulk = threading.Thread(target=render, args=(BULK, 'bulk'))
+        bulk.start()
+        self._wait_queued(scheduler, BULK)
+        with render_priority(INTERACTIVE):
+            interactive = threading.Thread(target=propagate(render),
+                                           args=(None, 'interactive'))
+        interactive.start()
+        self._wait_queued(scheduler, INTERACTIVE)
+
+        release.set()
+        for thread in (first, bulk, interactive):
+            thread.join()
+        self.assertEqual(order, ['first', 'interactive', 'bulk'])
+        self.assertEqual(scheduler.running, 0)
+
+    def test_scheduler_quotas(self):
+        scheduler = Scheduler(slots=2, priorities=[INTERACTIVE, BULK],
+                              quotas={BULK: 1})
+        release = threading.Event()
+
+        def render():
+            with scheduler.slot(BULK):
+                release.wait()
+
+        threads = [threading.Thread(target=render) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        self._wait_queued(scheduler, BULK)
+        # The second bulk render waits although a slot is free...
+        self.assertEqual(scheduler.running, 1)
+        # ...which an interactive render can use.
+        with scheduler.slot(INTERACTIVE):
+            self.assertEqual(scheduler.running, 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        with self.assertRaises(ValueError):
+            with scheduler.slot('urgent'):
+                pass
+
+    def test_shared_scheduler(self):
+        """Slots should be shared with other processes, and interactive
+        renders should take them before bulk ones."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        scheduler = SharedScheduler(slots=1, priorities=[INTERACTIVE, BULK],
+                                    directory=directory, poll_interval=0.01)
+        # Another process, e.g. a management command, holds the only slot.
+        holder = subprocess.Popen(
+            [sys.executable, '-c',
+             'import fcntl, os, sys\n'
+             'fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT)\n'
+             'fcntl.flock(fd, fcntl.LOCK_EX)\n'
+             'print("locked", flush=True)\n'
+             'sys.stdin.read()\n',
+             os.path.join(directory, 'slot-0.lock')],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEqual(holder.stdout.readline(), b'locked\n')
+        order = []
+
+        def render(priority):
+            with scheduler.slot(priority):
+                order.append(priority)
+
+        threads = []
+        for priority in (BULK, INTERACTIVE):
+            threads.append(threading.Thread(target=render, args=(priority,)))
+            threads[-1].start()
+            self._wait_queued(scheduler, priority)
+        time.sleep(0.1)
+        self.assertEqual(order, [])
+
+        holder.stdin.close()
+        holder.wait()
+        holder.stdout.close()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [INTERACTIVE, BULK])
+        self.assertEqual(scheduler.running, 0)
+
+        with override_settings(WKHTMLTOPDF_SCHEDULER={'directory': directory}):
+            self.assertIsInstance(get_scheduler(), SharedScheduler)
+            pdf = render_pdf_from_template('sample.html', None, None,
+                                           context={'title': 'Shared'})
+            self.assertTrue(pdf.startswith(b'%PDF-'))
+
+    def test_scheduled_wkhtmltopdf(self):
+        with override_settings(WKHTMLTOPDF_SCHEDULER={'slots': 1}):
+            scheduler = get_scheduler()
+            self.assertEqual(scheduler.slots, 1)
+            self.assertEqual(scheduler.default, BULK)
+            pdf = render_pdf_from_template('sample.html', None, None,
+                                           context={'title': 'Scheduled'})
+            self.assertTrue(pdf.startswith(b'%PDF-'))
+            self.assertEqual(scheduler.running, 0)
+        self.assertIsNone(get_scheduler())
+
+    def test_render_key(self):
+        template = loader.get_template('sample.html')
+        first = render_to_temporary_file(template, context={'title': 'A'})
+        second = render_to_temporary_file(template, context={'title': 'B'})
+        try:
+            key = render_key([first.name, None], {'title': 'x'})
+            self.assertEqual(key, render_key([first.name, None], {'title': 'x'}))
+            self.assertNotEqual(key, render_key([second.name, None], {'title': 'x'}))
+            self.assertNotEqual(key, render_key([None, first.name], {'title': 'x'}))
+            self.assertNotEqual(key, render_key([first.name, None], {}))
+        finally:
+            first.close()
+            second.close()
+
     @override_settings(STATIC_URL='/static/', STATIC_ROOT='path/to/some/dir')
     def test_make_absolute_paths(self):
         """
@@ -248,6 +1536,18 @@ class TestViews(TestCase):
                                content_type='application/x-pdf')
         self.assertEqual(response['Content-Type'], 'application/x-pdf')
 
+        # PDFResult content is used without copying.
+        result = PDFResult(args=[], returncode=0, duration=0,
+                           content=content)
+        response = PDFResponse(content=result)
+        self.assertIs(response.pdf_result, result)
+        self.assertIs(response._container[0], content)
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(response.content, content)
+        self.assertEqual(b''.join(response), content)
+        response.content = b'%PDF'
+        self.assertFalse(response.has_header('Content-Length'))
+
     def test_pdf_template_response(self, show_content=False):
         """Test PDFTemplateResponse."""
 
@@ -309,7 +1609,76 @@ class TestViews(TestCase):
 
         pdf_content = response.rendered_content
         title = '\0'.join(cmd_options['title'])
-        self.assertIn(six.b(title), pdf_content)
+        self.assertIn(title.encode('latin-1'), pdf_content)
+
+        # Result object
+        response = PDFTemplateResponse(request=request,
+                                       template=self.template,
+                                       context=context,
+                                       result=True)
+        response.render()
+        self.assertIsInstance(response.pdf_result, PDFResult)
+        self.assertTrue(response.content.startswith(b'%PDF-'))
+
+        # Coalesced
+        with override_settings(WKHTMLTOPDF_COALESCE=True):
+            response = PDFTemplateResponse(request=request,
+                                           template=self.template,
+                                           context=context)
+        self.assertTrue(response.coalesce)
+        self.assertTrue(response.rendered_content.startswith(b'%PDF-'))
+
+    def test_pdf_template_response_thumbnail(self):
+        request = RequestFactory().get('/')
+        response = PDFTemplateResponse(request=request,
+                                       template=self.template,
+                                       context={'title': 'Heading'},
+                                       thumbnail_options={'width': 100})
+        response.render()
+        self.assertTrue(response.content.startswith(b'%PDF-'))
+        self.assertTrue(response.thumbnail.startswith(PNG_SIGNATURE))
+
+        # The PDF is cached, and the thumbnail converted again.
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        with override_settings(WKHTMLTOPDF_CACHE={'location': location}):
+            for i in range(2):
+                response = PDFTemplateResponse(request=request,
+                                               template=self.template,
+                                               context={'title': 'Heading'},
+                                               thumbnail_options={'width': 100},
+                                               cache=True)
+                response.render()
+                self.assertTrue(response.thumbnail.startswith(PNG_SIGNATURE))
+        self.assertTrue(response.pdf_result.path.startswith(location))
+        response.close()
+
+    def test_image_template_response(self):
+        request = RequestFactory().get('/')
+        response = ImageTemplateResponse(request=request,
+                                         template=self.template,
+                                         context={'title': 'Heading'},
+                                         filename='preview.jpg',
+                                         cmd_options={'format': 'jpg'})
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Content-Disposition'],
+                         self.attached_fileheader.format('preview.jpg'))
+        self.assertEqual(ImageResponse(content=b'')['Content-Type'],
+                         'image/png')
+
+    def test_image_template_view(self):
+        view = ImageTemplateView.as_view(template_name=self.template)
+        response = view(RequestFactory().get('/'))
+        response.render()
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Disposition'],
+                         self.attached_fileheader.format('rendered_image.png'))
+        self.assertTrue(response.content.startswith(PNG_SIGNATURE))
+
+        # As HTML
+        response = view(RequestFactory().get('/?as=html'))
+        response.render()
+        self.assertTrue(response.content.startswith(b'<html>'))
 
     def test_pdf_template_response_to_browser(self):
         self.test_pdf_template_response(show_content=True)
@@ -349,9 +1718,77 @@ class TestViews(TestCase):
         response = view(request)
         self.assertEqual(response.status_code, 405)
 
+    @override_settings(
+        WKHTMLTOPDF_METRICS_BACKEND='wkhtmltopdf.tests.tests.RecordingBackend')
+    def test_pdf_template_view_metrics(self):
+        RecordingBackend.calls = []
+        view = PDFTemplateView.as_view(template_name=self.template)
+        view(RequestFactory().get('/')).render()
+        self.assertIn(('observe', metrics.RESPONSE_SECONDS,
+                       {'name': 'wkhtmltopdf.views.PDFTemplateView'}),
+                      RecordingBackend.calls)
+
+    def test_pdf_template_view_engine(self):
+        RecordingEngine.calls = []
+        view = PDFTemplateView.as_view(
+            template_name=self.template,
+            engine='wkhtmltopdf.tests.tests.RecordingEngine')
+        response = view(RequestFactory().get('/'))
+        response.render()
+        self.assertEqual(response.content, b'%PDF-1.4 recording')
+        self.assertEqual(len(RecordingEngine.calls), 1)
+
+        view = PDFTemplateView(template_name=self.template,
+                               engine='wkhtmltopdf.tests.tests.RecordingEngine')
+        view.setup(RequestFactory().get('/'))
+        self.assertEqual(view.get_render_plan().engine, 'recording')
+
     def test_pdf_template_view_to_browser(self):
         self.test_pdf_template_view(show_content=True)
 
+    def test_pdf_template_view_render_plan(self):
+        view = PDFTemplateView(template_name=self.template,
+                               footer_template=self.footer_template,
+                               cmd_options={'title': 'Plan'})
+        view.setup(RequestFactory().get('/'))
+        render_plan = view.get_render_plan(title='Plan')
+        self.assertTrue(render_plan.html_size > 0)
+        self.assertIn('--footer-html', render_plan.args)
+        self.assertEqual(render_plan.args[-2:], [self.template, '-'])
+
+    def test_pdf_template_view_cache(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        view = PDFTemplateView.as_view(template_name=self.template)
+        with override_settings(WKHTMLTOPDF_CACHE={'location': location}):
+            for i in range(2):
+                response = view(RequestFactory().get('/'))
+                response.render()
+                self.assertTrue(response.content.startswith(b'%PDF-'))
+        # The second response is served from the cache file.
+        self.assertIsNotNone(response.pdf_result.mmap)
+        response.pdf_result.close()
+
+    def test_pdf_template_view_jinja2(self):
+        """Test PDFTemplateView with a Jinja2 template."""
+        view = PDFTemplateView.as_view(template_name='invoice.html',
+                                       template_engine='jinja2')
+        request = RequestFactory().get('/')
+        response = view(request, title='Invoice', lines=[])
+        response.render()
+        self.assertTrue(response.content.startswith(b'%PDF-'))
+
+    def test_loadtest(self):
+        """The load test should serve PDFs and clean up its files."""
+        from wkhtmltopdf import loadtest
+
+        results = loadtest.run(clients=2, requests=4, rows=10, footer=True,
+                               delay=0)
+        self.assertEqual(results['errors'], 0, results['first_error'])
+        self.assertEqual(results['leftover_files'], 0)
+        self.assertTrue(results['throughput'] > 0)
+        self.assertTrue(results['p50'] <= results['p95'] <= results['p99'])
+
     def test_pdf_template_view_unicode(self, show_content=False):
         """Test PDFTemplateView with unicode content."""
         view = UnicodeContentPDFTemplateView.as_view(
@@ -454,3 +1891,96 @@ class TestViews(TestCase):
 
     def test_get_context_processor_variables_debug_show_content(self):
         self.test_get_context_processor_variables_debug(show_content=True)
+
+
+class TestCommands(TestCase):
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+
+    def test_render_pdfs(self):
+        stdout = io.StringIO()
+        call_command('render_pdfs', 'sample.html',
+                     'django.contrib.contenttypes.models.ContentType',
+                     self.output, jobs=2, stdout=stdout)
+        pks = ContentType.objects.values_list('pk', flat=True)
+        self.assertTrue(pks)
+        for pk in pks:
+            with open(os.path.join(self.output, '%d.pdf' % pk), 'rb') as f:
+                self.assertTrue(f.read().startswith(b'%PDF'))
+        self.assertIn('Rendered %d PDFs' % len(pks), stdout.getvalue())
+        self.assertIn('PDFs/s', stdout.getvalue())
+
+    def test_render_pdfs_resume(self):
+        """Already rendered PDFs should be skipped."""
+        checkpoint = os.path.join(self.output, '.render_pdfs.checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write('feb.pdf\n')
+
+        stdout = io.StringIO()
+        call_command('render_pdfs', 'sample.html',
+                     'wkhtmltopdf.tests.tests.statements', self.output,
+                     filename='{slug}.pdf', stdout=stdout)
+        self.assertEqual(sorted(os.listdir(self.output)),
+                         ['.render_pdfs.checkpoint', 'jan.pdf', 'mar.pdf'])
+        self.assertIn('Rendered 2 PDFs', stdout.getvalue())
+        self.assertIn('1 skipped', stdout.getvalue())
+        with open(checkpoint) as f:
+            self.assertEqual(sorted(f.read().split()),
+                             ['feb.pdf', 'jan.pdf', 'mar.pdf'])
+
+    def test_render_pdfs_storage(self):
+        """PDFs saved with --storage should replace the previous ones and be
+        checkpointed."""
+        with override_settings(MEDIA_ROOT=self.output):
+            for i in range(2):
+                call_command('render_pdfs', 'sample.html',
+                             'wkhtmltopdf.tests.tests.statements', 'statements',
+                             filename='{slug}.pdf', storage=True,
+                             stdout=io.StringIO())
+        directory = os.path.join(self.output, 'statements')
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['.render_pdfs.checkpoint', 'feb.pdf', 'jan.pdf', 'mar.pdf'])
+        with open(os.path.join(directory, '.render_pdfs.checkpoint')) as f:
+            self.assertEqual(sorted(f.read().split()),
+                             ['feb.pdf', 'jan.pdf', 'mar.pdf'])
+
+        # Existing files are replaced, not saved under a new name.
+        os.remove(os.path.join(directory, '.render_pdfs.checkpoint'))
+        with override_settings(MEDIA_ROOT=self.output):
+            call_command('render_pdfs', 'sample.html',
+                         'wkhtmltopdf.tests.tests.statements', 'statements',
+                         filename='{slug}.pdf', storage=True,
+                         stdout=io.StringIO())
+        self.assertEqual(len(os.listdir(directory)), 4)
+
+    def test_render_pdfs_filename_failure(self):
+        """An object without a file name should fail alone."""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        # 'March' has no seventh letter.
+        self.assertRaisesRegex(
+            CommandError, '1 PDFs failed', call_command, 'render_pdfs',
+            'sample.html', 'wkhtmltopdf.tests.tests.statements', self.output,
+            filename='{title[6]}.pdf', stdout=stdout, stderr=stderr)
+        self.assertIn('no file name for object 2', stderr.getvalue())
+        self.assertEqual(sorted(os.listdir(self.output)),
+                         ['.render_pdfs.checkpoint', 'r.pdf', 'y.pdf'])
+
+    def test_pdf_usage(self):
+        self.assertRaises(CommandError, call_command, 'pdf_usage')
+        database = os.path.join(self.output, 'usage.sqlite3')
+        with override_settings(WKHTMLTOPDF_USAGE={'database': database}):
+            render_pdf_from_template('sample.html', None, None, {})
+            stdout = io.StringIO()
+            call_command('pdf_usage', sort='rss', days=1, stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('sample.html '))
+
+    def test_render_pdfs_failure(self):
+        with override_settings(WKHTMLTOPDF_CMD='false'):
+            self.assertRaisesRegex(
+                CommandError, '3 PDFs failed', call_command, 'render_pdfs',
+                'sample.html', 'wkhtmltopdf.tests.tests.statements',
+                self.output, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(os.listdir(self.output), ['.render_pdfs.checkpoint'])
@@ -0,0 +1,373 @@
+import atexit
+from collections import deque
+import os
+import queue
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+from .diagnostics import logger
+from .signals import setting_changed
+
+DEFAULTS = {
+    # Number of recent runs per template kept in memory.
+    'window': 100,
+    # Path of an SQLite database keeping every run, shared by processes.
+    'database': None,
+    # Days after which runs are deleted from the database.
+    'retention': 30,
+    # Number of recent cost model samples read from the database.
+    'samples': 10000,
+}
+
+# ru_maxrss is in kilobytes, except on macOS where it is in bytes.
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# Keys of ResourceUsage.as_dict(), which the summaries aggregate.
+FIELDS = ('user_time', 'system_time', 'max_rss', 'in_blocks', 'out_blocks')
+
+# Kinds of runs, summarized separately.
+PDF = 'pdf'
+IMAGE = 'image'
+CHROMIUM = 'chromium'
+
+
+class ResourceUsage(object):
+    """
+    Resources used by a child process: CPU seconds in user and system mode,
+    peak resident set size in bytes and blocks read and written by the
+    file system.
+    """
+
+    def __init__(self, user_time=0.0, system_time=0.0, max_rss=0, in_blocks=0,
+                 out_blocks=0):
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.in_blocks = in_blocks
+        self.out_blocks = out_blocks
+
+    @classmethod
+    def from_rusage(cls, rusage):
+        """Returns the usage of a ``resource.struct_rusage``."""
+        return cls(user_time=rusage.ru_utime, system_time=rusage.ru_stime,
+                   max_rss=rusage.ru_maxrss * RSS_UNIT,
+                   in_blocks=rusage.ru_inblock, out_blocks=rusage.ru_oublock)
+
+    @classmethod
+    def total(cls, usages):
+        """
+        Returns the usage of several processes, the largest of their peak
+        RSS and the sum of the rest, or None if any is unknown.
+        """
+        usages = list(usages)
+        if not usages or None in usages:
+            return None
+        return cls(user_time=sum(u.user_time for u in usages),
+                   system_time=sum(u.system_time for u in usages),
+                   max_rss=max(u.max_rss for u in usages),
+                   in_blocks=sum(u.in_blocks for u in usages),
+                   out_blocks=sum(u.out_blocks for u in usages))
+
+    @property
+    def cpu_time(self):
+        return self.user_time + self.system_time
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in FIELDS)
+
+    def __repr__(self):
+        return '<%s cpu=%.3f max_rss=%d>' % (self.__class__.__name__,
+                                             self.cpu_time, self.max_rss)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(runs):
+    """
+    Returns the summary of ``runs``, ``(usage, duration)`` pairs: their
+    count, the mean and 95th percentile of their CPU time, peak RSS and
+    wall time, the largest peak RSS, the mean blocks read and written, and
+    the CPU utilization, CPU time per second of wall time.
+
+    A utilization of 0.5 means a run spends half of its time waiting, e.g.
+    for assets, so about twice as many runs as cores keep the CPUs busy.
+    """
+    runs = list(runs)
+    if not runs:
+        return None
+    count = len(runs)
+    cpu = [usage.cpu_time for usage, duration in runs]
+    rss = [usage.max_rss for usage, duration in runs]
+    wall = [duration for usage, duration in runs]
+    return {
+        'count': count,
+        'cpu_time': sum(cpu) / count,
+        'cpu_time_p95': _percentile(cpu, 0.95),
+        'max_rss': sum(rss) / count,
+        'max_rss_p95': _percentile(rss, 0.95),
+        'max_rss_max': max(rss),
+        'duration': sum(wall) / count,
+        'duration_p95': _percentile(wall, 0.95),
+        'in_blocks': sum(usage.in_blocks for usage, duration in runs) / count,
+        'out_blocks': sum(usage.out_blocks for usage, duration in runs) / count,
+        'cpu_utilization': sum(cpu) / sum(wall) if sum(wall) else 0.0,
+    }
+
+
+def most_expensive(summaries, key='cpu_time', limit=10):
+    """Returns the ``limit`` (label, summary) pairs of ``summaries`` with
+    the largest ``key``."""
+    return sorted(summaries.items(), key=lambda item: item[1][key],
+                  reverse=True)[:limit]
+
+
+class UsageHistory(object):
+    """
+    Thread-safe rolling window of the last runs of each template, by kind
+    of run: wkhtmltopdf (PDF), wkhtmltoimage (IMAGE) or Chromium (CHROMIUM).
+    """
+
+    def __init__(self, window=DEFAULTS['window']):
+        self.window = window
+        self._lock = threading.Lock()
+        self._runs = {}
+
+    def record(self, label, usage, duration, kind=PDF):
+        with self._lock:
+            runs = self._runs.get((kind, label))
+            if runs is None:
+                runs = self._runs[(kind, label)] = deque(maxlen=self.window)
+            runs.append((usage, duration))
+
+    def summary(self, label, kind=PDF):
+        """Returns the summary of the runs of ``label``, see summarize(), or
+        None if there are none."""
+        with self._lock:
+            runs = list(self._runs.get((kind, label), ()))
+        return summarize(runs)
+
+    def as_dict(self, kind=PDF):
+        """Returns the summaries of every template."""
+        with self._lock:
+            runs = dict((label, list(r)) for (run_kind, label), r
+                        in self._runs.items() if run_kind == kind)
+        return dict((label, summarize(r)) for label, r in runs.items())
+
+    def most_expensive(self, key='cpu_time', limit=10, kind=PDF):
+        return most_expensive(self.as_dict(kind), key, limit)
+
+    def reset(self):
+        with self._lock:
+            self._runs.clear()
+
+
+class UsageStore(object):
+    """
+    Runs kept in an SQLite database, so that the processes of a server
+    and its restarts add to the same history. Runs older than
+    ``retention`` days are deleted when the database is opened.
+
+    Runs are written by a background thread, which commits the runs
+    recorded since its last commit at once, so that renders don't wait
+    for the disk.
+    """
+
+    def __init__(self, path, retention=DEFAULTS['retention']):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._connection = None
+        self._queue = None
+        self._writer = None
+        self._pid = None
+
+    def _connect(self):
+        if self._connection is None:
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, '
+                'label TEXT, kind TEXT, finished REAL, duration REAL, '
+                'returncode INTEGER, user_time REAL, system_time REAL, '
+                'max_rss INTEGER, in_blocks INTEGER, out_blocks INTEGER)')
+            connection.execute('CREATE INDEX IF NOT EXISTS runs_finished '
+                               'ON runs (finished)')
+            # Samples of the cost model of render plans, see plan.record().
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, '
+                'finished REAL, html_size INTEGER, assets INTEGER, seconds REAL)')
+            if self.retention:
+                expired = time.time() - self.retention * 86400
+                connection.execute('DELETE FROM runs WHERE finished < ?',
+                                   (expired,))
+                connection.execute('DELETE FROM samples WHERE finished < ?',
+                                   (expired,))
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # The connection and the writer of a parent process can't
+                # be used after a fork.
+                self._connection = None
+                self._queue = queue.Queue()
+                self._writer = threading.Thread(
+                    target=self._write, name='wkhtmltopdf-usage', daemon=True)
+                self._writer.start()
+                self._pid = os.getpid()
+
+    def _write(self):
+        while True:
+            statements = [self._queue.get()]
+            while True:
+                try:
+                    statements.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._lock:
+                    connection = self._connect()
+                    for statement in statements:
+                        if statement is not None:
+                            connection.execute(*statement)
+                    connection.commit()
+            except Exception:
+                logger.exception('Could not write the resource usage of %d '
+                                 'runs to %s.', len(statements), self.path)
+            for statement in statements:
+                self._queue.task_done()
+            if None in statements:
+                return
+
+    def execute(self, query, params):
+        """Queues a write for the background thread."""
+        self._start()
+        self._queue.put((query, params))
+
+    def record(self, label, usage, duration, returncode=0, kind=PDF):
+        self.execute(
+            'INSERT INTO runs (label, kind, finished, duration, returncode, %s) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)' % ', '.join(FIELDS),
+            [label or '', kind, time.time(), duration, returncode] +
+            [getattr(usage, field) for field in FIELDS])
+
+    def record_sample(self, html_size, assets, seconds):
+        """Records a sample of the cost model."""
+        self.execute('INSERT INTO samples (finished, html_size, assets, seconds) '
+                     'VALUES (?, ?, ?, ?)',
+                     [time.time(), html_size, assets, seconds])
+
+    def samples(self, limit=DEFAULTS['samples']):
+        """Returns the last ``limit`` samples of the cost model, as
+        (html_size, assets, seconds) tuples."""
+        self.flush()
+        with self._lock:
+            return self._connect().execute(
+                'SELECT html_size, assets, seconds FROM samples '
+                'ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+
+    def flush(self):
+        """Waits until the recorded runs are written."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def as_dict(self, since=None, kind=PDF):
+        """Returns the summaries of every template, of the runs after the
+        timestamp ``since`` if given."""
+        query = ('SELECT label, duration, %s FROM runs WHERE kind = ?'
+                 % ', '.join(FIELDS))
+        params = [kind]
+        if since is not None:
+            query += ' AND finished >= ?'
+            params.append(since)
+        self.flush()
+        runs = {}
+        with self._lock:
+            for row in self._connect().execute(query, params):
+                runs.setdefault(row[0], []).append(
+                    (ResourceUsage(*row[2:]), row[1]))
+        return dict((label, summarize(r)) for label, r in runs.items())
+
+    def most_expensive(self, key='cpu_time', limit=10, since=None, kind=PDF):
+        return most_expensive(self.as_dict(since, kind), key, limit)
+
+    def close(self):
+        """Writes the recorded runs and closes the database."""
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._writer.join()
+            self._pid = None
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def get_config():
+    """Returns the options of WKHTMLTOPDF_USAGE, merged with DEFAULTS."""
+    config = DEFAULTS.copy()
+    options = getattr(settings, 'WKHTMLTOPDF_USAGE', None)
+    if isinstance(options, dict):
+        config.update(options)
+    return config
+
+
+_history = []
+_store = []
+
+
+def get_history():
+    """Returns the UsageHistory of this process."""
+    if not _history:
+        _history.append(UsageHistory(get_config()['window']))
+    return _history[0]
+
+
+def get_store():
+    """Returns the UsageStore of the ``database`` of WKHTMLTOPDF_USAGE, or
+    None."""
+    if not _store:
+        config = get_config()
+        store = None
+        if config['database']:
+            store = UsageStore(config['database'], config['retention'])
+        _store.append(store)
+    return _store[0]
+
+
+def _close_store():
+    if _store and _store[0] is not None:
+        _store[0].close()
+    del _store[:]
+
+atexit.register(_close_store)
+
+
+def _reset(**kwargs):
+    if kwargs['setting'] == 'WKHTMLTOPDF_USAGE':
+        del _history[:]
+        _close_store()
+
+setting_changed.connect(_reset)
+
+
+def record(label, usage, duration, returncode=0, kind=PDF):
+    """Records a run of the template ``label``."""
+    if usage is None:
+        return
+    get_history().record(label, usage, duration, kind)
+    store = get_store()
+    if store is not None:
+        store.record(label, usage, duration, returncode, kind)
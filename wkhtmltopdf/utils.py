@@ -1,29 +1,38 @@
-from __future__ import absolute_import
-
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from itertools import chain
+import multiprocessing
 import os
 import re
-import sys
 import shlex
 from tempfile import NamedTemporaryFile
+import time
+from timeit import default_timer
 
-from django.utils.encoding import smart_str
-
-try:
-    from urllib.request import pathname2url
-    from urllib.parse import urljoin
-except ImportError:  # Python2
-    from urllib import pathname2url
-    from urlparse import urljoin
+from urllib.parse import urljoin
+from urllib.request import pathname2url
 
-import django
 from django.conf import settings
 from django.template import loader
-from django.template.context import Context, RequestContext
-import six
+from django.template.context import make_context
+from django.utils.encoding import smart_str
 
-from .subprocess import check_output
+from . import coalesce as _coalesce
+from . import metrics
+from . import plan
+from . import profiling
+from . import retry
+from . import scheduler
+from . import usage
+from . import xvfb
+from .cache import get_pdf_cache
+from .diagnostics import logger, parse_stderr, report_events
+from .images import optimize_images
+from .minify import Minifier
+from .pdf import concatenate_pdfs
+from .result import PDFResult
+from .signals import setting_changed
+from .subprocess import CalledProcessError, resolve_executable, spawn
 
 NO_ARGUMENT_OPTIONS = ['--collate', '--no-collate', '-H', '--extended-help', '-g',
                        '--grayscale', '-h', '--help', '--htmldoc', '--license', '-l',
@@ -45,7 +54,10 @@ NO_ARGUMENT_OPTIONS = ['--collate', '--no-collate', '-H', '--extended-help', '-g
                        '--no-stop-slow-scripts', '--disable-toc-back-links',
                        '--enable-toc-back-links', '--footer-line', '--no-footer-line',
                        '--header-line', '--no-header-line', '--disable-dotted-lines',
-                       '--disable-toc-links', '--verbose']
+                       '--disable-toc-links', '--verbose',
+                       # wkhtmltoimage only
+                       '--disable-smart-width', '--enable-smart-width',
+                       '--transparent']
 
 
 def _options_to_args(**options):
@@ -65,16 +77,70 @@ def _options_to_args(**options):
         flags.append(formatted_flag)
         if accepts_no_arguments:
             continue
-        flags.append(six.text_type(value))
+        flags.append(str(value))
     return flags
 
 
-def wkhtmltopdf(pages, output=None, **kwargs):
+_spawn_cache = {}
+
+
+def get_env(display=None):
+    """
+    Returns the environment for the wkhtmltopdf process, or None to inherit
+    ours. The merge of os.environ and WKHTMLTOPDF_ENV is built once.
+
+    display: Optional X display, e.g. from the WKHTMLTOPDF_XVFB pool,
+             overriding DISPLAY.
+    """
+    env = getattr(settings, 'WKHTMLTOPDF_ENV', None)
+    if env is None:
+        if display is None:
+            return None
+        return dict(os.environ, DISPLAY=display)
+    cached = _spawn_cache.get('env')
+    if cached is None or cached[0] is not env:
+        cached = _spawn_cache['env'] = (env, dict(os.environ, **env))
+    if display is not None:
+        return dict(cached[1], DISPLAY=display)
+    return cached[1]
+
+
+def get_command(setting='WKHTMLTOPDF_CMD', default='wkhtmltopdf'):
+    """
+    Returns the command in ``setting`` (or the environment variable of the
+    same name) split into arguments, with the executable resolved to an
+    absolute path. The result is cached per command.
+    """
+    cmd = getattr(settings, setting, os.environ.get(setting, default))
+    try:
+        return _spawn_cache[cmd]
+    except KeyError:
+        args = shlex.split(cmd)
+        if args:
+            args[0] = resolve_executable(args[0])
+        _spawn_cache[cmd] = args
+        return args
+
+
+def _clear_spawn_cache(**kwargs):
+    if kwargs['setting'] in ('WKHTMLTOPDF_ENV', 'WKHTMLTOPDF_CMD',
+                             'WKHTMLTOPDF_FALLBACK_CMD', 'WKHTMLTOIMAGE_CMD'):
+        _spawn_cache.clear()
+
+setting_changed.connect(_clear_spawn_cache)
+
+
+def wkhtmltopdf(pages, output=None, label=None, result=False, dry_run=False, **kwargs):
     """
     Converts html to PDF using http://wkhtmltopdf.org/.
 
     pages: List of file paths or URLs of the html to be converted.
     output: Optional output file path. If None, the output is returned.
+    label: Optional name (usually the template name) used to group the
+           stderr diagnostics of this run.
+    result: If True, return a ``PDFResult`` with the output and metadata
+            of the run instead of bytes (or None when ``output`` is given).
+    dry_run: If True, return the command line without running it.
     **kwargs: Passed to wkhtmltopdf via _extra_args() (See
               https://github.com/antialize/wkhtmltopdf/blob/master/README_WKHTMLTOPDF
               for acceptable args.)
@@ -99,10 +165,11 @@ def wkhtmltopdf(pages, output=None, **kwargs):
                     orientation='Landscape',
                     disable_javascript=True)
     """
-    if isinstance(pages, six.string_types):
+    if isinstance(pages, str):
         # Support a single page.
         pages = [pages]
 
+    path = output
     if output is None:
         # Standard output.
         output = '-'
@@ -119,33 +186,138 @@ def wkhtmltopdf(pages, output=None, **kwargs):
     # Force --encoding utf8 unless the user has explicitly overridden this.
     options.setdefault('encoding', 'utf8')
 
-    env = getattr(settings, 'WKHTMLTOPDF_ENV', None)
-    if env is not None:
-        env = dict(os.environ, **env)
-
-    cmd = 'WKHTMLTOPDF_CMD'
-    cmd = getattr(settings, cmd, os.environ.get(cmd, 'wkhtmltopdf'))
-
     # Adding 'cover' option to add cover_file to the pdf to generate.
     if has_cover:
         pages.insert(0, 'cover')
 
-    ck_args = list(chain(shlex.split(cmd),
+    ck_args = list(chain(get_command(),
                          _options_to_args(**options),
                          list(pages),
                          [output]))
-    ck_kwargs = {'env': env}
-    # Handling of fileno() attr. based on https://github.com/GrahamDumpleton/mod_wsgi/issues/85
-    try:
-        i = sys.stderr.fileno()
-        ck_kwargs['stderr'] = sys.stderr
-    except (AttributeError, IOError):
-        # can't call fileno() on mod_wsgi stderr object
-        pass
+    if dry_run:
+        return ck_args
+
+    fallback_args = None
+    fallback = retry.get_fallback(options)
+    if fallback is not None:
+        fallback_cmd, fallback_options = fallback
+        fallback_args = list(chain(
+            get_command('WKHTMLTOPDF_FALLBACK_CMD') if fallback_cmd else get_command(),
+            _options_to_args(**fallback_options),
+            list(pages),
+            [output]))
+
+    ck_args, (returncode, output, stderr, events, duration, resources) = \
+        _execute_with_retry(ck_args, label, fallback_args)
+    metrics.observe(metrics.PDF_BYTES,
+                    os.path.getsize(path) if path else len(output), label)
+    plan.record(list(pages) + [options.get('header_html'),
+                               options.get('footer_html')], duration)
+
+    if result:
+        return PDFResult(args=ck_args, returncode=returncode,
+                         duration=duration,
+                         content=None if path else output, path=path,
+                         stderr=stderr, events=events, usage=resources)
+    return output
+
+def _execute(ck_args, label=None, kind=usage.PDF):
+    """
+    Runs ``ck_args`` and reports its stderr diagnostics. ``kind`` is the
+    kind of run its resource usage is recorded as.
 
-    return check_output(ck_args, **ck_kwargs)
+    Returns ``(returncode, output, stderr, events, duration, resources)``,
+    where resources is the ResourceUsage of the child, and raises
+    ``CalledProcessError`` if the command failed.
+    """
+    # stderr is captured and parsed rather than inherited, which also
+    # avoids https://github.com/GrahamDumpleton/mod_wsgi/issues/85
+    with scheduler.slot(), metrics.in_flight(label), xvfb.display() as display:
+        start = default_timer()
+        returncode, output, stderr, rusage = spawn(ck_args, env=get_env(display),
+                                                   rusage=True)
+        duration = default_timer() - start
+    metrics.observe(metrics.WALL_SECONDS, duration, label)
+    profiling.record(ck_args, duration, returncode)
+    resources = None
+    if rusage is not None:
+        resources = usage.ResourceUsage.from_rusage(rusage)
+        metrics.observe(metrics.CPU_SECONDS, resources.cpu_time, label)
+        metrics.observe(metrics.MAX_RSS_BYTES, resources.max_rss, label)
+        usage.record(label, resources, duration, returncode, kind)
+
+    events = parse_stderr(stderr)
+    report_events(events, args=ck_args, returncode=returncode, label=label)
+
+    if returncode:
+        metrics.failure(label, returncode)
+        error = CalledProcessError(returncode, ck_args, output=output)
+        error.stderr = stderr
+        error.events = events
+        error.usage = resources
+        raise error
+    return returncode, output, stderr, events, duration, resources
+
+def _execute_with_retry(ck_args, label=None, fallback_args=None, kind=usage.PDF):
+    """
+    Runs ``ck_args`` with _execute(), retrying transient failures with
+    exponential backoff as configured by WKHTMLTOPDF_RETRY. If every attempt
+    fails transiently, ``fallback_args`` are run once instead.
 
-def convert_to_pdf(filename, header_filename=None, footer_filename=None, cmd_options=None, cover_filename=None):
+    Returns the arguments that succeeded and the result of _execute().
+    """
+    config = retry.get_config()
+    for attempt in range(1, config['attempts'] + 1):
+        try:
+            return ck_args, _execute(ck_args, label, kind)
+        except CalledProcessError as error:
+            if not retry.is_transient(error, config):
+                raise
+            last_error = error
+            if attempt < config['attempts']:
+                delay = retry.backoff(attempt, config)
+                logger.warning('wkhtmltopdf exited with code %s, retrying in '
+                               '%.1f seconds.', error.returncode, delay)
+                time.sleep(delay)
+
+    if fallback_args is None:
+        raise last_error
+    logger.warning('wkhtmltopdf exited with code %s, running the fallback '
+                   'command.', last_error.returncode)
+    return fallback_args, _execute(fallback_args, label, kind)
+
+def wkhtmltoimage(page, output=None, label=None, **kwargs):
+    """
+    Converts html to an image using wkhtmltoimage, which ships with
+    wkhtmltopdf.
+
+    page: File path or URL of the html to be converted.
+    output: Optional output file path. If None, the image is returned.
+    label: Optional name used to group the stderr diagnostics of this run.
+    **kwargs: Passed to wkhtmltoimage as arguments, as for wkhtmltopdf().
+              Defaults to WKHTMLTOIMAGE_CMD_OPTIONS, or
+              {'quiet': True, 'format': 'png'}.
+
+    example usage:
+        wkhtmltoimage(page='/tmp/example.html', width=320, format='jpg')
+    """
+    options = getattr(settings, 'WKHTMLTOIMAGE_CMD_OPTIONS', None)
+    if options is None:
+        options = {'quiet': True, 'format': 'png'}
+    else:
+        options = copy(options)
+    options.update(kwargs)
+    options.setdefault('encoding', 'utf8')
+
+    ck_args = list(chain(get_command('WKHTMLTOIMAGE_CMD', 'wkhtmltoimage'),
+                         _options_to_args(**options),
+                         [page, output or '-']))
+    ck_args, (returncode, output, stderr, events, duration, resources) = \
+        _execute_with_retry(ck_args, label, kind=usage.IMAGE)
+    return output
+
+def convert_to_pdf(filename, header_filename=None, footer_filename=None, cmd_options=None, cover_filename=None,
+                   label=None, result=False, dry_run=False):
     # Clobber header_html and footer_html only if filenames are
     # provided. These keys may be in self.cmd_options as hardcoded
     # static files.
@@ -162,7 +334,8 @@ def convert_to_pdf(filename, header_filename=None, footer_filename=None, cmd_opt
         cmd_options['header_html'] = header_filename
     if footer_filename is not None:
         cmd_options['footer_html'] = footer_filename
-    return wkhtmltopdf(pages=pages, **cmd_options)
+    return wkhtmltopdf(pages=pages, label=label, result=result,
+                       dry_run=dry_run, **cmd_options)
 
 class RenderedFile(object):
     """
@@ -190,50 +363,334 @@ class RenderedFile(object):
             self.temporary_file.close()
 
 def render_pdf_from_template(input_template, header_template, footer_template, context, request=None, cmd_options=None,
-    cover_template=None):
+    cover_template=None, result=False, chunk_key=None, chunks=None, coalesce=False, using=None,
+    cache=None, engine=None):
     # For basic usage. Performs all the actions necessary to create a single
     # page PDF from a single template and context.
-    cmd_options = cmd_options if cmd_options else {}
-
-    header_filename = footer_filename = None
-
-    # Main content.
-    input_file = RenderedFile(
-        template=input_template,
-        context=context,
-        request=request
-    )
-
-    # Optional. For header template argument.
-    if header_template:
-        header_file = RenderedFile(
-            template=header_template,
+    # Template names are looked up in the template engine named using, or in
+    # all engines.
+    # If chunk_key is given, context[chunk_key] is split into chunks documents
+    # which are converted in parallel. See render_chunked_pdf_from_template.
+    # If coalesce is True, concurrent calls rendering identical HTML with the
+    # same options share a single wkhtmltopdf run.
+    # cache is a PDFCache, or True for the one configured by WKHTMLTOPDF_CACHE,
+    # keeping the PDFs of identical HTML and options.
+    # engine names the conversion engine, see wkhtmltopdf.engines.get_engine;
+    # by default the one configured for the template.
+    with profiling.profile(template_name(input_template)):
+        cmd_options = cmd_options if cmd_options else {}
+
+        if chunk_key is not None:
+            return render_chunked_pdf_from_template(
+                input_template, header_template, footer_template, context,
+                chunk_key=chunk_key, chunks=chunks, request=request,
+                cmd_options=cmd_options, cover_template=cover_template,
+                result=result, using=using, coalesce=coalesce, cache=cache,
+                engine=engine)
+
+        input_template, header_template, footer_template, cover_template = [
+            resolve_template(template, using) for template in
+            (input_template, header_template, footer_template, cover_template)]
+
+        # Main content.
+        input_file = RenderedFile(
+            template=input_template,
             context=context,
             request=request
         )
-        header_filename = header_file.filename
+        # Optional header, footer and cover templates.
+        header_file, footer_file, cover = [
+            _render_optional(template, context, request)
+            for template in (header_template, footer_template, cover_template)]
+        header_filename = header_file.filename if header_file else None
+        footer_filename = footer_file.filename if footer_file else None
+        cover_filename = cover.filename if cover else None
+        filenames = [input_file.filename, header_filename, footer_filename, cover_filename]
+
+        engine = _get_engine(engine, input_template)
+
+        def convert():
+            return engine.convert(filename=input_file.filename,
+                                  header_filename=header_filename,
+                                  footer_filename=footer_filename,
+                                  cmd_options=cmd_options,
+                                  cover_filename=cover_filename,
+                                  label=template_name(input_template),
+                                  result=result)
+
+        return _convert_once(convert, filenames, _key_options(engine, cmd_options),
+                             cache=cache, coalesce=coalesce, result=result)
+
+def _get_engine(engine, template):
+    """Returns the engine ``engine``, or the one configured for ``template``."""
+    from .engines import get_engine
+    return get_engine(engine, template_name(template))
+
+def _key_options(engine, cmd_options):
+    """Returns what identifies the options of a conversion by ``engine``."""
+    from .engines import WKHTMLTOPDF
+    if engine.name == WKHTMLTOPDF:
+        return cmd_options
+    return dict(cmd_options, engine=engine.name)
+
+def _convert_once(convert, filenames, key_options, cache=None, coalesce=False,
+                  result=False):
+    """
+    Returns ``convert()``, a conversion of the rendered files ``filenames``
+    with the options ``key_options``, or the PDF ``cache`` keeps for them.
 
-    # Optional. For footer template argument.
-    if footer_template:
-        footer_file = RenderedFile(
-            template=footer_template,
-            context=context,
-            request=request
-        )
-        footer_filename = footer_file.filename
-    cover = None
-    if cover_template:
-        cover = RenderedFile(
-            template=cover_template,
-            context=context,
-            request=request
-        )
+    cache is a PDFCache, or True for the one configured by WKHTMLTOPDF_CACHE.
+    If coalesce is True, concurrent calls for identical files and options
+    share a single conversion.
+    """
+    if cache is True:
+        cache = get_pdf_cache()
+    if cache:
+        cache_key = _coalesce.render_key(filenames, key_options)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if result:
+                return cached
+            try:
+                return cached.content
+            finally:
+                cached.close()
+
+    def run():
+        pdf = convert()
+        if cache:
+            cache.set(cache_key, pdf)
+        return pdf
+
+    if not coalesce:
+        return run()
+    key = _coalesce.render_key(filenames, dict(key_options, result=result))
+    return _coalesce.coalesce(key, run)
+
+def plan_pdf_from_template(input_template, header_template, footer_template, context, request=None,
+                           cmd_options=None, cover_template=None, using=None, engine=None):
+    """
+    Returns a ``RenderPlan`` of what render_pdf_from_template() would do
+    with the same arguments, without running wkhtmltopdf.
 
-    return convert_to_pdf(filename=input_file.filename,
-                          header_filename=header_filename,
-                          footer_filename=footer_filename,
-                          cmd_options=cmd_options,
-                          cover_filename=cover.filename if cover else None)
+    The templates are rendered and filtered to measure the HTML and count
+    the assets it references, but nothing is written to disk. The engine
+    is chosen as by render_pdf_from_template(); runs of other engines than
+    wkhtmltopdf have no command line or predicted time.
+    """
+    cmd_options = dict(cmd_options) if cmd_options else {}
+    templates = [resolve_template(template, using) for template in
+                 (input_template, header_template, footer_template, cover_template)]
+
+    stats = plan.HTMLStats()
+    for template in templates:
+        if template:
+            # Image references are counted the same, resized or not.
+            writer = ContentWriter(stats, filters=content_filters(images=False))
+            for chunk in iter_render(template, context, request):
+                writer.write(chunk)
+            writer.close()
+
+    from .engines import WKHTMLTOPDF
+    engine = _get_engine(engine, templates[0])
+    if engine.name != WKHTMLTOPDF:
+        return plan.RenderPlan(args=None, html_size=stats.size, assets=stats.assets,
+                               engine=engine.name)
+
+    names = [(template_name(template) or '<string>') if template else None
+             for template in templates]
+    args = convert_to_pdf(filename=names[0], header_filename=names[1],
+                          footer_filename=names[2], cmd_options=cmd_options,
+                          cover_filename=names[3], dry_run=True)
+    model = plan.get_cost_model()
+    predicted = None
+    if model is not None:
+        predicted = model.predict(stats.size, sum(stats.assets.values()))
+    return plan.RenderPlan(args=args, html_size=stats.size, assets=stats.assets,
+                           predicted_seconds=predicted, engine=engine.name)
+
+def _render_optional(template, context, request=None):
+    """Returns a RenderedFile for ``template``, or None if it is empty."""
+    if not template:
+        return None
+    return RenderedFile(template=template, context=context, request=request)
+
+def render_image_from_template(input_template, context, request=None, cmd_options=None, using=None):
+    # Renders a template to an image with wkhtmltoimage.
+    cmd_options = cmd_options if cmd_options else {}
+    input_template = resolve_template(input_template, using)
+    input_file = RenderedFile(template=input_template, context=context,
+                              request=request)
+    return wkhtmltoimage(page=input_file.filename,
+                         label=template_name(input_template), **cmd_options)
+
+def render_pdf_and_image_from_template(input_template, header_template, footer_template, context, request=None,
+                                       cmd_options=None, image_options=None, cover_template=None,
+                                       using=None, result=False, coalesce=False, cache=None,
+                                       engine=None):
+    """
+    Renders a template once and converts it to both a PDF and an image,
+    e.g. a thumbnail or preview.
+
+    Both conversions read the same rendered HTML file and run in parallel.
+    Returns a ``(pdf, image)`` tuple of bytes, with a PDFResult for the PDF
+    if ``result`` is True. The PDF is converted by ``engine`` and may come
+    from ``cache``, as in render_pdf_from_template(); the image is always
+    converted by wkhtmltoimage. With ``coalesce``, concurrent identical
+    calls share both conversions.
+    """
+    cmd_options = cmd_options if cmd_options else {}
+    image_options = image_options if image_options else {}
+    input_template, header_template, footer_template, cover_template = [
+        resolve_template(template, using) for template in
+        (input_template, header_template, footer_template, cover_template)]
+    label = template_name(input_template)
+
+    input_file = RenderedFile(template=input_template, context=context,
+                              request=request)
+    header_file, footer_file, cover = [
+        _render_optional(template, context, request)
+        for template in (header_template, footer_template, cover_template)]
+    filenames = [input_file.filename] + [
+        rendered.filename if rendered else None
+        for rendered in (header_file, footer_file, cover)]
+    engine = _get_engine(engine, input_template)
+    key_options = _key_options(engine, cmd_options)
+
+    def convert_pdf():
+        return engine.convert(filename=filenames[0], header_filename=filenames[1],
+                              footer_filename=filenames[2], cmd_options=cmd_options,
+                              cover_filename=filenames[3], label=label,
+                              result=result)
+
+    def convert():
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            pdf = pool.submit(scheduler.propagate(_convert_once), convert_pdf,
+                              filenames, key_options, cache=cache, result=result)
+            image = pool.submit(scheduler.propagate(wkhtmltoimage),
+                                page=input_file.filename,
+                                label=label, **image_options)
+            return pdf.result(), image.result()
+
+    if not coalesce:
+        return convert()
+    key = _coalesce.render_key(filenames, dict(key_options, result=result,
+                                               image_options=image_options))
+    return _coalesce.coalesce(key, convert)
+
+def split_chunks(sequence, chunks):
+    """Splits ``sequence`` into at most ``chunks`` contiguous lists."""
+    sequence = list(sequence)
+    chunks = max(1, min(chunks, len(sequence)))
+    size, extra = divmod(len(sequence), chunks)
+    parts, start = [], 0
+    for i in range(chunks):
+        end = start + size + (1 if i < extra else 0)
+        parts.append(sequence[start:end])
+        start = end
+    return parts
+
+def render_chunked_pdf_from_template(input_template, header_template, footer_template, context, chunk_key,
+                                     chunks=None, request=None, cmd_options=None, cover_template=None,
+                                     result=False, using=None, coalesce=False, cache=None, engine=None):
+    """
+    Renders a large document as several smaller ones in parallel.
+
+    ``context[chunk_key]`` is split into ``chunks`` parts (by default one per
+    CPU) and ``input_template`` is rendered once per part, with ``chunk_key``
+    set to the part and ``chunk_index``/``chunk_count`` added to the context.
+    Each part is converted by its own wkhtmltopdf process, so memory use per
+    process stays bounded, and the PDFs are concatenated.
+
+    When there is a header or footer, the parts are converted a second time
+    with ``--page-offset`` so that ``[page]`` numbers run across the whole
+    document. ``[topage]`` still refers to the last page of each part.
+
+    Each part is converted by ``engine``, and the whole document may come
+    from ``cache`` or be shared with ``coalesce``, as in
+    render_pdf_from_template().
+    """
+    cmd_options = cmd_options if cmd_options else {}
+    if chunks is None:
+        chunks = multiprocessing.cpu_count()
+    parts = split_chunks(context[chunk_key], chunks)
+    # Look the templates up once rather than once per part.
+    input_template, header_template, footer_template, cover_template = [
+        resolve_template(template, using) for template in
+        (input_template, header_template, footer_template, cover_template)]
+    label = template_name(input_template)
+    start = default_timer()
+
+    # Templates are rendered in this thread, only the conversions run in
+    # parallel.
+    input_files = []
+    for index, part in enumerate(parts):
+        part_context = dict(context)
+        part_context.update({chunk_key: part, 'chunk_index': index,
+                             'chunk_count': len(parts)})
+        input_files.append(RenderedFile(template=input_template,
+                                        context=part_context,
+                                        request=request))
+
+    header_file, footer_file, cover = [
+        _render_optional(template, context, request)
+        for template in (header_template, footer_template, cover_template)]
+    header_filename = header_file.filename if header_file else None
+    footer_filename = footer_file.filename if footer_file else None
+    cover_filename = cover.filename if cover else None
+
+    base_offset = int(cmd_options.get('page_offset') or 0)
+    engine = _get_engine(engine, input_template)
+
+    @scheduler.propagate
+    def convert(index, page_offset=None):
+        options = cmd_options.copy()
+        if page_offset:
+            options['page_offset'] = page_offset
+        pdf = engine.convert(filename=input_files[index].filename,
+                             header_filename=header_filename,
+                             footer_filename=footer_filename,
+                             cmd_options=options,
+                             cover_filename=cover_filename if index == 0 else None,
+                             label=label, result=True)
+        if not isinstance(pdf, PDFResult):
+            pdf = PDFResult(args=None, returncode=0, duration=0, content=pdf)
+        return pdf
+
+    def convert_all():
+        with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+            results = list(pool.map(convert, range(len(parts))))
+
+            if (header_filename or footer_filename) and len(parts) > 1:
+                offsets, offset = [], base_offset
+                for part_result in results:
+                    offsets.append(offset)
+                    offset += part_result.page_count
+                results[1:] = pool.map(convert, range(1, len(parts)), offsets[1:])
+
+        content = concatenate_pdfs([r.content for r in results])
+        if result:
+            return PDFResult(args=[r.args for r in results], returncode=0,
+                             duration=default_timer() - start, content=content,
+                             stderr=b''.join(r.stderr for r in results),
+                             events=chain.from_iterable(r.events for r in results),
+                             usage=usage.ResourceUsage.total(r.usage for r in results))
+        return content
+
+    filenames = [input_file.filename for input_file in input_files] + [
+        header_filename, footer_filename, cover_filename]
+    return _convert_once(convert_all, filenames, _key_options(engine, cmd_options),
+                         cache=cache, coalesce=coalesce, result=result)
+
+def template_name(template):
+    """Returns the name of ``template``, whether a name or a Template."""
+    if isinstance(template, str):
+        return template
+    if isinstance(template, (list, tuple)):
+        return template[0] if template else None
+    # Backend templates wrap the engine's own template object.
+    template = getattr(template, 'template', template)
+    return getattr(template, 'name', None)
 
 def content_disposition_filename(filename):
     """
@@ -256,7 +713,7 @@ def http_quote(string):
     valid ascii charset string you can use in, say, http headers and the
     like.
     """
-    if isinstance(string, six.text_type):
+    if isinstance(string, str):
         try:
             import unidecode
         except ImportError:
@@ -298,52 +755,193 @@ def make_absolute_paths(content):
             root += '/'
 
         occur_pattern = '''(["|']{0}.*?["|'])'''
-        occurences = re.findall(occur_pattern.format(x['url']), content)
-        occurences = list(set(occurences))  # Remove dups
-        for occur in occurences:
-            content = content.replace(occur, '"%s"' % (
-                                      pathname2fileurl(root) +
-                                      occur[1 + len(x['url']): -1]))
+        fileurl = pathname2fileurl(root)
+        # A single pass, rather than one str.replace() per distinct URL.
+        content = re.sub(occur_pattern.format(x['url']),
+                         lambda match: '"%s"' % (
+                             fileurl + match.group(0)[1 + len(x['url']): -1]),
+                         content)
 
 
     return content
 
+def content_filters(images=True):
+    """
+    Returns the functions applied to the rendered HTML before it is written,
+    in order. Each takes and returns a piece of the document.
+
+    ``images=False`` leaves out optimize_images(), which writes resized
+    copies of the images.
+    """
+    filters = [make_absolute_paths]
+    if images and getattr(settings, 'WKHTMLTOPDF_IMAGE_OPTIMIZATION', None):
+        filters.append(optimize_images)
+    if getattr(settings, 'WKHTMLTOPDF_MINIFY', False):
+        # A new Minifier per document, since it keeps state between pieces.
+        filters.append(Minifier())
+    return filters
+
+class ContentWriter(object):
+    """
+    Writes rendered HTML to a binary ``file`` in pieces of about
+    ``buffer_size`` characters, passing each piece through ``filters``.
+
+    Pieces end after a newline where possible, or else after a tag, so that
+    filters matching within a line, like make_absolute_paths(), see whole
+    attribute values. Memory use doesn't depend on the document size.
+
+    Filters that keep state between pieces, like minify.Minifier, may have a
+    ``flush()`` method returning what they held back, called on close().
+    """
+
+    def __init__(self, file, filters=(), buffer_size=64 * 1024):
+        self.file = file
+        self.filters = list(filters)
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+        self.write_seconds = 0
+
+    def write(self, chunk):
+        # Plain str: Jinja2's Markup escapes strings added to it.
+        chunk = str(smart_str(chunk))
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+        if self.pending_size < self.buffer_size:
+            return
+
+        buffer = ''.join(self.pending)
+        start = 0
+        # Work through large chunks by offset, copying one piece at a time.
+        while len(buffer) - start >= self.buffer_size:
+            end = start + self.buffer_size
+            cut = buffer.rfind('\n', start, end)
+            if cut < 0:
+                cut = buffer.rfind('>', start, end)
+            end = cut + 1 if cut >= 0 else end
+            self._write(buffer[start:end])
+            start = end
+        rest = buffer[start:]
+        self.pending = [rest] if rest else []
+        self.pending_size = len(rest)
+
+    def close(self):
+        """Writes what is left in the buffer and in the filters."""
+        if self.pending:
+            self._write(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+        # What a filter held back still goes through the filters after it.
+        tail = ''
+        for content_filter in self.filters:
+            if tail:
+                tail = content_filter(tail)
+            flush = getattr(content_filter, 'flush', None)
+            if flush is not None:
+                tail += flush()
+        if tail:
+            self._output(tail)
+
+    def _write(self, piece):
+        for content_filter in self.filters:
+            piece = content_filter(piece)
+        self._output(piece)
+
+    def _output(self, piece):
+        start = default_timer()
+        self.file.write(piece.encode('utf-8'))
+        self.write_seconds += default_timer() - start
+
+def resolve_template(template, using=None):
+    """
+    Returns the Template for ``template``, a name, list of names or Template,
+    from the template engine named ``using`` or the first one that has it.
+    Engines keep their compiled templates, so repeated lookups are cheap.
+    """
+    if isinstance(template, (list, tuple)):
+        return loader.select_template(template, using=using)
+    if isinstance(template, str) and template:
+        return loader.get_template(template, using=using)
+    return template
+
+def iter_render(template, context, request=None, using=None):
+    """
+    Renders ``template``, a name, list of names or Template, and yields the
+    output in chunks.
+
+    Templates of other engines can provide a ``stream(context, request)``
+    method returning an iterable of strings. Jinja2 templates are rendered
+    with generate(), Django templates one top-level node at a time. Other
+    templates are rendered as a whole.
+    """
+    template = resolve_template(template, using)
+    stream = getattr(template, 'stream', None)
+    if stream is not None:
+        return iter(stream(context, request))
+
+    engine_template = getattr(template, 'template', None)
+    if hasattr(engine_template, 'generate'):
+        return _iter_jinja2(template, context, request)
+    if hasattr(engine_template, 'nodelist'):
+        return _iter_django(template, context, request)
+    return iter([template.render(context, request)])
+
+def _iter_jinja2(template, context, request):
+    # Prepares the context like django.template.backends.jinja2.Template.
+    context = dict(context or {})
+    if request is not None:
+        from django.template.backends.utils import csrf_input_lazy, csrf_token_lazy
+        context['request'] = request
+        context['csrf_input'] = csrf_input_lazy(request)
+        context['csrf_token'] = csrf_token_lazy(request)
+        for context_processor in template.backend.template_context_processors:
+            context.update(context_processor(request))
+    return template.template.generate(context)
+
+def _iter_django(template, context, request):
+    # Does what django.template.base.Template.render() does, without joining
+    # the output of the nodes.
+    engine_template = template.template
+    context = make_context(context, request,
+                           autoescape=template.backend.engine.autoescape)
+    with context.render_context.push_state(engine_template), \
+            context.bind_template(engine_template):
+        context.template_name = engine_template.name
+        for node in engine_template.nodelist:
+            # Tags like chunked_table can produce their output piecemeal.
+            stream = getattr(node, 'stream', None)
+            if stream is not None:
+                for chunk in stream(context):
+                    yield chunk
+            else:
+                yield node.render_annotated(context)
+
 def render_to_temporary_file(template, context, request=None, mode='w+b',
                              bufsize=-1, suffix='.html', prefix='tmp',
                              dir=None, delete=True):
+    label = template_name(template)
+    start = default_timer()
+    tempfile = NamedTemporaryFile(mode=mode, buffering=bufsize,
+                                  suffix=suffix, prefix=prefix,
+                                  dir=dir, delete=delete)
     try:
-        render = template.render
-    except AttributeError:
-        content = loader.render_to_string(template, context)
-    else:
-        if django.VERSION < (1, 8):
-            # If using a version of Django prior to 1.8, ensure ``context`` is an
-            # instance of ``Context``
-            if not isinstance(context, Context):
-                if request:
-                    context = RequestContext(request, context)
-                else:
-                    context = Context(context)
-            # Handle error when ``request`` is None
-            content = render(context)
-        else:
-            content = render(context, request)
-    content = smart_str(content)
-    content = make_absolute_paths(content)
-
-    try:
-        # Python3 has 'buffering' arg instead of 'bufsize'
-        tempfile = NamedTemporaryFile(mode=mode, buffering=bufsize,
-                                      suffix=suffix, prefix=prefix,
-                                      dir=dir, delete=delete)
-    except TypeError:
-        tempfile = NamedTemporaryFile(mode=mode, bufsize=bufsize,
-                                      suffix=suffix, prefix=prefix,
-                                      dir=dir, delete=delete)
-
-    try:
-        tempfile.write(content.encode('utf-8'))
+        output = tempfile
+        stats = None
+        if plan.fitting():
+            # Counted now rather than read back after the run.
+            stats = plan.HTMLStats()
+            output = plan.StatsWriter(tempfile, stats)
+        writer = ContentWriter(output, filters=content_filters())
+        for chunk in iter_render(template, context, request):
+            writer.write(chunk)
+        writer.close()
         tempfile.flush()
+        if stats is not None:
+            plan.remember(tempfile.name, stats)
+        metrics.observe(metrics.TEMPLATE_RENDER_SECONDS,
+                        default_timer() - start - writer.write_seconds, label)
+        metrics.observe(metrics.TEMPFILE_WRITE_SECONDS, writer.write_seconds,
+                        label)
         return tempfile
     except:
         # Clean-up tempfile if an Exception is raised.
@@ -1,20 +1,40 @@
-from __future__ import absolute_import
-
+from django.conf import settings
 from django.http import HttpResponse
-from django.template.response import TemplateResponse
+from django.template.response import SimpleTemplateResponse, TemplateResponse
 from django.views.generic import TemplateView
 
-from .utils import (content_disposition_filename, render_pdf_from_template)
+from . import metrics, profiling
+from .scheduler import INTERACTIVE, render_priority
+from .result import PDFResult
+
+# wkhtmltopdf.utils is imported when first needed, so that importing the
+# views from a URLconf doesn't load the rendering machinery.
+
+IMAGE_CONTENT_TYPES = {
+    'bmp': 'image/bmp',
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
 
 
 class PDFResponse(HttpResponse):
-    """HttpResponse that sets the headers for PDF output."""
+    """HttpResponse that sets the headers for PDF output.
+
+    ``content`` may be a ``PDFResult``, which is used without copying.
+    """
+
+    default_content_type = 'application/pdf'
+    # Size of the slices used to stream file-backed results.
+    chunk_size = 64 * 1024
+    pdf_result = None
 
     def __init__(self, content, status=200, content_type=None,
             filename=None, show_content_in_browser=None, *args, **kwargs):
 
         if content_type is None:
-            content_type = 'application/pdf'
+            content_type = self.default_content_type
 
         super(PDFResponse, self).__init__(content=content,
                                           status=status,
@@ -28,12 +48,55 @@ class PDFResponse(HttpResponse):
             if show_content_in_browser:
                 fileheader = 'inline; filename={0}'
 
+            from .utils import content_disposition_filename
             filename = content_disposition_filename(filename)
             header_content = fileheader.format(filename)
             self['Content-Disposition'] = header_content
         else:
             del self['Content-Disposition']
 
+    @property
+    def content(self):
+        return HttpResponse.content.fget(self)
+
+    @content.setter
+    def content(self, value):
+        if isinstance(value, PDFResult):
+            # Keep a reference to the result's own buffer rather than
+            # letting HttpResponse copy it into a new bytestring.
+            self.pdf_result = value
+            self._container = [value.raw]
+            # Released with the response, by close(). Django < 3.0 only
+            # has _closable_objects, whose close() methods it calls.
+            closers = getattr(self, '_resource_closers', None)
+            if closers is not None:
+                closers.append(value.close)
+            else:
+                self._closable_objects.append(value)
+            self.__dict__.pop('text', None)
+            # Otherwise CommonMiddleware reads the content to measure it.
+            self['Content-Length'] = str(value.size)
+        else:
+            if self.pdf_result is not None:
+                del self['Content-Length']
+            self.pdf_result = None
+            HttpResponse.content.fset(self, value)
+
+    def __iter__(self):
+        for chunk in self._container:
+            if isinstance(chunk, bytes):
+                yield chunk
+                continue
+            # mmap-backed results are sent in bounded slices.
+            for start in range(0, len(chunk), self.chunk_size):
+                yield chunk[start:start + self.chunk_size]
+
+
+class ImageResponse(PDFResponse):
+    """HttpResponse that sets the headers for image output."""
+
+    default_content_type = 'image/png'
+
 
 class PDFTemplateResponse(TemplateResponse, PDFResponse):
     """Renders a Template into a PDF using wkhtmltopdf"""
@@ -44,6 +107,12 @@ class PDFTemplateResponse(TemplateResponse, PDFResponse):
                  header_template=None, footer_template=None,
                  cmd_options=None, *args, **kwargs):
         cover_template = kwargs.pop('cover_template', None)
+        result = kwargs.pop('result', False)
+        coalesce = kwargs.pop('coalesce', None)
+        thumbnail_options = kwargs.pop('thumbnail_options', None)
+        metrics_label = kwargs.pop('metrics_label', None)
+        cache = kwargs.pop('cache', None)
+        engine = kwargs.pop('engine', None)
 
         super(PDFTemplateResponse, self).__init__(request=request,
                                                   template=template,
@@ -56,6 +125,23 @@ class PDFTemplateResponse(TemplateResponse, PDFResponse):
         self.header_template = header_template
         self.footer_template = footer_template
         self.cover_template = cover_template
+        self.result = result
+        if coalesce is None:
+            coalesce = bool(getattr(settings, 'WKHTMLTOPDF_COALESCE', False))
+        self.coalesce = coalesce
+        if cache is None:
+            cache = bool(getattr(settings, 'WKHTMLTOPDF_CACHE', None))
+        # Cached PDFs are served from an mmap of the cache file.
+        self.cache = cache
+        # Options for wkhtmltoimage. If set, a thumbnail is rendered from the
+        # same HTML alongside the PDF and stored in self.thumbnail.
+        self.thumbnail_options = thumbnail_options
+        self.thumbnail = None
+        # Name of the view or template the render time is recorded under.
+        self.metrics_label = metrics_label
+        # Name of the conversion engine, see wkhtmltopdf.engines. By default
+        # the one configured for the template.
+        self.engine = engine
         if cmd_options is None:
             cmd_options = {}
         self.cmd_options = cmd_options
@@ -69,7 +155,32 @@ class PDFTemplateResponse(TemplateResponse, PDFResponse):
         response content, you must either call render(), or set the
         content explicitly using the value of this property.
         """
+        from .utils import template_name
+        label = self.metrics_label or template_name(self.template_name)
+        with metrics.timer(metrics.RESPONSE_SECONDS, label), \
+                render_priority(INTERACTIVE), profiling.profile(label):
+            return self._render_pdf()
+
+    def _render_pdf(self):
+        from .utils import (render_pdf_and_image_from_template,
+                            render_pdf_from_template)
         cmd_options = self.cmd_options.copy()
+        if self.thumbnail_options is not None:
+            content, self.thumbnail = render_pdf_and_image_from_template(
+                self.resolve_template(self.template_name),
+                self.resolve_template(self.header_template),
+                self.resolve_template(self.footer_template),
+                context=self.resolve_context(self.context_data),
+                request=self._request,
+                cmd_options=cmd_options,
+                image_options=self.thumbnail_options.copy(),
+                cover_template=self.resolve_template(self.cover_template),
+                result=self.result or bool(self.cache),
+                coalesce=self.coalesce,
+                cache=self.cache,
+                engine=self.engine
+            )
+            return content
         return render_pdf_from_template(
             self.resolve_template(self.template_name),
             self.resolve_template(self.header_template),
@@ -77,10 +188,84 @@ class PDFTemplateResponse(TemplateResponse, PDFResponse):
             context=self.resolve_context(self.context_data),
             request=self._request,
             cmd_options=cmd_options,
-            cover_template=self.resolve_template(self.cover_template)
+            cover_template=self.resolve_template(self.cover_template),
+            result=self.result or bool(self.cache),
+            coalesce=self.coalesce,
+            cache=self.cache,
+            engine=self.engine
+        )
 
+    def plan(self):
+        """Returns a ``RenderPlan`` of this response, without rendering it."""
+        from .utils import plan_pdf_from_template
+        return plan_pdf_from_template(
+            self.resolve_template(self.template_name),
+            self.resolve_template(self.header_template),
+            self.resolve_template(self.footer_template),
+            context=self.resolve_context(self.context_data),
+            request=self._request,
+            cmd_options=self.cmd_options,
+            cover_template=self.resolve_template(self.cover_template),
+            engine=self.engine
         )
 
+    @property
+    def content(self):
+        return SimpleTemplateResponse.content.fget(self)
+
+    @content.setter
+    def content(self, value):
+        PDFResponse.content.fset(self, value)
+        self._is_rendered = True
+
+
+class ImageTemplateResponse(TemplateResponse, ImageResponse):
+    """Renders a Template into an image using wkhtmltoimage"""
+
+    def __init__(self, request, template, context=None,
+                 status=None, content_type=None, current_app=None,
+                 filename=None, show_content_in_browser=None,
+                 cmd_options=None, *args, **kwargs):
+        super(ImageTemplateResponse, self).__init__(request=request,
+                                                    template=template,
+                                                    context=context,
+                                                    status=status,
+                                                    *args, **kwargs)
+        if cmd_options is None:
+            cmd_options = {}
+        self.cmd_options = cmd_options
+        if content_type is None:
+            image_format = cmd_options.get('format') or getattr(
+                settings, 'WKHTMLTOIMAGE_CMD_OPTIONS', {}).get('format', 'png')
+            content_type = IMAGE_CONTENT_TYPES.get(image_format.lower(),
+                                                   self.default_content_type)
+        self['Content-Type'] = content_type
+        self.set_filename(filename, show_content_in_browser)
+
+    @property
+    def rendered_content(self):
+        """Returns the freshly rendered image for the template and context
+        described by the ImageTemplateResponse.
+        """
+        from .utils import render_image_from_template
+        with render_priority(INTERACTIVE):
+            return render_image_from_template(
+                self.resolve_template(self.template_name),
+                context=self.resolve_context(self.context_data),
+                request=self._request,
+                cmd_options=self.cmd_options.copy()
+            )
+
+    @property
+    def content(self):
+        return SimpleTemplateResponse.content.fget(self)
+
+    @content.setter
+    def content(self, value):
+        ImageResponse.content.fset(self, value)
+        self._is_rendered = True
+
+
 class PDFTemplateView(TemplateView):
     """Class-based view for HTML templates rendered to PDF."""
 
@@ -107,6 +292,14 @@ class PDFTemplateView(TemplateView):
         # 'quiet': None,
     }
 
+    # Command-line options for wkhtmltoimage. If set, a thumbnail is rendered
+    # alongside the PDF and available as response.thumbnail.
+    thumbnail_options = None
+
+    # Conversion engine, e.g. 'weasyprint'. If None, the one configured by
+    # WKHTMLTOPDF_TEMPLATE_ENGINES or WKHTMLTOPDF_ENGINE.
+    engine = None
+
     def __init__(self, *args, **kwargs):
         super(PDFTemplateView, self).__init__(*args, **kwargs)
 
@@ -131,6 +324,21 @@ class PDFTemplateView(TemplateView):
     def get_cmd_options(self):
         return self.cmd_options
 
+    def get_metrics_label(self):
+        """Returns the name this view's renders are recorded under."""
+        match = getattr(self.request, 'resolver_match', None)
+        if match is not None and match.view_name:
+            return match.view_name
+        return '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+
+    def get_render_plan(self, **kwargs):
+        """
+        Returns a ``RenderPlan`` of the PDF this view would render for
+        ``kwargs``, e.g. to reject oversized exports before rendering them.
+        """
+        response = self.render_to_response(self.get_context_data(**kwargs))
+        return response.plan()
+
     def render_to_response(self, context, **response_kwargs):
         """
         Returns a PDF response with a template rendered with the given context.
@@ -152,6 +360,9 @@ class PDFTemplateView(TemplateView):
                 footer_template=self.footer_template,
                 cmd_options=cmd_options,
                 cover_template=self.cover_template,
+                thumbnail_options=self.thumbnail_options,
+                metrics_label=self.get_metrics_label(),
+                engine=self.engine,
                 **response_kwargs
             )
         else:
@@ -159,3 +370,40 @@ class PDFTemplateView(TemplateView):
                 context=context,
                 **response_kwargs
             )
+
+
+class ImageTemplateView(PDFTemplateView):
+    """Class-based view for HTML templates rendered to an image."""
+
+    filename = 'rendered_image.png'
+
+    response_class = ImageTemplateResponse
+
+    # Command-line options to pass to wkhtmltoimage
+    cmd_options = {
+        # 'format': 'jpg',
+        # 'width': 320,
+    }
+
+    def render_to_response(self, context, **response_kwargs):
+        """
+        Returns an image response with a template rendered with the given
+        context.
+        """
+        if not issubclass(self.response_class, ImageTemplateResponse):
+            return super(ImageTemplateView, self).render_to_response(
+                context=context, **response_kwargs)
+
+        filename = response_kwargs.pop('filename', None)
+        cmd_options = response_kwargs.pop('cmd_options', None)
+        if filename is None:
+            filename = self.get_filename()
+        if cmd_options is None:
+            cmd_options = self.get_cmd_options()
+
+        return TemplateView.render_to_response(
+            self, context=context, filename=filename,
+            show_content_in_browser=self.show_content_in_browser,
+            cmd_options=cmd_options,
+            **response_kwargs
+        )
@@ -0,0 +1,200 @@
+import atexit
+from contextlib import contextmanager
+import os
+import select
+import subprocess
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+
+from .diagnostics import logger
+from .signals import setting_changed
+from .subprocess import resolve_executable
+
+DEFAULTS = {
+    # Number of Xvfb servers.
+    'displays': 2,
+    # Maximum number of wkhtmltopdf processes per display.
+    'max_clients': 4,
+    # The Xvfb command and its arguments. The display number is chosen by
+    # Xvfb with -displayfd.
+    'command': 'Xvfb',
+    'args': ['-screen', '0', '1280x1024x24', '-nolisten', 'tcp'],
+    # Seconds to wait for a server to accept connections.
+    'start_timeout': 10,
+}
+
+
+class Display(object):
+    """A long-lived Xvfb server, started on first use."""
+
+    def __init__(self, command, args, start_timeout):
+        self.command = command
+        self.args = list(args)
+        self.start_timeout = start_timeout
+        self.name = None
+        self.process = None
+        self.clients = 0
+        self.starts = 0
+        self._lock = threading.Lock()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def ensure(self):
+        """Starts the server, or restarts it if it died, and returns its
+        DISPLAY."""
+        with self._lock:
+            if not self.alive():
+                if self.process is not None:
+                    logger.warning('Xvfb display %s exited with code %s, '
+                                   'restarting it.', self.name,
+                                   self.process.returncode)
+                self._start()
+            return self.name
+
+    def _start(self):
+        # Xvfb writes the display number to -displayfd once it accepts
+        # connections, which avoids both polling and display number clashes
+        # with other processes.
+        read_fd, write_fd = os.pipe()
+        try:
+            process = subprocess.Popen(
+                [resolve_executable(self.command)] + self.args +
+                ['-displayfd', str(write_fd)],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, pass_fds=(write_fd,),
+                start_new_session=True)
+        finally:
+            os.close(write_fd)
+        try:
+            number = self._read_display(read_fd)
+        finally:
+            os.close(read_fd)
+        if number is None:
+            _terminate(process)
+            raise RuntimeError('Xvfb did not start within %s seconds.'
+                               % self.start_timeout)
+        self.process = process
+        self.name = ':%s' % number
+        self.starts += 1
+
+    def _read_display(self, fd):
+        data = b''
+        deadline = default_timer() + self.start_timeout
+        while not data.endswith(b'\n'):
+            timeout = deadline - default_timer()
+            if timeout <= 0 or not select.select([fd], [], [], timeout)[0]:
+                return None
+            chunk = os.read(fd, 32)
+            if not chunk:
+                # Xvfb exited.
+                return None
+            data += chunk
+        return int(data)
+
+    def stop(self):
+        with self._lock:
+            if self.process is not None:
+                _terminate(self.process)
+                self.process = None
+
+
+def _terminate(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class DisplayPool(object):
+    """
+    A pool of Xvfb servers shared by the wkhtmltopdf processes.
+
+    Each run gets the least busy display, waiting if every display has
+    ``max_clients`` runs. Displays whose server died are restarted when
+    they are next handed out.
+    """
+
+    def __init__(self, displays, max_clients, command, args, start_timeout):
+        self.max_clients = max_clients
+        self.displays = [Display(command, args, start_timeout)
+                         for i in range(displays)]
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def display(self):
+        """Holds a display and yields its DISPLAY, e.g. ':99'."""
+        with self._condition:
+            while True:
+                free = [d for d in self.displays if d.clients < self.max_clients]
+                if free:
+                    break
+                self._condition.wait()
+            display = min(free, key=lambda d: d.clients)
+            display.clients += 1
+        try:
+            yield display.ensure()
+        finally:
+            with self._condition:
+                display.clients -= 1
+                self._condition.notify()
+
+    def start(self):
+        """Starts every display now rather than on first use."""
+        for display in self.displays:
+            display.ensure()
+
+    def close(self):
+        for display in self.displays:
+            display.stop()
+
+
+_pool = []
+
+
+def get_pool():
+    """
+    Returns the DisplayPool configured by WKHTMLTOPDF_XVFB, or None if
+    wkhtmltopdf uses the DISPLAY of WKHTMLTOPDF_ENV.
+    """
+    if not _pool:
+        config = getattr(settings, 'WKHTMLTOPDF_XVFB', None)
+        pool = None
+        if config:
+            options = DEFAULTS.copy()
+            if isinstance(config, dict):
+                options.update(config)
+            pool = DisplayPool(**options)
+        _pool.append(pool)
+    return _pool[0]
+
+
+def _close_pool():
+    if _pool and _pool[0] is not None:
+        _pool[0].close()
+    del _pool[:]
+
+atexit.register(_close_pool)
+
+
+def _reset_pool(**kwargs):
+    if kwargs['setting'] == 'WKHTMLTOPDF_XVFB':
+        _close_pool()
+
+setting_changed.connect(_reset_pool)
+
+
+@contextmanager
+def display():
+    """Holds an Xvfb display and yields its name, or None if
+    WKHTMLTOPDF_XVFB is not set."""
+    pool = get_pool()
+    if pool is None:
+        yield None
+    else:
+        with pool.display() as name:
+            yield name